@@ -0,0 +1,307 @@
+"""
+Mock-сервер API Whoosh и Cognito для нагрузочного тестирования.
+
+Отвечает в том же формате, что и настоящий API, на все запросы, которые выполняет main.py.
+Поведение задается переменными окружения:
+- MOCK_LATENCY_MS, MOCK_JITTER_MS - задержка ответа (среднее и разброс, мс)
+- MOCK_ERROR_RATE - доля ответов 503
+- MOCK_EXPIRE_RATE - доля ответов 401 "Token expired" при действующем токене
+- MOCK_TOKEN_TTL - время жизни выдаваемых access_token (с)
+- MOCK_DEVICES - количество самокатов в ответе /devices
+
+Запуск: uvicorn mock_whoosh:app --app-dir benchmarks --port 8090
+
+Служебные эндпоинты:
+- GET /_mock/stats - количество запросов по путям, ответов 401 и обновлений токенов
+- POST /_mock/expire_tokens - все выданные до этого момента токены считаются истекшими
+- POST /_mock/reset - сброс счетчиков
+"""
+
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "50"))
+JITTER_MS = float(os.getenv("MOCK_JITTER_MS", "20"))
+ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+EXPIRE_RATE = float(os.getenv("MOCK_EXPIRE_RATE", "0"))
+TOKEN_TTL = float(os.getenv("MOCK_TOKEN_TTL", "3600"))
+DEVICES_COUNT = int(os.getenv("MOCK_DEVICES", "2000"))
+
+CENTER_LAT = 55.7558
+CENTER_LNG = 37.6173
+
+app = FastAPI(title="Mock Whoosh")
+
+requests_by_path = Counter()
+unauthorized = Counter()
+state = {
+    "token_refreshes": 0,
+    # Токены, выданные раньше этого момента, считаются истекшими
+    "revoked_before": 0.0,
+    "trips": {}
+}
+
+
+def make_jwt(exp: float) -> str:
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    payload = {"exp": int(exp), "iat": time.time(), "sub": "mock-user", "jti": uuid.uuid4().hex}
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(payload)}.mock"
+
+
+def read_jwt(token: str) -> dict:
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        return {}
+
+
+def iso(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def device(code: str) -> dict:
+    rng = random.Random(code)
+    return {
+        "id": f"device-{code}",
+        "code": code,
+        "model": "Ninebot Max Plus",
+        "battery": {"power": rng.randint(5, 100)},
+        "state": {
+            "position": {"point": {
+                "lat": CENTER_LAT + rng.uniform(-0.05, 0.05),
+                "lng": CENTER_LNG + rng.uniform(-0.08, 0.08)
+            }},
+            "speedMode": {"current": "NORMAL"}
+        }
+    }
+
+
+def trip_payload(trip: dict, status: str) -> dict:
+    duration = int(time.time() - trip["started_at"])
+    payload = {
+        "id": trip["id"],
+        "status": status,
+        "createdAt": iso(datetime.fromtimestamp(trip["started_at"], timezone.utc)),
+        "duration": {"amount": duration, "unit": "с"},
+        "distance": {"amount": round(duration * 0.004, 2)},
+        "actualTripCost": {"netPrice": {"amount": 500 + duration * 10}},
+        "accruedPricing": {"price": {"amount": 500 + duration * 10}},
+        "device": device(trip["code"])
+    }
+    if trip.get("reservation_id"):
+        payload["reservation"] = {"id": trip["reservation_id"], "status": "COMPLETED"}
+    return payload
+
+
+@app.middleware("http")
+async def inject_behaviour(request: Request, call_next):
+    path = request.url.path
+    if path.startswith("/_mock"):
+        return await call_next(request)
+
+    requests_by_path[path] += 1
+    delay = max(0.0, random.gauss(LATENCY_MS, JITTER_MS)) / 1000
+    await asyncio.sleep(delay)
+
+    if random.random() < ERROR_RATE:
+        return PlainTextResponse("Service Unavailable", status_code=503)
+
+    # Cognito не проверяет access_token
+    if path != "/":
+        token = request.headers.get("X-Auth-Token") or ""
+        claims = read_jwt(token)
+        expired = claims.get("exp", 0) <= time.time() or claims.get("iat", 0) < state["revoked_before"]
+        if expired or random.random() < EXPIRE_RATE:
+            unauthorized[path] += 1
+            return PlainTextResponse("Token expired", status_code=401)
+
+    return await call_next(request)
+
+
+@app.post("/")
+async def cognito(request: Request):
+    body = json.loads(await request.body())
+    if not body.get("AuthParameters", {}).get("REFRESH_TOKEN"):
+        return JSONResponse({"__type": "NotAuthorizedException"}, status_code=400)
+    state["token_refreshes"] += 1
+    expires_at = time.time() + TOKEN_TTL
+    return {
+        "AuthenticationResult": {
+            "AccessToken": make_jwt(expires_at),
+            "IdToken": make_jwt(expires_at),
+            "ExpiresIn": int(TOKEN_TTL),
+            "TokenType": "Bearer"
+        },
+        "ChallengeParameters": {}
+    }
+
+
+@app.get("/user-minute-pack/info")
+async def minute_pack_info(regionId: str = ""):
+    return {
+        "purchasedMinutePack": {
+            "secondsLeft": 7140,
+            "validTo": iso(datetime.now(timezone.utc) + timedelta(days=20)),
+            "annotations": {"packName": "120 минут", "packDuration": "30 дней"}
+        }
+    }
+
+
+@app.get("/devices/state")
+async def device_state(code: str):
+    return {"device": device(code)}
+
+
+@app.get("/devices")
+async def devices(regionId: str = ""):
+    return {"devices": [device(f"MK{index:05d}") for index in range(DEVICES_COUNT)]}
+
+
+@app.get("/tariffs/tariff/minute-pack")
+async def tariffs(device: str):
+    return {
+        "tariffs": [{
+            "id": "tariff-minute-pack",
+            "type": "MINUTE_PACK",
+            "price": {"amount": 0, "currency": "RUB"},
+            "baseTariff": {"start": {"amount": 0}, "minute": {"amount": 0}}
+        }],
+        "tariffsToken": make_jwt(time.time() + 300),
+        "usersMinutePack": {"secondsLeft": 7140}
+    }
+
+
+@app.post("/trips")
+async def start_trip(request: Request):
+    body = json.loads(await request.body())
+    trip = {
+        "id": str(uuid.uuid4()),
+        "code": body.get("deviceCode", "MK00000"),
+        "started_at": time.time(),
+        "reservation_id": str(uuid.uuid4()) if body.get("debugData", {}).get("sourceType") == "reservation_scan" else None
+    }
+    state["trips"][trip["id"]] = trip
+    return {"trip": trip_payload(trip, "ACTIVE")}
+
+
+@app.get("/users/logged/active-trips")
+async def active_trips():
+    return {"trips": [trip_payload(trip, "ACTIVE") for trip in list(state["trips"].values())[:1]]}
+
+
+@app.get("/trips/active/{trip_id}")
+async def trip_info(trip_id: str):
+    trip = state["trips"].get(trip_id) or {"id": trip_id, "code": "MK00000", "started_at": time.time() - 300}
+    return {"trip": trip_payload(trip, "ACTIVE")}
+
+
+@app.get("/trips/{trip_id}/route")
+async def trip_route(trip_id: str):
+    rng = random.Random(trip_id)
+    lat, lng = CENTER_LAT, CENTER_LNG
+    points = []
+    for _ in range(600):
+        lat += rng.uniform(-0.0001, 0.0002)
+        lng += rng.uniform(-0.0001, 0.0002)
+        points.append({"lat": lat, "lng": lng})
+    return {"route": {"points": points}}
+
+
+@app.post("/trips/{trip_id}/completion")
+async def complete_trip(trip_id: str):
+    trip = state["trips"].pop(trip_id, None) or {"id": trip_id, "code": "MK00000", "started_at": time.time() - 300}
+    return {"trip": trip_payload(trip, "COMPLETED")}
+
+
+@app.get("/users/logged")
+async def user():
+    return {"user": {
+        "id": "mock-user",
+        "name": "Нагрузочный Тест",
+        "phone": "+70000000000",
+        "email": "bench@example.com",
+        "locale": "ru",
+        "tripsCount": 42,
+        "verification": "DONE",
+        "authTypes": ["PHONE"],
+        "debtor": False
+    }}
+
+
+@app.get("/payment/payment-methods")
+async def payment_methods(regionId: str = ""):
+    return {"paymentMethods": [{
+        "type": "CARD",
+        "cardBinding": {
+            "id": "card-1",
+            "card": {"cardType": "VISA", "number": "4111 **** **** 1111"},
+            "rbsType": "SBER",
+            "status": "ACTIVE",
+            "preferable": True,
+            "lastSuccessfulCharge": True,
+            "createdAt": "2024-01-01T00:00:00Z"
+        }
+    }]}
+
+
+@app.get("/subscriptions/user")
+async def user_subscriptions(regionId: str = ""):
+    return {"userSubscriptions": []}
+
+
+@app.get("/offer/subscriptions")
+async def subscription_offers(regionId: str = ""):
+    return {"subscriptionOffers": [{"id": "offer-1", "title": "Whoosh Plus", "price": {"amount": 399, "currency": "RUB"}}]}
+
+
+@app.post("/reservations/{code}")
+async def reserve(code: str):
+    now = datetime.now(timezone.utc)
+    return {"reservation": {
+        "id": str(uuid.uuid4()),
+        "createdAt": iso(now),
+        "expiresAt": iso(now + timedelta(minutes=20)),
+        "device": device(code)
+    }}
+
+
+@app.delete("/reservations/{reservation_id}")
+async def cancel_reservation(reservation_id: str):
+    now = iso(datetime.now(timezone.utc))
+    return {"reservation": {"id": reservation_id, "status": "CANCELLED", "createdAt": now, "finishedAt": now}}
+
+
+@app.get("/_mock/stats")
+async def stats():
+    return {
+        "requests": dict(requests_by_path),
+        "unauthorized": dict(unauthorized),
+        "token_refreshes": state["token_refreshes"]
+    }
+
+
+@app.post("/_mock/expire_tokens")
+async def expire_tokens():
+    state["revoked_before"] = time.time()
+    return {"revoked_before": state["revoked_before"]}
+
+
+@app.post("/_mock/reset")
+async def reset():
+    requests_by_path.clear()
+    unauthorized.clear()
+    state["token_refreshes"] = 0
+    return {"reset": True}
@@ -0,0 +1,337 @@
+"""
+Нагрузочные сценарии для main.py против mock-сервера Whoosh (benchmarks/mock_whoosh.py).
+
+Скрипт запускает mock-сервер и сервер main.py во временном каталоге (WHOOSH_BASE_URL и
+WHOOSH_COGNITO_URL указывают на mock), прогоняет сценарии и печатает для каждого эндпоинта
+количество запросов, ошибки, пропускную способность и задержки p50/p95/p99.
+Результат сравнивается с benchmarks/baseline.json: рост p95 или падение пропускной
+способности больше чем на --tolerance считается регрессией (код возврата 1).
+
+    python benchmarks/run.py                          # все сценарии, сравнение с baseline.json
+    python benchmarks/run.py polling --duration 30    # один сценарий
+    python benchmarks/run.py --save-baseline          # записать результат как новый baseline
+
+Сценарии:
+- polling - клиенты периодически опрашивают /api/trip_info и /api/minute_pack
+- unlock_burst - волны одновременных /api/start_trip и затем /api/end_trip
+- token_storm - опрос, во время которого mock-сервер раз в несколько секунд объявляет
+  все токены истекшими (ответ 401 "Token expired" на все запросы со старым токеном)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+SCENARIOS = ("polling", "unlock_burst", "token_storm")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Recorder:
+    """Задержки и ошибки запросов по эндпоинтам"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors = Counter()
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+
+    async def call(self, client: httpx.AsyncClient, method: str, path: str, name: Optional[str] = None, **kwargs):
+        name = name or f"{method} {path}"
+        started = time.perf_counter()
+        response = None
+        try:
+            response = await client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.samples[name].append((time.perf_counter() - started) * 1000)
+        self.statuses[name][str(status)] += 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors[name] += 1
+        return response
+
+    def report(self, duration: float) -> Dict[str, Dict]:
+        result = {}
+        for name, samples in sorted(self.samples.items()):
+            latencies = np.array(samples)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            result[name] = {
+                "requests": len(samples),
+                "errors": self.errors[name],
+                "rps": round(len(samples) / duration, 1),
+                "p50_ms": round(float(p50), 2),
+                "p95_ms": round(float(p95), 2),
+                "p99_ms": round(float(p99), 2),
+                "statuses": dict(self.statuses[name])
+            }
+        return result
+
+
+async def start_trip(client: httpx.AsyncClient, recorder: Recorder, code: str) -> Optional[str]:
+    response = await recorder.call(client, "POST", "/api/start_trip", json={"code": code})
+    if response is not None and response.status_code == 200:
+        return response.json().get("trip_id")
+    return None
+
+
+async def poll(client: httpx.AsyncClient, recorder: Recorder, trip_id: str, deadline: float, interval: float):
+    while time.perf_counter() < deadline:
+        await asyncio.gather(
+            recorder.call(client, "GET", "/api/trip_info", "GET /api/trip_info", params={"trip_id": trip_id}),
+            recorder.call(client, "GET", "/api/minute_pack")
+        )
+        await asyncio.sleep(interval)
+
+
+async def scenario_polling(client: httpx.AsyncClient, mock: httpx.AsyncClient, args) -> tuple:
+    recorder = Recorder()
+    trip_id = await start_trip(client, Recorder(), "PL00001")
+    deadline = time.perf_counter() + args.duration
+    await asyncio.gather(*(poll(client, recorder, trip_id, deadline, args.poll_interval) for _ in range(args.clients)))
+    return recorder, {}
+
+
+async def scenario_unlock_burst(client: httpx.AsyncClient, mock: httpx.AsyncClient, args) -> tuple:
+    recorder = Recorder()
+    for wave in range(args.waves):
+        codes = [f"UB{wave:02d}{index:03d}" for index in range(args.burst)]
+        trip_ids = await asyncio.gather(*(start_trip(client, recorder, code) for code in codes))
+        await asyncio.gather(*(
+            recorder.call(client, "POST", "/api/end_trip", json={"trip_id": trip_id})
+            for trip_id in trip_ids if trip_id
+        ))
+    return recorder, {}
+
+
+async def scenario_token_storm(client: httpx.AsyncClient, mock: httpx.AsyncClient, args) -> tuple:
+    recorder = Recorder()
+    trip_id = await start_trip(client, Recorder(), "TS00001")
+    before = (await mock.get("/_mock/stats")).json()
+    deadline = time.perf_counter() + args.duration
+
+    async def expire_tokens():
+        storms = 0
+        while time.perf_counter() + args.storm_interval < deadline:
+            await asyncio.sleep(args.storm_interval)
+            await mock.post("/_mock/expire_tokens")
+            storms += 1
+        return storms
+
+    storms, *_ = await asyncio.gather(
+        expire_tokens(),
+        *(poll(client, recorder, trip_id, deadline, args.poll_interval) for _ in range(args.clients))
+    )
+    after = (await mock.get("/_mock/stats")).json()
+    extra = {
+        "storms": storms,
+        "cognito_refreshes": after["token_refreshes"] - before["token_refreshes"],
+        "upstream_401": sum(after["unauthorized"].values()) - sum(before["unauthorized"].values())
+    }
+    return recorder, extra
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/readyz")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Сервер {url} не стал готов за {timeout} с")
+
+
+def start_servers(args, workdir: str) -> tuple:
+    mock_port = free_port()
+    api_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+
+    mock_env = {
+        **os.environ,
+        "MOCK_LATENCY_MS": str(args.latency_ms),
+        "MOCK_JITTER_MS": str(args.jitter_ms),
+        "MOCK_ERROR_RATE": str(args.error_rate),
+        "MOCK_EXPIRE_RATE": str(args.expire_rate)
+    }
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "mock_whoosh:app", "--app-dir", BENCH_DIR,
+         "--port", str(mock_port), "--log-level", "warning", "--no-access-log"],
+        env=mock_env, cwd=workdir,
+        stdout=open(os.path.join(workdir, "mock.log"), "w"), stderr=subprocess.STDOUT
+    )
+
+    with open(os.path.join(workdir, "whoosh_tokens.json"), "w") as f:
+        json.dump({"access_token": None, "id_token": None, "refresh_token": "benchmark"}, f)
+
+    api_env = {
+        **os.environ,
+        "WHOOSH_BASE_URL": mock_url,
+        "WHOOSH_COGNITO_URL": f"{mock_url}/",
+        "WHOOSH_ACCOUNTS_FILE": os.path.join(workdir, "whoosh_accounts.json"),
+        "WHOOSH_TRIP_HISTORY_DB": os.path.join(workdir, "whoosh_trips.db"),
+        "WHOOSH_SHARED_DB": os.path.join(workdir, "whoosh_shared.db"),
+        "WHOOSH_WORKERS": str(args.workers)
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        api_env[key] = value
+    api_command = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO_DIR,
+                   "--port", str(api_port), "--log-level", "warning", "--no-access-log"]
+    if args.workers > 1:
+        api_command += ["--workers", str(args.workers)]
+    api = subprocess.Popen(
+        api_command, env=api_env, cwd=workdir,
+        stdout=open(os.path.join(workdir, "api.log"), "w"), stderr=subprocess.STDOUT
+    )
+    return mock, api, mock_url, f"http://127.0.0.1:{api_port}"
+
+
+async def run_scenarios(args, mock_url: str, api_url: str) -> Dict:
+    await wait_ready(api_url)
+    results = {}
+    limits = httpx.Limits(max_connections=args.clients * 2 + args.burst, max_keepalive_connections=args.clients * 2 + args.burst)
+    async with httpx.AsyncClient(base_url=api_url, timeout=60, limits=limits) as client, \
+            httpx.AsyncClient(base_url=mock_url, timeout=10) as mock:
+        for name in args.scenarios:
+            await mock.post("/_mock/reset")
+            started = time.perf_counter()
+            recorder, extra = await globals()[f"scenario_{name}"](client, mock, args)
+            duration = time.perf_counter() - started
+            upstream = (await mock.get("/_mock/stats")).json()
+            results[name] = {
+                "duration_s": round(duration, 2),
+                "endpoints": recorder.report(duration),
+                "upstream_requests": sum(upstream["requests"].values()),
+                **extra
+            }
+    return results
+
+
+def print_results(results: Dict, baseline: Optional[Dict]):
+    header = f"{'сценарий / эндпоинт':<40}{'запросы':>9}{'ошибки':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'p95 было':>10}"
+    print(header)
+    print("-" * len(header))
+    for scenario, data in results.items():
+        extra = {key: value for key, value in data.items() if key not in ("endpoints", "duration_s")}
+        print(f"{scenario} ({data['duration_s']} с) {json.dumps(extra, ensure_ascii=False)}")
+        base_endpoints = (baseline or {}).get(scenario, {}).get("endpoints", {})
+        for endpoint, stats in data["endpoints"].items():
+            base_p95 = base_endpoints.get(endpoint, {}).get("p95_ms")
+            print(
+                f"  {endpoint:<38}{stats['requests']:>9}{stats['errors']:>8}{stats['rps']:>9}"
+                f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}"
+                f"{base_p95 if base_p95 is not None else '-':>10}"
+            )
+
+
+def find_regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for scenario, data in results.items():
+        base_endpoints = baseline.get(scenario, {}).get("endpoints", {})
+        for endpoint, stats in data["endpoints"].items():
+            base = base_endpoints.get(endpoint)
+            if base is None:
+                continue
+            if stats["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{scenario} {endpoint}: p95 {base['p95_ms']} -> {stats['p95_ms']} мс")
+            if stats["rps"] < base["rps"] * (1 - tolerance):
+                regressions.append(f"{scenario} {endpoint}: rps {base['rps']} -> {stats['rps']}")
+            if stats["errors"] > base["errors"]:
+                regressions.append(f"{scenario} {endpoint}: ошибок {base['errors']} -> {stats['errors']}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочные сценарии WhooshAPI против mock-сервера Whoosh")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=f"сценарии: {', '.join(SCENARIOS)} (по умолчанию все)")
+    parser.add_argument("--duration", type=float, default=15, help="длительность сценариев с опросом, с")
+    parser.add_argument("--clients", type=int, default=20, help="количество опрашивающих клиентов")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="пауза между опросами клиента, с")
+    parser.add_argument("--burst", type=int, default=50, help="одновременных начал поездки в волне")
+    parser.add_argument("--waves", type=int, default=3, help="количество волн в unlock_burst")
+    parser.add_argument("--storm-interval", type=float, default=3, help="как часто истекают токены в token_storm, с")
+    parser.add_argument("--latency-ms", type=float, default=50, help="задержка mock-сервера, мс")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="разброс задержки mock-сервера, мс")
+    parser.add_argument("--error-rate", type=float, default=0, help="доля ответов 503 от mock-сервера")
+    parser.add_argument("--expire-rate", type=float, default=0, help="доля случайных ответов 401 Token expired")
+    parser.add_argument("--workers", type=int, default=1, help="количество воркеров main.py")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменная окружения для main.py")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="файл baseline для сравнения")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат в файл baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимое ухудшение относительно baseline")
+    parser.add_argument("--output", help="записать результат в JSON-файл")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("scenarios", "baseline", "save_baseline", "tolerance", "output")}
+
+    with tempfile.TemporaryDirectory(prefix="whoosh-bench-") as workdir:
+        mock, api, mock_url, api_url = start_servers(args, workdir)
+        try:
+            results = asyncio.run(run_scenarios(args, mock_url, api_url))
+        except Exception:
+            print(open(os.path.join(workdir, "api.log")).read()[-4000:], file=sys.stderr)
+            raise
+        finally:
+            api.terminate()
+            mock.terminate()
+            api.wait()
+            mock.wait()
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        if saved.get("config") != config:
+            print(f"Внимание: параметры отличаются от baseline ({saved.get('config')})\n")
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2, ensure_ascii=False)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"\nBaseline записан в {args.baseline}")
+        return 0
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print("\nРегрессии относительно baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nРегрессий относительно baseline нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
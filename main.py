@@ -1,30 +1,149 @@
 from fastapi import FastAPI, HTTPException, Query,  Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 import httpx
-import uvicorn
+import numpy as np
+import orjson
+import asyncio
+import base64
+import copy
+import heapq
+import itertools
+import math
+import random
+import time
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from typing import Optional, Dict, Any, List, Tuple, Union
 import json
 import os
+import atexit
 import logging
+import logging.handlers
+import queue
+import sqlite3
+import sys
+import threading
 import uuid
-from datetime import datetime
+import zlib
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from contextvars import Context, ContextVar, copy_context
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+
+# Настройки логирования
+LOG_LEVEL = os.getenv("WHOOSH_LOG_LEVEL", "INFO").upper()
+# json - одна JSON-строка на запись, text - обычный текстовый формат
+LOG_FORMAT = os.getenv("WHOOSH_LOG_FORMAT", "json")
+# Доля запросов, для которых подробные записи (тела ответов API Whoosh) пишутся на уровне INFO,
+# для остальных - на уровне DEBUG. Для отдельных маршрутов долю можно задать
+# в WHOOSH_LOG_PAYLOAD_SAMPLE_RATES, например "/api/end_trip=1,/api/trip_info=0.01"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("WHOOSH_LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+LOG_PAYLOAD_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition("=") for item in os.getenv("WHOOSH_LOG_PAYLOAD_SAMPLE_RATES", "").split(","))
+    if route.strip()
+}
+REQUEST_ID_HEADER = "X-Request-Id"
+
+# id запроса к нашему API (выставляется middleware): попадает в каждую запись лога и в запросы к API Whoosh
+current_request_id: ContextVar[Optional[str]] = ContextVar("current_request_id", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет к записи id текущего запроса (выполняется в потоке, создавшем запись)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id.get() or "-"
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Запись лога в виде одной JSON-строки"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        request_id = getattr(record, "request_id", "-")
+        if request_id != "-":
+            entry["request_id"] = request_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передает записи в очередь, откуда их форматирует и выводит поток QueueListener.
+    В вызывающем потоке собирается только текст сообщения (аргументы могут измениться позже),
+    а трассировка исключения и JSON формируются уже в потоке вывода.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 
-# Настраиваем логирование
-logging.basicConfig(level=logging.INFO)
+# Настраиваем логирование: вывод в stderr выполняется в отдельном потоке, а не в цикле событий
+def setup_logging() -> logging.handlers.QueueListener:
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    # Журналы uvicorn (в том числе журнал доступа, если он не отключен) выводятся через ту же очередь
+    for name in ("uvicorn", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        if uvicorn_logger.handlers:
+            uvicorn_logger.handlers = [handler]
+
+    # httpx пишет каждый запрос к API Whoosh на уровне INFO: это есть в метриках /metrics,
+    # поэтому в лог такие записи попадают только при WHOOSH_LOG_LEVEL=DEBUG
+    if root.getEffectiveLevel() > logging.DEBUG:
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    # Дописываем оставшиеся в очереди записи при завершении процесса
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Whoosh API Wrapper", description="Упрощенный API для сервиса аренды самокатов Whoosh")
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # В продакшн-окружении лучше указать конкретные домены
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Подробные записи (тела ответов API Whoosh) пишутся на уровне INFO только для доли запросов
+# маршрута, для остальных - на уровне DEBUG. Выбор зависит от id запроса, поэтому у выбранного
+# запроса в лог попадают все его подробные записи
+def log_payload(route: str, message: str, *args):
+    rate = LOG_PAYLOAD_SAMPLE_RATES.get(route, LOG_PAYLOAD_SAMPLE_RATE)
+    request_id = current_request_id.get()
+    if request_id is None:
+        sampled = random.random() < rate
+    else:
+        sampled = zlib.crc32(request_id.encode()) % 10000 < rate * 10000
+    logger.log(logging.INFO if sampled else logging.DEBUG, message, *args)
+
+app = FastAPI(title="Whoosh API Wrapper", description="Упрощенный API для сервиса аренды самокатов Whoosh")
 
 STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whoosh-telegram-app/build")
 
@@ -35,32 +154,346 @@ app.mount("/static", StaticFiles(directory=os.path.join(STATIC_DIR, "static")),
 TOKENS_FILE = "whoosh_tokens.json"
 CONFIG_FILE = "whoosh_config.json"
 
+# Ограничения для параллельных запросов к API Whoosh внутри одного эндпоинта
+UPSTREAM_FANOUT_LIMIT = int(os.getenv("WHOOSH_UPSTREAM_FANOUT_LIMIT", "4"))
+UPSTREAM_CALL_TIMEOUT = float(os.getenv("WHOOSH_UPSTREAM_CALL_TIMEOUT", "15"))
+
+# Групповые операции: сколько самокатов обрабатывается одновременно и сколько ждать каждый
+BATCH_MAX_ITEMS = int(os.getenv("WHOOSH_BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("WHOOSH_BATCH_CONCURRENCY", "5"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("WHOOSH_BATCH_MAX_CONCURRENCY", "20"))
+BATCH_ITEM_TIMEOUT = float(os.getenv("WHOOSH_BATCH_ITEM_TIMEOUT", "45"))
+
+# Кэш ответов API Whoosh: путь -> (время жизни, сколько еще можно отдавать устаревший ответ), в секундах
+CACHE_TTLS = {
+    "/user-minute-pack/info": (5, 30),
+    "/users/logged": (60, 600),
+    "/payment/payment-methods": (60, 600),
+    "/subscriptions/user": (60, 600),
+    "/offer/subscriptions": (300, 3600)
+}
+CACHE_MAX_ENTRIES = int(os.getenv("WHOOSH_CACHE_MAX_ENTRIES", "2000"))
+CACHE_MAX_BYTES = int(os.getenv("WHOOSH_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Кэш устройств: код самоката -> id и тарифы самоката (tariffs + tariffsToken)
+DEVICE_CACHE_MAX_ENTRIES = int(os.getenv("WHOOSH_DEVICE_CACHE_MAX_ENTRIES", "5000"))
+DEVICE_ID_CACHE_TTL = int(os.getenv("WHOOSH_DEVICE_ID_CACHE_TTL", "3600"))
+TARIFFS_CACHE_TTL = int(os.getenv("WHOOSH_TARIFFS_CACHE_TTL", "120"))
+# Запас до истечения tariffsToken, после которого токен из кэша уже не используется
+TARIFFS_TOKEN_MARGIN = int(os.getenv("WHOOSH_TARIFFS_TOKEN_MARGIN", "15"))
+
+# Данные аккаунта, которые меняются после начала/завершения поездки и бронирования
+TRIP_WRITE_INVALIDATES = ["/user-minute-pack/info", "/users/logged"]
+
+# Поток обновлений поездки: интервалы опроса API Whoosh и keep-alive для клиентов (секунды)
+TRIP_STREAM_INTERVAL = float(os.getenv("WHOOSH_TRIP_STREAM_INTERVAL", "1"))
+TRIP_STREAM_MINUTE_PACK_INTERVAL = float(os.getenv("WHOOSH_TRIP_STREAM_MINUTE_PACK_INTERVAL", "5"))
+TRIP_STREAM_KEEPALIVE = float(os.getenv("WHOOSH_TRIP_STREAM_KEEPALIVE", "15"))
+TRIP_STREAM_QUEUE_SIZE = 16
+
+# Сроки бронирований и пакетов минут: за сколько секунд предупреждать и куда слать события
+EXPIRY_WARNING_SECONDS = float(os.getenv("WHOOSH_EXPIRY_WARNING_SECONDS", "120"))
+WEBHOOK_URL = os.getenv("WHOOSH_WEBHOOK_URL")
+WEBHOOK_TIMEOUT = float(os.getenv("WHOOSH_WEBHOOK_TIMEOUT", "5"))
+EVENT_QUEUE_SIZE = 64
+
+# Объединять одинаковые одновременные GET-запросы к API Whoosh в один
+COALESCE_REQUESTS = os.getenv("WHOOSH_COALESCE_REQUESTS", "1") == "1"
+
+# Ограничение частоты запросов к API Whoosh: запросов в секунду и размер всплеска
+# на каждую пару (аккаунт, шаблон пути); 0 (по умолчанию) - без ограничения частоты
+UPSTREAM_RATE_LIMIT = float(os.getenv("WHOOSH_UPSTREAM_RATE_LIMIT", "0"))
+UPSTREAM_RATE_BURST = float(os.getenv("WHOOSH_UPSTREAM_RATE_BURST", "20"))
+# Адаптивный лимит одновременных запросов к API Whoosh (AIMD): растет на 1 за "окно"
+# успешных ответов и умножается на UPSTREAM_CONCURRENCY_BACKOFF при 429/5xx/ошибках сети
+# или ответах медленнее UPSTREAM_LATENCY_TARGET секунд
+UPSTREAM_CONCURRENCY_INITIAL = int(os.getenv("WHOOSH_UPSTREAM_CONCURRENCY_INITIAL", "20"))
+UPSTREAM_CONCURRENCY_MIN = int(os.getenv("WHOOSH_UPSTREAM_CONCURRENCY_MIN", "2"))
+UPSTREAM_CONCURRENCY_MAX = int(os.getenv("WHOOSH_UPSTREAM_CONCURRENCY_MAX", "100"))
+UPSTREAM_CONCURRENCY_BACKOFF = float(os.getenv("WHOOSH_UPSTREAM_CONCURRENCY_BACKOFF", "0.7"))
+UPSTREAM_LATENCY_TARGET = float(os.getenv("WHOOSH_UPSTREAM_LATENCY_TARGET", "2"))
+# Сколько секунд запрос может ждать в очереди, прежде чем получит 429
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("WHOOSH_UPSTREAM_QUEUE_TIMEOUT", "5"))
+
+# Повторы запросов к API Whoosh при таймаутах, ошибках сети и 5xx: (метод, шаблон пути) -> политика.
+# "safe" - повторять всегда, "never" - не повторять.
+# Для путей без своей записи используется политика метода ((метод, "*")).
+# Ошибки установки соединения повторяются для любых запросов: запрос до API Whoosh не дошел.
+# Начало и завершение поездки после таймаута или 5xx не повторяются (API Whoosh не поддерживает
+# ключи идемпотентности, а запрос мог выполниться): вместо этого проверяется состояние поездки
+RETRY_POLICIES = {
+    ("GET", "*"): "safe",
+    ("POST", "*"): "never",
+    ("DELETE", "*"): "never"
+}
+RETRY_STATUSES = {500, 502, 503, 504}
+RETRY_MAX_ATTEMPTS = int(os.getenv("WHOOSH_RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("WHOOSH_RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.getenv("WHOOSH_RETRY_MAX_DELAY", "2"))
+# Бюджет повторов: не больше RETRY_BUDGET_RATIO от числа запросов за RETRY_BUDGET_WINDOW секунд
+# плюс RETRY_BUDGET_MIN_PER_SECOND повторов в секунду, чтобы повторы не умножали нагрузку во время сбоя
+RETRY_BUDGET_RATIO = float(os.getenv("WHOOSH_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("WHOOSH_RETRY_BUDGET_MIN_PER_SECOND", "1"))
+RETRY_BUDGET_WINDOW = float(os.getenv("WHOOSH_RETRY_BUDGET_WINDOW", "10"))
+
+# Размыкатель цепи для каждого пути API Whoosh (и для Cognito): после BREAKER_FAILURE_THRESHOLD
+# ошибок подряд запросы по пути BREAKER_OPEN_SECONDS секунд сразу завершаются 503, затем один
+# пробный запрос решает, замкнуть цепь или снова разомкнуть
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("WHOOSH_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("WHOOSH_BREAKER_OPEN_SECONDS", "30"))
+# Последние успешные ответы на GET-запросы, которые отдаются, пока цепь к пути API Whoosh разомкнута
+FALLBACK_MAX_AGE = int(os.getenv("WHOOSH_FALLBACK_MAX_AGE", "3600"))
+FALLBACK_MAX_ENTRIES = int(os.getenv("WHOOSH_FALLBACK_MAX_ENTRIES", "2000"))
+FALLBACK_MAX_BYTES = int(os.getenv("WHOOSH_FALLBACK_MAX_BYTES", str(16 * 1024 * 1024)))
+STALE_HEADER = "X-Data-Stale"
+
+# Файл с пулом аккаунтов Whoosh (если его нет, используется один аккаунт из TOKENS_FILE)
+ACCOUNTS_FILE = os.getenv("WHOOSH_ACCOUNTS_FILE", "whoosh_accounts.json")
+DEFAULT_ACCOUNT_ID = "default"
+ACCOUNT_HEADER = "X-Account-Id"
+API_KEY_HEADER = "X-Api-Key"
+
+# За сколько секунд до истечения access_token его нужно обновить заранее
+TOKEN_REFRESH_MARGIN = int(os.getenv("WHOOSH_TOKEN_REFRESH_MARGIN", "120"))
+
+# Несколько воркеров: токены и кэш ответов хранятся в общем для процессов хранилище
+# (local - в памяти процесса, только для одного воркера; sqlite - файл; redis - сервер Redis)
+WORKERS = int(os.getenv("WHOOSH_WORKERS", "1"))
+SHARED_BACKEND = os.getenv("WHOOSH_SHARED_BACKEND", "sqlite" if WORKERS > 1 else "local")
+SHARED_DB_FILE = os.getenv("WHOOSH_SHARED_DB", "whoosh_shared.db")
+REDIS_URL = os.getenv("WHOOSH_REDIS_URL", "redis://localhost:6379/0")
+# Блокировка между процессами снимается сама, если ее владелец завис или упал
+SHARED_LOCK_TTL = float(os.getenv("WHOOSH_SHARED_LOCK_TTL", "30"))
+SHARED_LOCK_POLL_INTERVAL = 0.05
+
 # Настройки по умолчанию
-BASE_URL = "https://api.whoosh.bike"
-COGNITO_URL = "https://cognito.whoosh.bike/"
-REGION_ID = "773ff572-49a8-4619-b291-290f1f3e4271" # Москва (ids_regions.json)
+# Адреса API Whoosh и Cognito можно переопределить (например, на mock-сервер из benchmarks/)
+BASE_URL = os.getenv("WHOOSH_BASE_URL", "https://api.whoosh.bike")
+COGNITO_URL = os.getenv("WHOOSH_COGNITO_URL", "https://cognito.whoosh.bike/")
+REGION_ID = "773ff572-49a8-4619-b291-290f1f3e4271" # Москва (ids_regions.json), регион по умолчанию
+REGIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ids_regions.json")
+REGION_HEADER = "X-Region-Id"
+LAT_HEADER = "X-Lat"
+LNG_HEADER = "X-Lng"
+EARTH_RADIUS_KM = 6371.0
 CLIENT_UUID = "c027fc25-d406-33c4-867a-dc2e3d071b60"
 CLIENT_ID = "7g1h82vpnjve0omfq1ssko18gl"
 
-# Координаты пользователя (неизменные, как указано в требованиях)
+# Координаты пользователя по умолчанию (если райдер не передал свои)
 DEFAULT_LAT = 55.766845 # Просто рандомная парковка
 DEFAULT_LNG = 37.585954 # Просто рандомная парковка
 
-# Координаты для завершения поездки (неизменные, как указано в требованиях)
+# Координаты для завершения поездки, если райдер не передал свои
 END_COORDINATES = {
     "lat": 55.767656,
     "lng": 37.587952
 } # Просто рандомная парковка
 
+# Локальный набор парковок по регионам и максимальное расстояние (м), на которое
+# точка завершения поездки притягивается к ближайшей парковке
+PARKINGS_FILE = os.getenv("WHOOSH_PARKINGS_FILE", "whoosh_parkings.json")
+PARKING_SNAP_MAX_DISTANCE = float(os.getenv("WHOOSH_PARKING_SNAP_MAX_DISTANCE", "150"))
+# Запрос парковок у Whoosh не документирован, поэтому по умолчанию файл парковок не обновляется.
+# Если задан путь (например /zones), сервер периодически запрашивает по нему парковки регионов
+# WHOOSH_PARKINGS_REGIONS (через запятую, по умолчанию REGION_ID) и перезаписывает PARKINGS_FILE
+PARKINGS_SOURCE_PATH = os.getenv("WHOOSH_PARKINGS_SOURCE_PATH")
+PARKINGS_REFRESH_INTERVAL = float(os.getenv("WHOOSH_PARKINGS_REFRESH_INTERVAL", "3600"))
+
+# Самокаты рядом: снимок всех самокатов региона, который периодически обновляется одним запросом.
+# Массовый запрос устройств у Whoosh не документирован, поэтому путь настраивается
+DEVICES_SNAPSHOT_PATH = os.getenv("WHOOSH_DEVICES_SNAPSHOT_PATH", "/devices")
+DEVICES_SNAPSHOT_INTERVAL = float(os.getenv("WHOOSH_DEVICES_SNAPSHOT_INTERVAL", "30"))
+# Снимок региона перестает обновляться, если его не запрашивали столько секунд
+DEVICES_SNAPSHOT_IDLE = float(os.getenv("WHOOSH_DEVICES_SNAPSHOT_IDLE", "600"))
+DEVICES_GRID_CELL_SIZE = float(os.getenv("WHOOSH_DEVICES_GRID_CELL_SIZE", "250"))
+DEVICES_CHANGES_MAX = 50000
+NEARBY_DEFAULT_RADIUS = 500
+NEARBY_MAX_RADIUS = 5000
+NEARBY_DEFAULT_LIMIT = 50
+NEARBY_MAX_LIMIT = 500
+
+# Маршрут поездки: маршруты длиннее ROUTE_STREAM_THRESHOLD точек отдаются потоком
+# частями по ROUTE_STREAM_CHUNK точек, не собирая весь ответ в памяти
+ROUTE_STREAM_THRESHOLD = int(os.getenv("WHOOSH_ROUTE_STREAM_THRESHOLD", "5000"))
+ROUTE_STREAM_CHUNK = 1000
+
+# История завершенных поездок (SQLite)
+TRIP_HISTORY_DB = os.getenv("WHOOSH_TRIP_HISTORY_DB", "whoosh_trips.db")
+TRIP_HISTORY_PAGE_SIZE = 50
+TRIP_HISTORY_MAX_PAGE_SIZE = 200
+
+# Настройки пула HTTP-соединений к API Whoosh (общий клиент на всё время жизни приложения)
+HTTP_MAX_CONNECTIONS = int(os.getenv("WHOOSH_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("WHOOSH_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("WHOOSH_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("WHOOSH_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("WHOOSH_HTTP_READ_TIMEOUT", "15"))
+HTTP_POOL_TIMEOUT = float(os.getenv("WHOOSH_HTTP_POOL_TIMEOUT", "5"))
+HTTP2_ENABLED = os.getenv("WHOOSH_HTTP2", "1") == "1"
+
+# Общий HTTP-клиент, создается при старте приложения и закрывается при остановке
+http_client: Optional[httpx.AsyncClient] = None
+
+
+# Функция для создания HTTP-клиента с пулом соединений
+def create_http_client() -> httpx.AsyncClient:
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("Пакет h2 не установлен, HTTP/2 отключен (pip install httpx[http2])")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_READ_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT
+        )
+    )
+
+
+# Возвращает общий HTTP-клиент (создает его, если startup еще не отработал)
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
+
+
+# Статистика использования пула соединений (для подбора его размера)
+def get_pool_stats() -> Dict[str, Any]:
+    stats = {
+        "max_connections": HTTP_MAX_CONNECTIONS,
+        "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        "http2": False,
+        "connections": 0,
+        "active": 0,
+        "idle": 0,
+        "http2_connections": 0,
+        "queued_requests": 0
+    }
+    if http_client is None or http_client.is_closed:
+        return stats
+
+    # httpx не дает публичного API для пула, поэтому смотрим в пул httpcore.
+    # Это внутренние атрибуты: если в новой версии httpcore их нет, отдаем нули, а не ошибку
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    if pool is None:
+        return stats
+
+    try:
+        connections = list(pool.connections)
+        idle = sum(1 for connection in connections if connection.is_idle())
+        stats.update({
+            "http2": getattr(pool, "_http2", False),
+            "connections": len(connections),
+            "active": len(connections) - idle,
+            "idle": idle,
+            # info() начинается с адреса: "'https://api.whoosh.bike:443', HTTP/2, ACTIVE, Request Count: 3"
+            "http2_connections": sum(1 for connection in connections if ", HTTP/2," in connection.info()),
+            "queued_requests": sum(1 for pool_request in getattr(pool, "_requests", []) if pool_request.is_queued())
+        })
+    except AttributeError as e:
+        logger.warning("Не удалось получить состояние пула соединений: %s", e)
+    return stats
+
+
+# Метрики в формате Prometheus (отдаются эндпоинтом /metrics)
+REQUEST_COUNT = Counter(
+    "whoosh_api_requests_total", "Запросы к нашему API", ["route", "method", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "whoosh_api_request_duration_seconds", "Время обработки запросов к нашему API", ["route", "method"]
+)
+UPSTREAM_COUNT = Counter(
+    "whoosh_upstream_requests_total", "Запросы к API Whoosh", ["method", "path", "status"]
+)
+UPSTREAM_LATENCY = Histogram(
+    "whoosh_upstream_request_duration_seconds", "Время ответа API Whoosh", ["method", "path"]
+)
+TOKEN_REFRESH_COUNT = Counter(
+    "whoosh_token_refresh_total", "Обновления токенов через Cognito", ["account", "result"]
+)
+TOKEN_REFRESH_LATENCY = Histogram(
+    "whoosh_token_refresh_duration_seconds", "Время обновления токенов через Cognito", ["account"]
+)
+CACHE_LOOKUPS = Counter(
+    "whoosh_cache_lookups_total", "Обращения к кэшам (hit, stale, miss)", ["cache", "result"]
+)
+COALESCED_REQUESTS = Counter(
+    "whoosh_coalesced_requests_total", "GET-запросы, объединенные с уже выполняющимся запросом"
+)
+UPSTREAM_QUEUE_WAIT = Histogram(
+    "whoosh_upstream_queue_wait_seconds", "Ожидание в очереди перед запросом к API Whoosh", ["path"]
+)
+UPSTREAM_THROTTLED = Counter(
+    "whoosh_upstream_throttled_total", "Запросы, отклоненные из-за переполненной очереди к API Whoosh", ["path", "reason"]
+)
+UPSTREAM_RETRIES = Counter(
+    "whoosh_upstream_retries_total", "Повторы запросов к API Whoosh", ["path", "reason"]
+)
+UPSTREAM_RETRIES_DENIED = Counter(
+    "whoosh_upstream_retries_denied_total", "Повторы, не выполненные из-за исчерпанного бюджета", ["path"]
+)
+UPSTREAM_SHORT_CIRCUITED = Counter(
+    "whoosh_upstream_short_circuited_total", "Запросы, сразу отклоненные разомкнутой цепью", ["path"]
+)
+UPSTREAM_FALLBACKS = Counter(
+    "whoosh_upstream_fallback_responses_total", "Ответы из запаса последних успешных ответов", ["path"]
+)
+SCHEDULED_EVENTS = Counter(
+    "whoosh_scheduled_events_total", "События о сроках бронирований и пакетов минут", ["event"]
+)
+WEBHOOK_DELIVERIES = Counter(
+    "whoosh_webhook_deliveries_total", "Отправки событий на WHOOSH_WEBHOOK_URL", ["result"]
+)
+
+
+class PoolCollector:
+    """Отдает состояние пула HTTP-соединений в момент сбора метрик"""
+
+    def collect(self):
+        stats = get_pool_stats()
+        connections = GaugeMetricFamily(
+            "whoosh_http_pool_connections", "Соединения в пуле к API Whoosh", labels=["state"]
+        )
+        connections.add_metric(["active"], stats["active"])
+        connections.add_metric(["idle"], stats["idle"])
+        yield connections
+        yield GaugeMetricFamily(
+            "whoosh_http_pool_max_connections", "Максимум соединений в пуле", value=stats["max_connections"]
+        )
+        yield GaugeMetricFamily(
+            "whoosh_http_pool_queued_requests", "Запросы, ожидающие свободного соединения", value=stats["queued_requests"]
+        )
+
+
+REGISTRY.register(PoolCollector())
+
+
+# Шаблон пути запроса к API Whoosh для метрик: сегменты с цифрами (id, коды самокатов) заменяются на {id}
+def get_upstream_path_template(url: str) -> str:
+    segments = urlsplit(url).path.split("/")
+    return "/".join("{id}" if any(char.isdigit() for char in segment) else segment for segment in segments) or "/"
+
 
 # Функция для загрузки токенов из файла
-def load_tokens():
-    if os.path.exists(TOKENS_FILE):
+def load_tokens(tokens_file: str = TOKENS_FILE):
+    if os.path.exists(tokens_file):
         try:
-            with open(TOKENS_FILE, 'r') as f:
+            with open(tokens_file, 'r') as f:
                 return json.load(f)
         except Exception as e:
-            logger.error(f"Ошибка при загрузке токенов: {str(e)}")
+            logger.error("Ошибка при загрузке токенов: %s", e)
 
     # Возвращаем пустую структуру, если файл не существует или произошла ошибка
     return {
@@ -70,19 +503,243 @@ def load_tokens():
     }
 
 
-# Функция для сохранения токенов в файл
-def save_tokens(tokens):
+# Функция для сохранения токенов в файл (атомарно: временный файл + переименование)
+def save_tokens(tokens, tokens_file: str = TOKENS_FILE):
+    tmp_file = f"{tokens_file}.{os.getpid()}.tmp"
     try:
-        with open(TOKENS_FILE, 'w') as f:
+        with open(tmp_file, 'w') as f:
             json.dump(tokens, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, tokens_file)
     except Exception as e:
-        logger.error(f"Ошибка при сохранении токенов: {str(e)}")
+        logger.error("Ошибка при сохранении токенов: %s", e)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
 
-# Функция для обновления токенов
-async def refresh_tokens():
-    tokens = load_tokens()
+# Время истечения JWT-токена (claim exp) или None, если его не удалось прочитать
+def get_token_expiry(token: Optional[str]) -> Optional[float]:
+    if not token:
+        return None
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+class SharedStore:
+    """
+    Хранилище состояния, общего для воркеров: записи (пространство имен, поле) -> байты
+    с необязательным временем жизни и именованные блокировки между процессами.
+    Пространство имен удаляется целиком (так сбрасывается кэш пути для аккаунта).
+    """
+
+    name = "local"
+    # False - состояние видно только этому процессу
+    shared = False
+
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, tuple]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, namespace: str, field: str) -> Optional[bytes]:
+        value, expires_at = self._entries.get(namespace, {}).get(field, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return value
+
+    async def set(self, namespace: str, field: str, value: bytes, ttl: Optional[float] = None):
+        self._entries.setdefault(namespace, {})[field] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, namespaces: List[str]):
+        for namespace in namespaces:
+            self._entries.pop(namespace, None)
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = SHARED_LOCK_TTL):
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            yield
+
+    async def close(self):
+        pass
+
+
+class SQLiteSharedStore(SharedStore):
+    """
+    Общее хранилище в файле SQLite (режим WAL) для воркеров на одной машине.
+    Блокировка - строка в таблице locks со сроком действия: ее захватывает тот,
+    кому удалось вставить строку или занять просроченную.
+    """
+
+    name = "sqlite"
+    shared = True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            namespace TEXT NOT NULL,
+            field TEXT NOT NULL,
+            value BLOB NOT NULL,
+            expires_at REAL,
+            PRIMARY KEY (namespace, field)
+        );
+        CREATE TABLE IF NOT EXISTS locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+    # Просроченные записи удаляются раз в столько записей
+    CLEANUP_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        connection = self._connection()
+        connection.executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _get(self, namespace: str, field: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM entries WHERE namespace = ? AND field = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, field, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, namespace: str, field: str, value: bytes, ttl: Optional[float]):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (namespace, field, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, field, value, time.time() + ttl if ttl else None)
+        )
+        self._writes += 1
+        if self._writes % self.CLEANUP_EVERY == 0:
+            connection.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+
+    def _delete(self, namespaces: List[str]):
+        self._connection().executemany("DELETE FROM entries WHERE namespace = ?", [(namespace,) for namespace in namespaces])
+
+    def _try_lock(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE locks.expires_at <= ?",
+            (name, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def _unlock(self, name: str, owner: str):
+        self._connection().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
 
+    async def get(self, namespace: str, field: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, namespace, field)
+
+    async def set(self, namespace: str, field: str, value: bytes, ttl: Optional[float] = None):
+        await asyncio.to_thread(self._set, namespace, field, value, ttl)
+
+    async def delete(self, namespaces: List[str]):
+        await asyncio.to_thread(self._delete, namespaces)
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = SHARED_LOCK_TTL):
+        owner = uuid.uuid4().hex
+        while not await asyncio.to_thread(self._try_lock, name, owner, ttl):
+            await asyncio.sleep(SHARED_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._unlock, name, owner)
+
+
+class RedisSharedStore(SharedStore):
+    """
+    Общее хранилище в Redis (или совместимом сервере) для воркеров на разных машинах.
+    Каждое поле - отдельный ключ со своим временем жизни, а множество ключей пространства
+    имен позволяет удалить его целиком. Блокировка - SET NX с временем жизни.
+    """
+
+    name = "redis"
+    shared = True
+    PREFIX = "whoosh:"
+    # Снимаем блокировку, только если она все еще наша
+    UNLOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("Для WHOOSH_SHARED_BACKEND=redis нужен пакет redis: pip install redis")
+        self.client = redis.from_url(url)
+
+    def _key(self, namespace: str, field: str) -> str:
+        return f"{self.PREFIX}{namespace}:{field}"
+
+    async def get(self, namespace: str, field: str) -> Optional[bytes]:
+        return await self.client.get(self._key(namespace, field))
+
+    async def set(self, namespace: str, field: str, value: bytes, ttl: Optional[float] = None):
+        key = self._key(namespace, field)
+        index = f"{self.PREFIX}{namespace}"
+        async with self.client.pipeline(transaction=False) as pipe:
+            if ttl:
+                pipe.set(key, value, px=int(ttl * 1000))
+                pipe.sadd(index, key)
+                pipe.pexpire(index, int(ttl * 1000))
+            else:
+                pipe.set(key, value)
+                pipe.sadd(index, key)
+                pipe.persist(index)
+            await pipe.execute()
+
+    async def delete(self, namespaces: List[str]):
+        for namespace in namespaces:
+            index = f"{self.PREFIX}{namespace}"
+            keys = await self.client.smembers(index)
+            await self.client.delete(index, *keys)
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = SHARED_LOCK_TTL):
+        key = f"{self.PREFIX}lock:{name}"
+        owner = uuid.uuid4().hex
+        while not await self.client.set(key, owner, nx=True, px=int(ttl * 1000)):
+            await asyncio.sleep(SHARED_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            await self.client.eval(self.UNLOCK_SCRIPT, 1, key, owner)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_shared_store() -> SharedStore:
+    if SHARED_BACKEND == "sqlite":
+        return SQLiteSharedStore(SHARED_DB_FILE)
+    if SHARED_BACKEND == "redis":
+        return RedisSharedStore(REDIS_URL)
+    if SHARED_BACKEND != "local":
+        raise RuntimeError(f"Неизвестный WHOOSH_SHARED_BACKEND: {SHARED_BACKEND} (local, sqlite или redis)")
+    if WORKERS > 1:
+        logger.warning("WHOOSH_SHARED_BACKEND=local при нескольких воркерах: токены и кэш у каждого воркера свои")
+    return SharedStore()
+
+
+shared_store = create_shared_store()
+
+
+# Запрос новых токенов у Cognito по refresh_token
+async def request_new_tokens(tokens: Dict) -> Dict:
     if not tokens.get("refresh_token"):
         raise HTTPException(status_code=401, detail="Отсутствует refresh_token. Требуется полная авторизация.")
 
@@ -92,7 +749,7 @@ async def refresh_tokens():
         "aws-sdk-invocation-id": str(uuid.uuid4()),
         "aws-sdk-retry": "0/0",
         "Content-Type": "application/x-amz-json-1.1",
-        "Host": "cognito.whoosh.bike",
+        "Host": urlsplit(COGNITO_URL).netloc,
         "User-Agent": "aws-sdk-android/2.22.5 Linux/4.19.278-g7b0944645172-ab10812814 Dalvik/2.1.0/0 ru_RU",
         "X-Amz-Target": "AWSCognitoIdentityProviderService.InitiateAuth"
     }
@@ -106,39 +763,1026 @@ async def refresh_tokens():
         "UserContextData": {}
     }
 
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(COGNITO_URL, headers=headers, json=data)
-
-            if response.status_code != 200:
-                logger.error(f"Ошибка при обновлении токенов: {response.text}")
-                raise HTTPException(status_code=response.status_code,
-                                    detail=f"Ошибка при обновлении токенов: {response.text}")
+    breaker = get_circuit_breaker("cognito")
+    if not breaker.allow():
+        raise CircuitOpenError("cognito", breaker.retry_after())
 
-            refresh_data = response.json()
-            auth_result = refresh_data.get("AuthenticationResult", {})
+    success = None
+    try:
+        client = get_http_client()
+        response = await client.post(COGNITO_URL, headers=headers, json=data)
+        success = response.status_code < 500
 
-            # Обновляем токены
-            tokens["access_token"] = auth_result.get("AccessToken")
-            tokens["id_token"] = auth_result.get("IdToken")
-            # refresh_token не меняется при обновлении
+        if response.status_code != 200:
+            logger.error("Ошибка при обновлении токенов: %s", response.text)
+            raise HTTPException(status_code=response.status_code,
+                                detail=f"Ошибка при обновлении токенов: {response.text}")
 
-            # Сохраняем обновленные токены
-            save_tokens(tokens)
+        refresh_data = orjson.loads(response.content)
+        auth_result = refresh_data.get("AuthenticationResult", {})
 
-            return tokens
+        # refresh_token не меняется при обновлении
+        return {
+            **tokens,
+            "access_token": auth_result.get("AccessToken"),
+            "id_token": auth_result.get("IdToken")
+        }
     except httpx.HTTPError as e:
-        logger.error(f"Ошибка HTTP при обновлении токенов: {str(e)}")
+        success = False
+        logger.error("Ошибка HTTP при обновлении токенов: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка при обновлении токенов: {str(e)}")
+    finally:
+        breaker.record(success)
+
+
+class TokenManager:
+    """
+    Хранит токены в памяти и обновляет их не чаще, чем нужно:
+    - одновременно выполняется только один запрос к Cognito, остальные ждут его результата
+    - токены обновляются заранее, за TOKEN_REFRESH_MARGIN секунд до истечения (по claim exp)
+    - файл с токенами пишется в отдельном потоке, не блокируя event loop
+    - при нескольких воркерах токены лежат в общем хранилище, а обновление идет под
+      блокировкой между процессами: воркер, дождавшийся блокировки, берет уже обновленные токены
+    """
+
+    def __init__(self, tokens_file: str = TOKENS_FILE, name: str = DEFAULT_ACCOUNT_ID):
+        self.tokens_file = tokens_file
+        self.name = name
+        self.tokens: Optional[Dict] = None
+        self._refresh_lock = asyncio.Lock()
+        self._save_lock = asyncio.Lock()
+        self._background_tasks = set()
+
+    async def load(self) -> Dict:
+        if self.tokens is None:
+            tokens = await self._load_shared() or await asyncio.to_thread(load_tokens, self.tokens_file)
+            # Пока файл читался, токены могли уже загрузить или обновить
+            if self.tokens is None:
+                self.tokens = tokens
+        return self.tokens
+
+    def expires_at(self) -> Optional[float]:
+        return get_token_expiry((self.tokens or {}).get("access_token"))
+
+    def is_fresh(self, margin: float = 0) -> bool:
+        tokens = self.tokens or {}
+        if not tokens.get("access_token") or not tokens.get("id_token"):
+            return False
+        expires_at = self.expires_at()
+        # Если exp прочитать не удалось, считаем токен рабочим до первого 401
+        return expires_at is None or expires_at - margin > time.time()
+
+    def is_refreshing(self) -> bool:
+        return self._refresh_lock.locked()
+
+    async def get_tokens(self) -> Dict:
+        tokens = await self.load()
+
+        if not self.is_fresh():
+            return await self.refresh(stale_access_token=tokens.get("access_token"))
+
+        # Токен скоро истечет: обновляем в фоне, текущий запрос идет со старым
+        if not self.is_fresh(TOKEN_REFRESH_MARGIN) and not self._refresh_lock.locked():
+            self._spawn(self.refresh(stale_access_token=tokens.get("access_token")))
+
+        return tokens
+
+    async def refresh(self, stale_access_token: Optional[str] = None, force: bool = False) -> Dict:
+        async with self._refresh_lock:
+            tokens = await self.load()
+
+            # Пока ждали блокировку, токены уже обновил другой запрос
+            if not force and tokens.get("access_token") != stale_access_token and self.is_fresh():
+                return tokens
+
+            async with shared_store.lock(f"tokens:{self.name}"):
+                # Пока ждали блокировку, токены (и refresh_token) мог обновить другой воркер
+                shared_tokens = await self._load_shared()
+                if shared_tokens is not None and shared_tokens.get("access_token") != tokens.get("access_token"):
+                    self.tokens = tokens = shared_tokens
+                    if not force and tokens.get("access_token") != stale_access_token and self.is_fresh():
+                        return tokens
+
+                started = time.perf_counter()
+                try:
+                    self.tokens = await request_new_tokens(tokens)
+                except Exception:
+                    TOKEN_REFRESH_COUNT.labels(self.name, "error").inc()
+                    raise
+                finally:
+                    TOKEN_REFRESH_LATENCY.labels(self.name).observe(time.perf_counter() - started)
+                TOKEN_REFRESH_COUNT.labels(self.name, "success").inc()
+                await shared_store.set("tokens", self.name, orjson.dumps(self.tokens))
+
+            self._spawn(self.save(self.tokens))
+            return self.tokens
+
+    async def _load_shared(self) -> Optional[Dict]:
+        raw = await shared_store.get("tokens", self.name)
+        return orjson.loads(raw) if raw else None
+
+    async def save(self, tokens: Dict):
+        async with self._save_lock:
+            # Пока ждали предыдущую запись, токены успели обновить еще раз - их запишет следующий save
+            if tokens is not self.tokens:
+                return
+            await asyncio.to_thread(save_tokens, tokens, self.tokens_file)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка фонового обновления токенов: %s", task.exception())
+
+
+class Account:
+    """Аккаунт Whoosh со своими токенами и счетчиками нагрузки"""
+
+    def __init__(self, account_id: str, tokens_file: str, client_uuid: str, api_key: Optional[str] = None):
+        self.id = account_id
+        self.client_uuid = client_uuid
+        self.api_key = api_key
+        self.token_manager = TokenManager(tokens_file, account_id)
+        # Количество запросов к API Whoosh, выполняющихся прямо сейчас
+        self.outstanding = 0
+        self.last_used = 0.0
+
+
+class AccountPool:
+    """
+    Пул аккаунтов Whoosh. Запрос привязывается к аккаунту по заголовку X-Account-Id
+    или по API-ключу (X-Api-Key), а запросы, не связанные с конкретным пользователем,
+    распределяются между аккаунтами.
+    """
+
+    def __init__(self, accounts: List[Account], selection: str = "least_outstanding"):
+        if not accounts:
+            raise ValueError("Пул аккаунтов не может быть пустым")
+        self.accounts: Dict[str, Account] = {account.id: account for account in accounts}
+        self.default = accounts[0]
+        self.selection = selection
+        self._by_api_key = {account.api_key: account for account in accounts if account.api_key}
+
+    @classmethod
+    def from_config(cls, accounts_file: str = ACCOUNTS_FILE) -> "AccountPool":
+        selection = os.getenv("WHOOSH_ACCOUNT_SELECTION", "least_outstanding")
+
+        # Без файла аккаунтов работаем как раньше: один аккаунт из whoosh_tokens.json
+        if not os.path.exists(accounts_file):
+            return cls([Account(DEFAULT_ACCOUNT_ID, TOKENS_FILE, CLIENT_UUID)], selection)
+
+        with open(accounts_file, 'r') as f:
+            config = json.load(f)
+
+        accounts = [
+            Account(
+                account_id=item["id"],
+                tokens_file=item.get("tokens_file", f"whoosh_tokens_{item['id']}.json"),
+                client_uuid=item.get("client_uuid", CLIENT_UUID),
+                api_key=item.get("api_key")
+            )
+            for item in config.get("accounts", [])
+        ]
+        return cls(accounts, config.get("selection", selection))
+
+    def get(self, account_id: str) -> Optional[Account]:
+        return self.accounts.get(account_id)
+
+    def get_by_api_key(self, api_key: str) -> Optional[Account]:
+        return self._by_api_key.get(api_key)
+
+    def pick_shared(self) -> Account:
+        # Выбираем наименее загруженный аккаунт, при равенстве - дольше всех не использовавшийся
+        if self.selection == "lru":
+            return min(self.accounts.values(), key=lambda account: account.last_used)
+        return min(self.accounts.values(), key=lambda account: (account.outstanding, account.last_used))
+
+
+account_pool = AccountPool.from_config()
+
+# Аккаунт, к которому привязан текущий запрос к нашему API (выставляется middleware)
+current_account_id: ContextVar[Optional[str]] = ContextVar("current_account_id", default=None)
+
+
+# Возвращает аккаунт для текущего запроса
+def get_request_account(shared: bool = False) -> Account:
+    account_id = current_account_id.get()
+    if account_id is not None:
+        account = account_pool.get(account_id)
+        if account is None:
+            raise HTTPException(status_code=404, detail=f"Аккаунт {account_id} не найден")
+        return account
+
+    if shared:
+        return account_pool.pick_shared()
+
+    return account_pool.default
+
+
+# Функция для принудительного обновления токенов аккаунта текущего запроса
+async def refresh_tokens():
+    return await get_request_account().token_manager.refresh(force=True)
+
+
+# Привязываем запрос к аккаунту по заголовкам X-Account-Id / X-Api-Key
+@app.middleware("http")
+async def bind_account(request: Request, call_next):
+    account_id = request.headers.get(ACCOUNT_HEADER)
+    api_key = request.headers.get(API_KEY_HEADER)
+
+    if api_key:
+        account = account_pool.get_by_api_key(api_key)
+        if account is None or (account_id and account_id != account.id):
+            return JSONResponse(status_code=401, content={"detail": "Неверный API-ключ"})
+        account_id = account.id
+    elif account_id:
+        account = account_pool.get(account_id)
+        if account is None:
+            return JSONResponse(status_code=404, content={"detail": f"Аккаунт {account_id} не найден"})
+        # Аккаунты с API-ключом доступны только по ключу
+        if account.api_key:
+            return JSONResponse(status_code=401, content={"detail": "Для этого аккаунта требуется API-ключ"})
+
+    token = current_account_id.set(account_id)
+    try:
+        return await call_next(request)
+    finally:
+        current_account_id.reset(token)
 
 
 # Модели данных
+class Position(BaseModel):
+    lat: float
+    lng: float
+
+
 class ScooterCode(BaseModel):
     code: str  # Код самоката (например KE446A)
+    position: Optional[Position] = None  # Координаты райдера (если не указаны - X-Lat/X-Lng или по умолчанию)
 
 
 class EndTripRequest(BaseModel):
     trip_id: str
+    position: Optional[Position] = None  # Координаты райдера для завершения поездки
+
+
+class BatchStartTripsRequest(BaseModel):
+    codes: List[str]  # Коды самокатов
+    position: Optional[Position] = None  # Координаты группы (общие для всех самокатов)
+    concurrency: Optional[int] = None  # Сколько самокатов запускать одновременно
+    timeout: Optional[float] = None  # Сколько секунд ждать каждый самокат
+
+
+class BatchEndTripsRequest(BaseModel):
+    trip_ids: List[str]
+    position: Optional[Position] = None  # Координаты группы для завершения поездок
+    concurrency: Optional[int] = None
+    timeout: Optional[float] = None
+
+
+# Модели ответов. Значения, которые передаются из ответа API Whoosh как есть, объявлены как Any:
+# их формат задает Whoosh. Эндпоинты отдают ответы с response_model_exclude_unset=True,
+# поэтому в JSON попадают только поля, которые эндпоинт действительно заполнил.
+class MinutePackResponse(BaseModel):
+    has_minute_pack: bool
+    pack_name: Any = None
+    minutes_left: Any = None
+    seconds_left: Any = None
+    formatted_time_left: Optional[str] = None
+    valid_to: Any = None
+    duration: Any = None
+
+
+class PrepareTripResponse(BaseModel):
+    success: bool
+    device_code: str
+    device_id: Any = None
+    using_minute_pack: bool
+    expires_in: int
+    message: str
+
+
+class StartTripResponse(BaseModel):
+    success: bool
+    trip_id: Any = None
+    device_code: str
+    device_id: Any = None
+    using_minute_pack: bool
+    message: str
+    status: Any = None
+    battery_level: Any = None
+
+
+class TripInfoResponse(BaseModel):
+    active_trip: bool
+    message: Optional[str] = None
+    trip_id: Optional[str] = None
+    duration: Any = None
+    duration_formatted: Optional[str] = None
+    device_code: Any = None
+    battery_level: Any = None
+    current_cost: Any = None
+    distance: Any = None
+    speed_mode: Any = None
+    coordinates: Any = None
+    route: Any = None
+
+
+class TripRouteResponse(BaseModel):
+    trip_id: str
+    encoding: str
+    precision: int
+    points_count: int
+    original_points_count: int
+    polyline: Optional[str] = None
+    lat: Optional[List[int]] = None
+    lng: Optional[List[int]] = None
+
+
+class TripHistoryItem(BaseModel):
+    trip_id: str
+    finished_at: str
+    device_code: Optional[str] = None
+    device_id: Optional[str] = None
+    region_id: Optional[str] = None
+    duration: Any = None
+    distance: Any = None
+    final_cost: Any = None
+    end_coordinates: Optional[Position] = None
+    parking_id: Optional[str] = None
+
+
+class TripHistoryPeriod(BaseModel):
+    period: str
+    trips: int
+    total_cost: float
+    total_minutes: float
+    total_distance: float
+
+
+class TripHistoryAggregates(BaseModel):
+    period: str
+    trips: int
+    total_cost: float
+    total_minutes: float
+    total_distance: float
+    periods: List[TripHistoryPeriod]
+
+
+class TripHistoryResponse(BaseModel):
+    trips: List[TripHistoryItem]
+    next_cursor: Optional[str] = None
+    aggregates: Optional[TripHistoryAggregates] = None
+
+
+class MinutePackSummary(BaseModel):
+    active: bool
+    minutes_left: Any = None
+
+
+class EndTripResponse(BaseModel):
+    success: bool
+    trip_id: str
+    status: Any = None
+    message: str
+    duration: Any = None
+    duration_formatted: Optional[str] = None
+    distance: Any = None
+    final_cost: Any = None
+    minute_pack: Optional[MinutePackSummary] = None
+    end_coordinates: Optional[Position] = None
+    parking: Optional[Dict[str, Any]] = None
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    item: str
+    success: bool
+    status_code: Optional[int] = None
+    status: Optional[str] = None  # "unknown" - результат операции неизвестен
+    result: Optional[Dict[str, Any]] = None
+    detail: Any = None
+    elapsed: float
+
+
+class BatchResponse(BaseModel):
+    success: bool
+    total: int
+    succeeded: int
+    failed: int
+    results: List[BatchItemResult]
+
+
+class RefreshTokensResponse(BaseModel):
+    success: bool
+    message: str
+    expires_in: str
+
+
+class Region(BaseModel):
+    id: str
+    name: str
+    lat: float
+    lng: float
+
+
+class RegionsResponse(BaseModel):
+    regions: List[Region]
+    count: int
+
+
+class NearestRegionResponse(Region):
+    distance_km: float
+
+
+# Точка на единичной сфере: по хордовому расстоянию между такими точками
+# ближайший сосед совпадает с ближайшим по расстоянию вдоль поверхности Земли
+def to_unit_vector(lat: float, lng: float) -> tuple:
+    lat_rad = math.radians(lat)
+    lng_rad = math.radians(lng)
+    return (
+        math.cos(lat_rad) * math.cos(lng_rad),
+        math.cos(lat_rad) * math.sin(lng_rad),
+        math.sin(lat_rad)
+    )
+
+
+class RegionIndex:
+    """
+    Регионы Whoosh из ids_regions.json в k-d дереве по точкам на единичной сфере.
+    Поиск ближайшего региона занимает O(log n) и не требует запросов к API.
+    """
+
+    def __init__(self, regions: List[Dict]):
+        self.regions = regions
+        self.by_id = {region["id"]: region for region in regions}
+        points = [(to_unit_vector(region["lat"], region["lng"]), region) for region in regions]
+        self._root = self._build(points, 0)
+
+    @classmethod
+    def from_file(cls, regions_file: str = REGIONS_FILE) -> "RegionIndex":
+        with open(regions_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        regions = [
+            {
+                "id": item["id"],
+                "name": item["name"],
+                "lat": item["coordinate"]["lat"],
+                "lng": item["coordinate"]["lng"]
+            }
+            for item in data.get("regions", [])
+        ]
+        return cls(regions)
+
+    def _build(self, points: List[tuple], depth: int) -> Optional[tuple]:
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        vector, region = points[median]
+        return (
+            vector,
+            region,
+            axis,
+            self._build(points[:median], depth + 1),
+            self._build(points[median + 1:], depth + 1)
+        )
+
+    def nearest(self, lat: float, lng: float) -> Optional[tuple]:
+        """Ближайший регион и расстояние до его центра в километрах"""
+        if self._root is None:
+            return None
+
+        target = to_unit_vector(lat, lng)
+        best = [None, float("inf")]  # регион, квадрат хордового расстояния
+
+        def search(node):
+            if node is None:
+                return
+            vector, region, axis, left, right = node
+            distance = sum((a - b) ** 2 for a, b in zip(vector, target))
+            if distance < best[1]:
+                best[0], best[1] = region, distance
+
+            diff = target[axis] - vector[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            search(near)
+            # В другую ветку идем, только если в ней может оказаться точка ближе
+            if diff * diff < best[1]:
+                search(far)
+
+        search(self._root)
+        chord = math.sqrt(best[1])
+        distance_km = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+        return best[0], distance_km
+
+
+region_index = RegionIndex.from_file()
+
+# Регион текущего запроса (выставляется middleware по X-Region-Id или координатам X-Lat/X-Lng)
+current_region_id: ContextVar[Optional[str]] = ContextVar("current_region_id", default=None)
+
+
+# Координаты райдера из заголовков X-Lat/X-Lng (выставляются middleware)
+current_position: ContextVar[Optional[tuple]] = ContextVar("current_position", default=None)
+
+
+# Возвращает id региона для текущего запроса (по умолчанию REGION_ID)
+def get_request_region_id() -> str:
+    return current_region_id.get() or REGION_ID
+
+
+# Определяем регион запроса: явно по X-Region-Id или по координатам райдера X-Lat/X-Lng
+@app.middleware("http")
+async def bind_region(request: Request, call_next):
+    region_id = request.headers.get(REGION_HEADER)
+    position = None
+
+    if region_id and region_id not in region_index.by_id:
+        return JSONResponse(status_code=400, content={"detail": f"Неизвестный регион {region_id}"})
+
+    if request.headers.get(LAT_HEADER) and request.headers.get(LNG_HEADER):
+        try:
+            position = (float(request.headers[LAT_HEADER]), float(request.headers[LNG_HEADER]))
+        except ValueError:
+            return JSONResponse(status_code=400, content={"detail": "Некорректные координаты в X-Lat/X-Lng"})
+        if not region_id:
+            nearest = region_index.nearest(*position)
+            region_id = nearest[0]["id"] if nearest else None
+
+    region_token = current_region_id.set(region_id)
+    position_token = current_position.set(position)
+    try:
+        return await call_next(request)
+    finally:
+        current_region_id.reset(region_token)
+        current_position.reset(position_token)
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate запросов в секунду с запасом на всплеск до burst запросов.
+    Токены резервируются заранее (баланс может уйти в минус), поэтому ожидающие
+    запросы обслуживаются по очереди, а не наперегонки после каждого сна.
+    rate <= 0 - частота не ограничена (действуют только паузы по Retry-After).
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько ждать до отправки запроса или None, если дольше max_wait
+    def reserve(self, max_wait: float) -> Optional[float]:
+        if self.rate <= 0:
+            wait = max(0.0, self.paused_until - time.monotonic())
+            return wait if wait <= max_wait else None
+        self._refill()
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    # API Whoosh попросил подождать (429 с Retry-After) - не отправляем запросы это время
+    def pause(self, seconds: float):
+        if self.rate <= 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            return
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    Адаптивный лимит одновременных запросов к API Whoosh (additive increase / multiplicative decrease).
+    Успешный быстрый ответ увеличивает лимит на 1/limit (примерно +1 за каждые limit ответов),
+    перегрузка (429, 5xx, ошибка сети или ответ медленнее latency_target) уменьшает его
+    в backoff раз, но не чаще одного раза за latency_target секунд, чтобы одна волна
+    ошибок не обрушила лимит до минимума. Лишние запросы ждут в очереди FIFO.
+    """
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, backoff: float, latency_target: float):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self._waiters: "deque[asyncio.Future]" = deque()
+
+    async def acquire(self, timeout: float) -> bool:
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # Место уже передано этому запросу - возвращаем его следующему
+                self.in_flight -= 1
+                self._wake()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self, latency: float, overloaded: bool):
+        self.in_flight -= 1
+        if overloaded or latency > self.latency_target:
+            now = time.monotonic()
+            if now - self.decreased_at >= self.latency_target:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.decreased_at = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft().set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit
+        }
+
+
+upstream_limiter = AdaptiveLimiter(
+    UPSTREAM_CONCURRENCY_INITIAL, UPSTREAM_CONCURRENCY_MIN, UPSTREAM_CONCURRENCY_MAX,
+    UPSTREAM_CONCURRENCY_BACKOFF, UPSTREAM_LATENCY_TARGET
+)
+
+
+class UpstreamCollector:
+    """Отдает состояние адаптивного лимита и размыкателей цепи API Whoosh в момент сбора метрик"""
+
+    def collect(self):
+        stats = upstream_limiter.stats()
+        yield GaugeMetricFamily(
+            "whoosh_upstream_concurrency_limit", "Текущий адаптивный лимит запросов к API Whoosh", value=stats["limit"]
+        )
+        yield GaugeMetricFamily(
+            "whoosh_upstream_in_flight", "Выполняющиеся запросы к API Whoosh", value=stats["in_flight"]
+        )
+        yield GaugeMetricFamily(
+            "whoosh_upstream_queued", "Запросы, ожидающие места в адаптивном лимите", value=stats["queued"]
+        )
+        states = GaugeMetricFamily(
+            "whoosh_upstream_circuit_state", "Состояние цепи: 0 - замкнута, 1 - пробный запрос, 2 - разомкнута", labels=["path"]
+        )
+        for name, breaker in circuit_breakers.items():
+            states.add_metric([name], CircuitBreaker.STATES.index(breaker.state))
+        yield states
+
+
+class CircuitOpenError(HTTPException):
+    """Цепь к пути API Whoosh разомкнута - запрос отклонен без обращения к API"""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"API Whoosh временно недоступен ({name}), повторите позже",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для одного пути API Whoosh.
+    closed - запросы идут как обычно и считаются ошибки подряд (сетевые ошибки и 5xx);
+    open - после failure_threshold ошибок запросы open_seconds секунд сразу отклоняются;
+    half_open - пропускается один пробный запрос: успех замыкает цепь, ошибка снова размыкает.
+    """
+
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, open_seconds: float = BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return True
+
+    # success=None - результат не говорит о состоянии API (429, отмена, ошибка до отправки)
+    def record(self, success: Optional[bool]):
+        self.probe_in_flight = False
+        if success is None:
+            return
+        if success:
+            if self.state != "closed":
+                logger.info("Цепь %s замкнута: API Whoosh снова отвечает", self.name)
+            self.state = "closed"
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            logger.warning("Цепь %s разомкнута на %.0f с после %s ошибок подряд", self.name, self.open_seconds, self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self.opened_at)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures}
+
+
+# Шаблон пути (или "cognito") -> размыкатель цепи
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(name)
+    if breaker is None:
+        breaker = circuit_breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+REGISTRY.register(UpstreamCollector())
+# (аккаунт, шаблон пути) -> ограничение частоты; шаблонов немного, поэтому словарь не чистится
+rate_buckets: Dict[tuple, TokenBucket] = {}
+
+
+def get_rate_bucket(account: Account, upstream_path: str) -> TokenBucket:
+    key = (account.id, upstream_path)
+    bucket = rate_buckets.get(key)
+    if bucket is None:
+        bucket = rate_buckets[key] = TokenBucket(UPSTREAM_RATE_LIMIT, UPSTREAM_RATE_BURST)
+    return bucket
+
+
+# Ждет своей очереди на запрос к API Whoosh: сначала ограничение частоты, затем адаптивный лимит.
+# Если суммарное ожидание превышает UPSTREAM_QUEUE_TIMEOUT, запрос отклоняется с 429.
+async def throttle_upstream(account: Account, upstream_path: str):
+    started = time.perf_counter()
+
+    wait = get_rate_bucket(account, upstream_path).reserve(UPSTREAM_QUEUE_TIMEOUT)
+    if wait is None:
+        UPSTREAM_THROTTLED.labels(upstream_path, "rate").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Слишком много запросов к API Whoosh, повторите позже",
+            headers={"Retry-After": str(math.ceil(UPSTREAM_QUEUE_TIMEOUT))}
+        )
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+    if not await upstream_limiter.acquire(UPSTREAM_QUEUE_TIMEOUT - wait):
+        UPSTREAM_THROTTLED.labels(upstream_path, "concurrency").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="API Whoosh перегружен, повторите позже",
+            headers={"Retry-After": "1"}
+        )
+
+    UPSTREAM_QUEUE_WAIT.labels(upstream_path).observe(time.perf_counter() - started)
+
+
+class RetryBudget:
+    """
+    Общий бюджет повторов запросов к API Whoosh: за последние window секунд повторов может быть
+    не больше ratio от числа запросов плюс min_per_second в секунду. Во время сбоя API Whoosh
+    почти все запросы завершаются ошибкой, и без бюджета каждый из них превратился бы
+    в несколько, усиливая нагрузку как раз тогда, когда API и так перегружен.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, window: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._requests: "deque[float]" = deque()
+        self._retries: "deque[float]" = deque()
+
+    def _trim(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and events[0] <= now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= self.min_per_second * self.window + self.ratio * len(self._requests):
+            return False
+        self._retries.append(now)
+        return True
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_WINDOW)
+
+
+def get_retry_policy(method: str, upstream_path: str) -> str:
+    method = method.upper()
+    return RETRY_POLICIES.get((method, upstream_path)) or RETRY_POLICIES.get((method, "*"), "never")
+
+
+# Через сколько секунд повторить запрос или None, если повторять нельзя
+def get_retry_delay(
+        method: str,
+        upstream_path: str,
+        attempt: int,
+        error: Optional[httpx.HTTPError] = None,
+        response: Optional[httpx.Response] = None
+) -> Optional[float]:
+    if attempt >= RETRY_MAX_ATTEMPTS:
+        return None
+
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        # Соединение не установлено - запрос точно не выполнен, повторять безопасно
+        reason = "connect"
+    else:
+        policy = get_retry_policy(method, upstream_path)
+        if policy == "never":
+            return None
+        if isinstance(error, httpx.TimeoutException):
+            reason = "timeout"
+        elif isinstance(error, httpx.TransportError):
+            reason = "network"
+        elif response is not None and response.status_code in RETRY_STATUSES:
+            reason = str(response.status_code)
+        else:
+            return None
+
+    if not retry_budget.try_spend():
+        UPSTREAM_RETRIES_DENIED.labels(upstream_path).inc()
+        return None
+
+    UPSTREAM_RETRIES.labels(upstream_path, reason).inc()
+    # Экспоненциальная задержка со случайным разбросом (full jitter), чтобы повторы не шли волной
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def get_retry_after(response: httpx.Response) -> float:
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", "1")))
+    except ValueError:
+        return 1.0
+
+
+class StaleResponse(dict):
+    """Ответ из запаса последних успешных ответов, отданный, пока API Whoosh недоступен"""
+
+    # Когда ответ был получен от API Whoosh (time.time())
+    fetched_at: float = 0.0
+
+
+# Когда получены данные ответа API Whoosh: для ответа из запаса - время исходного ответа, иначе - сейчас
+def get_fetched_at(value: Dict) -> float:
+    return value.fetched_at if isinstance(value, StaleResponse) else time.time()
+
+
+# Флаги ответа текущего запроса к нашему API. Хранится изменяемый словарь, а не сам флаг:
+# запросы к API Whoosh выполняются и в дочерних задачах (gather, объединение запросов),
+# а изменения contextvar в них не видны обработчику запроса
+current_response_flags: ContextVar[Optional[Dict[str, bool]]] = ContextVar("current_response_flags", default=None)
+
+
+def mark_response_stale():
+    flags = current_response_flags.get()
+    if flags is not None:
+        flags["stale"] = True
+
+
+# Отправлен ли уже запрос на изменение в API Whoosh (выставляется для каждого элемента групповой
+# операции). Изменяемый словарь по той же причине, что и current_response_flags
+current_write_flags: ContextVar[Optional[Dict[str, bool]]] = ContextVar("current_write_flags", default=None)
+
+
+def mark_write_sent():
+    flags = current_write_flags.get()
+    if flags is not None:
+        flags["sent"] = True
+
+
+@app.middleware("http")
+async def flag_stale_response(request: Request, call_next):
+    flags = {"stale": False}
+    token = current_response_flags.set(flags)
+    try:
+        response = await call_next(request)
+    finally:
+        current_response_flags.reset(token)
+    if flags["stale"]:
+        response.headers[STALE_HEADER] = "1"
+    return response
+
+
+# Собираем метрики по каждому маршруту нашего API
+@app.middleware("http")
+async def collect_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        # Шаблон маршрута (/api/prepare_trip/{scooter_code}), а не конкретный путь
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        REQUEST_COUNT.labels(route_path, request.method, status).inc()
+        REQUEST_LATENCY.labels(route_path, request.method).observe(time.perf_counter() - started)
+
+
+# id запроса: из заголовка X-Request-Id клиента или новый. Возвращается в ответе,
+# передается в запросы к API Whoosh и добавляется к записям лога
+@app.middleware("http")
+async def bind_request_id(request: Request, call_next):
+    request_id = request.headers.get(REQUEST_ID_HEADER)
+    if not request_id or len(request_id) > 128 or not request_id.isascii() or not request_id.isprintable():
+        request_id = uuid.uuid4().hex
+    token = current_request_id.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        current_request_id.reset(token)
+    response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+# Middleware, зарегистрированные позже, оборачивают зарегистрированные раньше. Метрики, сжатие
+# и CORS регистрируются последними, чтобы действовать и на ответы с ошибками из middleware выше
+# (неизвестный регион, неверный API-ключ): иначе браузер не сможет прочитать такой ответ,
+# а /metrics не посчитает его.
+
+# Сжатие ответов (маршруты поездок, списки). Потоки SSE и NDJSON не сжимаются,
+# иначе события копились бы в буфере gzip и доходили до клиента с задержкой
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=int(os.getenv("WHOOSH_GZIP_MINIMUM_SIZE", "1000")),
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + ("application/x-ndjson",)
+)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # В продакшн-окружении лучше указать конкретные домены
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+# Последний успешный ответ на GET-запрос, если API Whoosh сейчас недоступен
+async def get_fallback_response(method: str, key: Optional[tuple], upstream_path: str) -> Optional[StaleResponse]:
+    if key is None:
+        return None
+    cached = await fallback_cache.get_timed(key)
+    if cached is None:
+        return None
+    UPSTREAM_FALLBACKS.labels(upstream_path).inc()
+    logger.warning("API Whoosh недоступен, отдаем последний успешный ответ %s %s", method.upper(), upstream_path)
+    value, fetched_at = cached
+    response = StaleResponse(copy.deepcopy(value))
+    response.fetched_at = fetched_at
+    return response
+
+
+# Выполняющиеся GET-запросы к API Whoosh: (аккаунт, url, параметры) -> задача
+inflight_requests: Dict[tuple, asyncio.Task] = {}
+coalesced_requests_total = 0
 
 
 # Вспомогательная функция для запросов к API Whoosh с автоматическим обновлением токенов
@@ -147,16 +1791,64 @@ async def make_request(
         url: str,
         json_data: Optional[Dict] = None,
         params: Optional[Dict] = None,
-        retry_count: int = 0
+        retry_count: int = 0,
+        account: Optional[Account] = None,
+        shared: bool = False
+) -> Dict:
+    global coalesced_requests_total
+
+    # shared=True - запрос не привязан к пользователю и может уйти с любого аккаунта пула
+    if account is None:
+        account = get_request_account(shared)
+
+    if method.lower() != "get" or not COALESCE_REQUESTS:
+        result = await send_request(method, url, json_data, params, retry_count, account)
+        if isinstance(result, StaleResponse):
+            mark_response_stale()
+        return result
+
+    # Одинаковые одновременные GET-запросы выполняются одним запросом к API Whoosh
+    key = ResponseCache.make_key(account.id, method, url, params)
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(send_request(method, url, json_data, params, retry_count, account))
+        inflight_requests[key] = task
+        task.add_done_callback(lambda done: forget_inflight_request(key, done))
+    else:
+        coalesced_requests_total += 1
+        COALESCED_REQUESTS.inc()
+
+    # shield: отмена одного из ожидающих не отменяет запрос для остальных
+    result = await asyncio.shield(task)
+    if isinstance(result, StaleResponse):
+        mark_response_stale()
+    # Каждый получает свою копию, чтобы изменения ответа не влияли на других
+    return copy.deepcopy(result)
+
+
+def forget_inflight_request(key: tuple, task: asyncio.Task):
+    if inflight_requests.get(key) is task:
+        del inflight_requests[key]
+    # Помечаем ошибку как обработанную, даже если все ожидающие были отменены
+    if not task.cancelled():
+        task.exception()
+
+
+# Выполняет запрос к API Whoosh от имени аккаунта.
+# Таймауты, ошибки сети и 5xx повторяются с экспоненциальной задержкой согласно RETRY_POLICIES.
+async def send_request(
+        method: str,
+        url: str,
+        json_data: Optional[Dict],
+        params: Optional[Dict],
+        retry_count: int,
+        account: Account
 ) -> Dict:
     if retry_count > 1:
         raise HTTPException(status_code=500, detail="Превышено количество попыток запроса")
 
-    tokens = load_tokens()
-
-    # Если токены отсутствуют, пытаемся обновить их
-    if not tokens.get("access_token") or not tokens.get("id_token"):
-        tokens = await refresh_tokens()
+    # Токены берутся из памяти; при отсутствии или истечении они будут обновлены
+    tokens = await account.token_manager.get_tokens()
 
     headers = {
         "X-Api-Key": "yqKeRnxGX77NSeqvX3YyQ5VBio3SJcJ44iOfOnBX",
@@ -165,14 +1857,97 @@ async def make_request(
         "X-Id-Token": tokens["id_token"],
         "X-Client": "android",
         "x-client-AB": "A",
-        "x-client-uuid": CLIENT_UUID,
+        "x-client-uuid": account.client_uuid,
         "X-Client-Version": "2.33.0",
-        "X-region-id": REGION_ID,
+        "X-region-id": get_request_region_id(),
         "Content-Type": "application/json; charset=UTF-8"
     }
+    # Объединенный GET-запрос уходит с id запроса, который его начал
+    request_id = current_request_id.get()
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+
+    upstream_path = get_upstream_path_template(url)
+    # Успешные ответы на GET запоминаются, чтобы отдать их при недоступности API Whoosh
+    fallback_key = ResponseCache.make_key(account.id, method, url, params) if method.lower() == "get" else None
+    retry_budget.record_request()
+    attempt = 1
+
+    while True:
+        error = None
+        response = None
+        try:
+            response = await send_attempt(method, url, headers, json_data, params, account, upstream_path)
+        except httpx.HTTPError as e:
+            error = e
+        except CircuitOpenError:
+            fallback = await get_fallback_response(method, fallback_key, upstream_path)
+            if fallback is not None:
+                return fallback
+            raise
+
+        if response is not None:
+            # Если токен истек, обновляем токены и повторяем запрос
+            if response.status_code == 401 and "expired" in response.text.lower():
+                logger.info("Токен истек, обновляем токены...")
+
+                await account.token_manager.refresh(stale_access_token=tokens["access_token"])
+                # Рекурсивно повторяем запрос с обновленными токенами
+                return await send_request(method, url, json_data, params, retry_count + 1, account)
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                if fallback_key is not None:
+                    # Отдельная копия: вызывающий код может изменять полученный ответ
+                    await fallback_cache.put(fallback_key, orjson.loads(response.content), FALLBACK_MAX_AGE)
+                return data
+
+        delay = get_retry_delay(method, upstream_path, attempt, error, response)
+        if delay is None:
+            # Последний успешный ответ отдается только при разомкнутой цепи (см. выше): единичная
+            # ошибка API Whoosh возвращается как есть, а не подменяется данными часовой давности
+            if error is not None:
+                logger.error("Ошибка HTTP: %s", error)
+                raise HTTPException(status_code=500, detail=f"Ошибка при выполнении запроса: {str(error)}")
+            raise HTTPException(status_code=response.status_code, detail=f"Ошибка API Whoosh: {response.text}")
+
+        logger.warning(
+            "Запрос %s %s не удался (%s), повтор %d через %.2f с",
+            method.upper(), upstream_path, error if error is not None else response.status_code, attempt, delay
+        )
+        await asyncio.sleep(delay)
+        attempt += 1
 
+
+# Одна попытка запроса к API Whoosh: размыкатель цепи, очередь ограничителей, сам запрос и метрики
+async def send_attempt(
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        json_data: Optional[Dict],
+        params: Optional[Dict],
+        account: Account,
+        upstream_path: str
+) -> httpx.Response:
+    breaker = get_circuit_breaker(upstream_path)
+    if not breaker.allow():
+        UPSTREAM_SHORT_CIRCUITED.labels(upstream_path).inc()
+        raise CircuitOpenError(upstream_path, breaker.retry_after())
+
+    status = "error"
+    started = time.perf_counter()
+    success = None
+
+    account.outstanding += 1
+    account.last_used = time.monotonic()
     try:
-        async with httpx.AsyncClient() as client:
+        await throttle_upstream(account, upstream_path)
+        client = get_http_client()
+        sent = time.perf_counter()
+        overloaded = False
+        if method.lower() != "get":
+            mark_write_sent()
+        try:
             if method.lower() == "get":
                 response = await client.get(url, headers=headers, params=params)
             elif method.lower() == "post":
@@ -181,26 +1956,350 @@ async def make_request(
                 response = await client.delete(url, headers=headers, params=params)
             else:
                 raise ValueError(f"Неподдерживаемый метод: {method}")
+            overloaded = response.status_code == 429 or response.status_code >= 500
+            if response.status_code != 429:
+                success = response.status_code < 500
+        except httpx.TransportError:
+            overloaded = True
+            success = False
+            raise
+        finally:
+            upstream_limiter.release(time.perf_counter() - sent, overloaded)
+
+        status = str(response.status_code)
+
+        # API Whoosh ограничивает частоту - приостанавливаем запросы по этому пути
+        if response.status_code == 429:
+            get_rate_bucket(account, upstream_path).pause(get_retry_after(response))
+
+        return response
+    finally:
+        breaker.record(success)
+        account.outstanding -= 1
+        UPSTREAM_COUNT.labels(method.upper(), upstream_path, status).inc()
+        UPSTREAM_LATENCY.labels(method.upper(), upstream_path).observe(time.perf_counter() - started)
+
+
+# Параллельно выполняет независимые запросы к API Whoosh.
+# Одновременно выполняется не больше limit запросов, каждый ограничен timeout секундами.
+# Ошибки не прерывают остальные запросы и возвращаются в списке результатов.
+# Таймаут отменяет запрос, даже если он уже отправлен, поэтому запросы на изменение сюда не передаются.
+async def gather_requests(*coros, limit: int = UPSTREAM_FANOUT_LIMIT, timeout: float = UPSTREAM_CALL_TIMEOUT) -> List[Any]:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(coro, timeout)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="Превышено время ожидания ответа API Whoosh")
+
+    return await asyncio.gather(*(run(coro) for coro in coros), return_exceptions=True)
+
+
+class CacheEntry:
+    __slots__ = ("value", "size", "expires_at", "stale_until", "fetched_at")
+
+    def __init__(self, value: Dict, size: int, expires_at: float, stale_until: float, fetched_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+        # Время получения ответа (time.time()): по нему считаются величины вроде остатка секунд
+        self.fetched_at = fetched_at
+
+
+class ResponseCache:
+    """
+    LRU-кэш ответов API Whoosh с ограничением по количеству записей и по памяти.
+    Свежая запись отдается сразу. Устаревшая, но еще не просроченная больше чем на stale
+    секунд, тоже отдается сразу, а в фоне запускается ее обновление (stale-while-revalidate).
+    Значения из кэша общие для всех запросов, поэтому изменять их нельзя.
+    """
 
-            # Если токен истек, обновляем токены и повторяем запрос
-            if response.status_code == 401 and "expired" in response.text.lower():
-                logger.info("Токен истек, обновляем токены...")
+    def __init__(self, name: str, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+        self._refreshing: Dict[tuple, asyncio.Task] = {}
+
+    @staticmethod
+    def make_key(account_id: str, method: str, url: str, params: Optional[Dict] = None) -> tuple:
+        frozen_params = tuple(sorted((key, str(value)) for key, value in (params or {}).items()))
+        # Регион запроса уходит в API Whoosh заголовком X-region-id, поэтому ответы разных регионов различаются
+        return account_id, method.lower(), url, frozen_params, get_request_region_id()
+
+    async def get_or_fetch(self, key: tuple, fetch, ttl: float, stale: float = 0) -> Dict:
+        return (await self.get_or_fetch_timed(key, fetch, ttl, stale))[0]
+
+    # То же, что get_or_fetch, но вместе со временем получения ответа от API Whoosh
+    async def get_or_fetch_timed(self, key: tuple, fetch, ttl: float, stale: float = 0) -> Tuple[Dict, float]:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+
+        if entry is not None and now < entry.expires_at:
+            self.hits += 1
+            CACHE_LOOKUPS.labels(self.name, "hit").inc()
+            self._entries.move_to_end(key)
+            return entry.value, entry.fetched_at
+
+        if entry is not None and now < entry.stale_until:
+            self.stale_hits += 1
+            CACHE_LOOKUPS.labels(self.name, "stale").inc()
+            self._entries.move_to_end(key)
+            if key not in self._refreshing:
+                task = asyncio.create_task(self._revalidate(key, fetch, ttl, stale))
+                self._refreshing[key] = task
+            return entry.value, entry.fetched_at
+
+        self.misses += 1
+        CACHE_LOOKUPS.labels(self.name, "miss").inc()
+        value = await fetch()
+        self._put(key, value, ttl, stale)
+        return value, get_fetched_at(value)
+
+    async def _revalidate(self, key: tuple, fetch, ttl: float, stale: float):
+        try:
+            self._put(key, await fetch(), ttl, stale)
+        except Exception as e:
+            logger.warning("Не удалось обновить кэш для %s: %s", key[2], e)
+        finally:
+            self._refreshing.pop(key, None)
+
+    # get, put, ttl_left и discard асинхронные, как и у общего кэша (SharedResponseCache)
+    async def get(self, key: tuple) -> Optional[Dict]:
+        cached = await self.get_timed(key)
+        return cached[0] if cached is not None else None
+
+    async def get_timed(self, key: tuple) -> Optional[Tuple[Dict, float]]:
+        # Только свежая запись, без фонового обновления
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry.expires_at:
+            self.misses += 1
+            CACHE_LOOKUPS.labels(self.name, "miss").inc()
+            return None
+        self.hits += 1
+        CACHE_LOOKUPS.labels(self.name, "hit").inc()
+        self._entries.move_to_end(key)
+        return entry.value, entry.fetched_at
+
+    async def ttl_left(self, key: tuple) -> float:
+        entry = self._entries.get(key)
+        if entry is None:
+            return 0.0
+        return max(0.0, entry.expires_at - time.monotonic())
+
+    async def discard(self, key: tuple):
+        self._remove(key)
+
+    async def put(self, key: tuple, value: Dict, ttl: float, stale: float = 0):
+        self._put(key, value, ttl, stale)
+
+    def _put(self, key: tuple, value: Dict, ttl: float, stale: float = 0):
+        # Ответ из запаса при недоступном API Whoosh не должен попасть в кэш как свежий
+        if isinstance(value, StaleResponse):
+            return
+
+        now = time.monotonic()
+        size = len(orjson.dumps(value))
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = CacheEntry(value, size, now + ttl, now + ttl + stale, time.time())
+        self.total_bytes += size
+
+        # Вытесняем давно не использовавшиеся записи
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, account_id: str, paths: List[str]):
+        for key in [key for key in self._entries if key[0] == account_id]:
+            if urlsplit(key[2]).path in paths:
+                self._remove(key)
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
 
-                await refresh_tokens()
-                # Рекурсивно повторяем запрос с обновленными токенами
-                return await make_request(method, url, json_data, params, retry_count + 1)
 
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail=f"Ошибка API Whoosh: {response.text}")
+class SharedResponseCache(ResponseCache):
+    """
+    Кэш ответов в общем хранилище (при нескольких воркерах): запись, полученная одним
+    воркером, видна остальным, а сброс после поездки действует во всех процессах.
+    Значения хранятся сериализованными, поэтому каждый запрос получает свою копию.
+    Ошибка хранилища не ломает запрос: он просто идет в API Whoosh мимо кэша.
+    """
 
-            return response.json()
-    except httpx.HTTPError as e:
-        logger.error(f"Ошибка HTTP: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ошибка при выполнении запроса: {str(e)}")
+    def __init__(self, name: str, store: SharedStore):
+        super().__init__(name)
+        self.store = store
+        self._invalidations = set()
+
+    def _location(self, key: tuple) -> tuple:
+        # Ответы API Whoosh (ключ из make_key) группируются по аккаунту и пути, чтобы invalidate сбрасывал
+        # путь целиком; остальные ключи (кэш самокатов) - каждый в своем пространстве имен
+        if len(key) == 5:
+            account_id, method, url, params, region_id = key
+            return f"{self.name}:{account_id}:{urlsplit(url).path}", orjson.dumps([method, url, params, region_id]).decode()
+        return f"{self.name}:" + ":".join(str(part) for part in key), ""
+
+    async def _load(self, key: tuple) -> Optional[Dict]:
+        namespace, field = self._location(key)
+        try:
+            raw = await self.store.get(namespace, field)
+        except Exception as e:
+            logger.warning("Ошибка чтения общего кэша: %s", e)
+            return None
+        if not raw:
+            return None
+        entry = orjson.loads(raw)
+        # Записи, сохраненные до появления fetched_at, считаем полученными сейчас
+        entry.setdefault("fetched_at", time.time())
+        return entry
+
+    async def get_or_fetch_timed(self, key: tuple, fetch, ttl: float, stale: float = 0) -> Tuple[Dict, float]:
+        # Сброс, начатый этим воркером, должен завершиться до чтения
+        if self._invalidations:
+            await asyncio.gather(*list(self._invalidations), return_exceptions=True)
+
+        entry = await self._load(key)
+        now = time.time()
+        if entry is not None and now < entry["expires_at"]:
+            self.hits += 1
+            CACHE_LOOKUPS.labels(self.name, "hit").inc()
+            return entry["value"], entry["fetched_at"]
+
+        if entry is not None and now < entry["stale_until"]:
+            self.stale_hits += 1
+            CACHE_LOOKUPS.labels(self.name, "stale").inc()
+            if key not in self._refreshing:
+                self._refreshing[key] = asyncio.create_task(self._revalidate(key, fetch, ttl, stale))
+            return entry["value"], entry["fetched_at"]
+
+        self.misses += 1
+        CACHE_LOOKUPS.labels(self.name, "miss").inc()
+        value = await fetch()
+        await self.put(key, value, ttl, stale)
+        return value, get_fetched_at(value)
+
+    async def _revalidate(self, key: tuple, fetch, ttl: float, stale: float):
+        try:
+            await self.put(key, await fetch(), ttl, stale)
+        except Exception as e:
+            logger.warning("Не удалось обновить кэш для %s: %s", key[2], e)
+        finally:
+            self._refreshing.pop(key, None)
+
+    async def get_timed(self, key: tuple) -> Optional[Tuple[Dict, float]]:
+        entry = await self._load(key)
+        if entry is None or time.time() >= entry["expires_at"]:
+            self.misses += 1
+            CACHE_LOOKUPS.labels(self.name, "miss").inc()
+            return None
+        self.hits += 1
+        CACHE_LOOKUPS.labels(self.name, "hit").inc()
+        return entry["value"], entry["fetched_at"]
+
+    async def ttl_left(self, key: tuple) -> float:
+        entry = await self._load(key)
+        if entry is None:
+            return 0.0
+        return max(0.0, entry["expires_at"] - time.time())
+
+    async def discard(self, key: tuple):
+        try:
+            await self.store.delete([self._location(key)[0]])
+        except Exception as e:
+            logger.warning("Ошибка записи в общий кэш: %s", e)
+
+    async def put(self, key: tuple, value: Dict, ttl: float, stale: float = 0):
+        if isinstance(value, StaleResponse):
+            return
+        namespace, field = self._location(key)
+        now = time.time()
+        entry = orjson.dumps({"value": value, "expires_at": now + ttl, "stale_until": now + ttl + stale, "fetched_at": now})
+        try:
+            await self.store.set(namespace, field, entry, ttl + stale)
+        except Exception as e:
+            logger.warning("Ошибка записи в общий кэш: %s", e)
+
+    def invalidate(self, account_id: str, paths: List[str]):
+        task = asyncio.create_task(self.store.delete([f"{self.name}:{account_id}:{path}" for path in paths]))
+        self._invalidations.add(task)
+        task.add_done_callback(self._invalidations.discard)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "backend": self.store.name,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
+
+
+# С общим хранилищем кэш ответов и запас последних ответов общие для воркеров, иначе - LRU в памяти процесса
+if shared_store.shared:
+    response_cache = SharedResponseCache("responses", shared_store)
+    fallback_cache = SharedResponseCache("fallback", shared_store)
+else:
+    response_cache = ResponseCache("responses")
+    fallback_cache = ResponseCache("fallback", FALLBACK_MAX_ENTRIES, FALLBACK_MAX_BYTES)
+
+
+# GET-запрос к API Whoosh через кэш ответов (время жизни задается в CACHE_TTLS по пути запроса)
+async def cached_request(url: str, params: Optional[Dict] = None, shared: bool = False) -> Dict:
+    return (await cached_request_timed(url, params, shared))[0]
+
+
+# То же, что cached_request, но вместе со временем, когда ответ был получен от API Whoosh
+# (для ответа из кэша или запаса - время исходного ответа)
+async def cached_request_timed(url: str, params: Optional[Dict] = None, shared: bool = False) -> Tuple[Dict, float]:
+    ttl, stale = CACHE_TTLS.get(urlsplit(url).path, (0, 0))
+    if ttl <= 0:
+        value = await make_request("get", url, params=params, shared=shared)
+        return value, get_fetched_at(value)
+
+    # Ответы, не зависящие от пользователя, кэшируются общими для всех аккаунтов
+    account = None if shared else get_request_account()
+    key = ResponseCache.make_key("*" if shared else account.id, "get", url, params)
+
+    async def fetch():
+        return await make_request("get", url, params=params, account=account, shared=shared)
+
+    return await response_cache.get_or_fetch_timed(key, fetch, ttl, stale)
+
+
+# Сбрасывает кэш данных аккаунта, которые меняются после поездок и бронирований
+def invalidate_account_cache(account: Optional[Account] = None):
+    account = account or get_request_account()
+    response_cache.invalidate(account.id, TRIP_WRITE_INVALIDATES)
 
 
 # Эндпоинт для проверки пакета минут
-@app.get("/api/minute_pack", summary="Получение информации о пакете минут")
+@app.get("/api/minute_pack", summary="Получение информации о пакете минут",
+         response_model=MinutePackResponse, response_model_exclude_unset=True)
 async def get_minute_pack():
     """
     Возвращает информацию о текущем пакете минут пользователя:
@@ -209,78 +2308,386 @@ async def get_minute_pack():
     - Срок действия пакета
     """
     url = f"{BASE_URL}/user-minute-pack/info"
-    params = {"regionId": REGION_ID}
+    params = {"regionId": get_request_region_id()}
+
+    try:
+        response, fetched_at = await cached_request_timed(url, params=params)
+
+        track_minute_pack(response.get("purchasedMinutePack"), fetched_at)
+
+        # Проверяем наличие пакета минут
+        if "purchasedMinutePack" in response:
+            minute_pack = response["purchasedMinutePack"]
+            seconds_left = minute_pack.get("secondsLeft", 0)
+            minutes_left = seconds_left // 60
+            seconds_remainder = seconds_left % 60
+
+            return {
+                "has_minute_pack": True,
+                "pack_name": minute_pack.get("annotations", {}).get("packName", ""),
+                "minutes_left": minutes_left,
+                "seconds_left": seconds_left,
+                "formatted_time_left": f"{minutes_left} мин {seconds_remainder} сек",
+                "valid_to": minute_pack.get("validTo", ""),
+                "duration": minute_pack.get("annotations", {}).get("packDuration", "")
+            }
+        else:
+            return {"has_minute_pack": False}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении информации о пакете минут: {str(e)}")
+
+
+class ParkingIndex:
+    """
+    Парковки одного региона в массивах NumPy. Ближайшая парковка ищется
+    векторизованной формулой гаверсинусов сразу по всем точкам.
+    """
+
+    def __init__(self, parkings: List[Dict]):
+        # Сортируем по широте, чтобы при ограниченном радиусе считать расстояния только для полосы широт
+        parkings = sorted(parkings, key=lambda parking: parking["lat"])
+        self.ids = [parking.get("id") for parking in parkings]
+        self.lat = np.array([parking["lat"] for parking in parkings], dtype=np.float64)
+        self.lng = np.array([parking["lng"] for parking in parkings], dtype=np.float64)
+        self._lat_rad = np.radians(self.lat)
+        self._lng_rad = np.radians(self.lng)
+        self._cos_lat = np.cos(self._lat_rad)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def nearest(self, lat: float, lng: float, max_distance: Optional[float] = None) -> Optional[tuple]:
+        """Ближайшая парковка и расстояние до нее в метрах (None, если в пределах max_distance парковок нет)"""
+        start, end = 0, len(self)
+        if max_distance is not None:
+            # Дальше max_distance по широте точно не ближе: отсекаем бинарным поиском
+            lat_delta = math.degrees(max_distance / (EARTH_RADIUS_KM * 1000))
+            start = int(np.searchsorted(self.lat, lat - lat_delta, side="left"))
+            end = int(np.searchsorted(self.lat, lat + lat_delta, side="right"))
+        if start >= end:
+            return None
+
+        lat_rad = math.radians(lat)
+        lng_rad = math.radians(lng)
+        # Значение a из формулы гаверсинусов монотонно растет с расстоянием, поэтому argmin берем по нему
+        a = (np.sin((self._lat_rad[start:end] - lat_rad) / 2) ** 2
+             + math.cos(lat_rad) * self._cos_lat[start:end] * np.sin((self._lng_rad[start:end] - lng_rad) / 2) ** 2)
+        offset = int(np.argmin(a))
+        index = start + offset
+        distance_m = 2 * EARTH_RADIUS_KM * 1000 * math.asin(math.sqrt(min(1.0, float(a[offset]))))
+
+        parking = {"id": self.ids[index], "lat": float(self.lat[index]), "lng": float(self.lng[index])}
+        return parking, distance_m
+
+
+# Загружает локальный набор парковок: {"regions": {"<id региона>": [{"id", "lat", "lng"}, ...]}}
+def load_parking_indexes(parkings_file: str = PARKINGS_FILE) -> Dict[str, ParkingIndex]:
+    if not os.path.exists(parkings_file):
+        return {}
+    try:
+        with open(parkings_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {
+            region_id: ParkingIndex(parkings)
+            for region_id, parkings in data.get("regions", {}).items()
+        }
+    except Exception as e:
+        logger.error("Ошибка при загрузке парковок: %s", e)
+        return {}
+
+
+parking_indexes = load_parking_indexes()
+parkings_refresh_task: Optional[asyncio.Task] = None
+
+
+# Формат ответа о парковках не документирован: ищем список зон и берем у каждой id и центр
+# (явные координаты или среднее точек полигона)
+def extract_parkings(data: Any) -> List[Dict]:
+    if isinstance(data, dict):
+        for key in ("parkings", "zones", "areas", "items"):
+            if isinstance(data.get(key), list):
+                data = data[key]
+                break
+    if not isinstance(data, list):
+        return []
+
+    parkings = []
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        point = item.get("center") or item.get("coordinate") or item.get("position") or item
+        lat = point.get("lat", point.get("latitude")) if isinstance(point, dict) else None
+        lng = point.get("lng", point.get("longitude")) if isinstance(point, dict) else None
+        if lat is None or lng is None:
+            polygon = [vertex for vertex in item.get("polygon") or item.get("points") or []
+                       if isinstance(vertex, dict) and "lat" in vertex and "lng" in vertex]
+            if not polygon:
+                continue
+            lat = sum(vertex["lat"] for vertex in polygon) / len(polygon)
+            lng = sum(vertex["lng"] for vertex in polygon) / len(polygon)
+        parkings.append({"id": item.get("id"), "lat": float(lat), "lng": float(lng)})
+    return parkings
+
+
+def save_parkings(regions: Dict[str, List[Dict]], parkings_file: str = PARKINGS_FILE):
+    tmp_file = f"{parkings_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({"regions": regions}, f, ensure_ascii=False)
+    os.replace(tmp_file, parkings_file)
+
+
+# Запрашивает парковки регионов у Whoosh, обновляет индексы и файл парковок
+async def refresh_parkings():
+    regions = [region_id.strip() for region_id in os.getenv("WHOOSH_PARKINGS_REGIONS", REGION_ID).split(",") if region_id.strip()]
+    updated = {}
+    for region_id in regions:
+        token = current_region_id.set(region_id)
+        try:
+            data = await make_request("get", f"{BASE_URL}{PARKINGS_SOURCE_PATH}", params={"regionId": region_id}, shared=True)
+        except Exception as e:
+            logger.warning("Ошибка при обновлении парковок региона %s: %s", region_id, e)
+            continue
+        finally:
+            current_region_id.reset(token)
+        parkings = extract_parkings(data)
+        if parkings:
+            updated[region_id] = parkings
+        else:
+            logger.warning("В ответе %s для региона %s не найдено парковок", PARKINGS_SOURCE_PATH, region_id)
+
+    if not updated:
+        return
+    for region_id, parkings in updated.items():
+        parking_indexes[region_id] = ParkingIndex(parkings)
+    # Регионы, которые сейчас не обновлялись, остаются в файле из прошлой загрузки
+    regions_data = {region_id: [{"id": parking_id, "lat": float(lat), "lng": float(lng)}
+                                for parking_id, lat, lng in zip(index.ids, index.lat, index.lng)]
+                    for region_id, index in parking_indexes.items()}
+    try:
+        await asyncio.to_thread(save_parkings, regions_data)
+    except OSError as e:
+        logger.error("Ошибка при сохранении парковок: %s", e)
+    logger.info("Парковки обновлены: %s", {region_id: len(parkings) for region_id, parkings in updated.items()})
+
+
+async def refresh_parkings_periodically():
+    while True:
+        await refresh_parkings()
+        await asyncio.sleep(PARKINGS_REFRESH_INTERVAL)
+
+
+# Позиция райдера для запроса: из тела запроса, из заголовков X-Lat/X-Lng или по умолчанию
+def get_rider_position(position: Optional[Position] = None) -> Position:
+    if position is not None:
+        # Регион определяем по координатам из тела, если он не задан заголовками
+        if current_region_id.get() is None:
+            nearest = region_index.nearest(position.lat, position.lng)
+            if nearest is not None:
+                current_region_id.set(nearest[0]["id"])
+        return position
+
+    header_position = current_position.get()
+    if header_position is not None:
+        return Position(lat=header_position[0], lng=header_position[1])
+
+    return Position(lat=DEFAULT_LAT, lng=DEFAULT_LNG)
+
+
+# Точка завершения поездки: позиция райдера, притянутая к ближайшей известной парковке
+def get_trip_end_position(position: Optional[Position] = None) -> tuple:
+    if position is None and current_position.get() is None:
+        # Координаты райдера неизвестны - используем прежние фиксированные координаты
+        return Position(**END_COORDINATES), None
+
+    position = get_rider_position(position)
+    index = parking_indexes.get(get_request_region_id())
+    nearest = index.nearest(position.lat, position.lng, PARKING_SNAP_MAX_DISTANCE) if index is not None else None
+
+    if nearest is not None and nearest[1] <= PARKING_SNAP_MAX_DISTANCE:
+        parking, distance_m = nearest
+        return Position(lat=parking["lat"], lng=parking["lng"]), {**parking, "distance_m": round(distance_m, 1)}
+
+    return position, None
+
+
+# Кэш для разрешения кода самоката в id и тарифов самоката (общий для воркеров, как и кэш ответов):
+# prepare_trip и следующий за ним start_trip могут попасть на разные воркеры
+if shared_store.shared:
+    device_cache = SharedResponseCache("devices", shared_store)
+else:
+    device_cache = ResponseCache("devices", max_entries=DEVICE_CACHE_MAX_ENTRIES)
+
+
+# Находит id самоката по его коду (код -> id кэшируется на DEVICE_ID_CACHE_TTL секунд)
+async def resolve_device_id(code: str, position: Optional[Position] = None) -> str:
+    key = ("*", "device", code)
+    cached = await device_cache.get(key)
+    if cached is not None:
+        return cached["id"]
+
+    position = position or get_rider_position()
+    device_state_url = f"{BASE_URL}/devices/state"
+    device_params = {
+        "code": code,
+        "lat": position.lat,
+        "lng": position.lng,
+        "scanType": "MANUAL"
+    }
+
+    device_info = await make_request("get", device_state_url, params=device_params)
+
+    device_id = device_info.get("device", {}).get("id")
+    if not device_id:
+        raise HTTPException(status_code=404, detail="Самокат не найден")
+
+    await device_cache.put(key, {"id": device_id}, DEVICE_ID_CACHE_TTL)
+    return device_id
+
+
+# Сколько секунд можно использовать полученные тарифы: до истечения tariffsToken
+# (если это JWT с exp) за вычетом запаса, но не дольше TARIFFS_CACHE_TTL
+def get_tariffs_ttl(tariffs_info: Dict) -> float:
+    token_expiry = get_token_expiry(tariffs_info.get("tariffsToken"))
+    if token_expiry is None:
+        return TARIFFS_CACHE_TTL
+    return min(TARIFFS_CACHE_TTL, token_expiry - time.time() - TARIFFS_TOKEN_MARGIN)
+
+
+def get_tariffs_cache_key(device_id: str) -> tuple:
+    return get_request_account().id, "tariffs", device_id
+
+
+# Получает тарифы для самоката (из кэша, пока действителен tariffsToken)
+async def get_device_tariffs(device_id: str, refresh: bool = False) -> Dict:
+    key = get_tariffs_cache_key(device_id)
+    if not refresh:
+        cached = await device_cache.get(key)
+        if cached is not None:
+            return cached
+
+    tariff_url = f"{BASE_URL}/tariffs/tariff/minute-pack"
+    tariff_params = {"device": device_id}
+
+    tariffs_info = await make_request("get", tariff_url, params=tariff_params)
+
+    ttl = get_tariffs_ttl(tariffs_info)
+    if ttl > 0:
+        await device_cache.put(key, tariffs_info, ttl)
+    return tariffs_info
+
+
+# Эндпоинт для предварительной подготовки самоката к поездке
+@app.post("/api/prepare_trip/{scooter_code}", summary="Подготовить самокат к поездке",
+          response_model=PrepareTripResponse, response_model_exclude_unset=True)
+async def prepare_trip(scooter_code: str):
+    """
+    Заранее находит самокат по коду и получает его тарифы.
+    Результат сохраняется на время действия tariffsToken, поэтому следующий
+    /api/start_trip для этого кода отправляет в Whoosh только запрос на начало поездки.
+    Клиенту стоит вызывать его сразу после ввода или сканирования кода.
+    """
+    try:
+        device_id = await resolve_device_id(scooter_code)
+        tariffs_info = await get_device_tariffs(device_id)
+        expires_in = int(await device_cache.ttl_left(get_tariffs_cache_key(device_id)))
+
+        return {
+            "success": True,
+            "device_code": scooter_code,
+            "device_id": device_id,
+            "using_minute_pack": "usersMinutePack" in tariffs_info,
+            "expires_in": expires_in,
+            "message": f"Самокат готов к поездке, данные действительны {expires_in} с"
+        }
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка при подготовке самоката: {str(e)}")
+
 
+# Свежий (без кэша, объединения запросов и запаса последних ответов) GET-запрос к API Whoosh
+# для проверки результата запроса на изменение, ответ на который не был получен
+async def fetch_current_state(url: str) -> Optional[Dict]:
     try:
-        response = await make_request("get", url, params=params)
+        result = await send_request("get", url, None, None, 0, get_request_account())
+    except CircuitOpenError:
+        return None
+    return None if isinstance(result, StaleResponse) else result
 
-        # Проверяем наличие пакета минут
-        if "purchasedMinutePack" in response:
-            minute_pack = response["purchasedMinutePack"]
-            seconds_left = minute_pack.get("secondsLeft", 0)
-            minutes_left = seconds_left // 60
-            seconds_remainder = seconds_left % 60
 
-            return {
-                "has_minute_pack": True,
-                "pack_name": minute_pack.get("annotations", {}).get("packName", ""),
-                "minutes_left": minutes_left,
-                "seconds_left": seconds_left,
-                "formatted_time_left": f"{minutes_left} мин {seconds_remainder} сек",
-                "valid_to": minute_pack.get("validTo", ""),
-                "duration": minute_pack.get("annotations", {}).get("packDuration", "")
-            }
-        else:
-            return {"has_minute_pack": False}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка при получении информации о пакете минут: {str(e)}")
+# Отправляет запрос на начало поездки. Если ответ не получен (таймаут, 5xx), запрос мог выполниться,
+# поэтому он не повторяется: поездка на этом самокате ищется среди активных поездок
+async def send_start_trip(trips_data: Dict) -> Dict:
+    try:
+        return await make_request("post", f"{BASE_URL}/trips", json_data=trips_data)
+    except CircuitOpenError:
+        raise
+    except HTTPException as e:
+        if e.status_code < 500:
+            raise
+        try:
+            active_trips = await fetch_current_state(f"{BASE_URL}/users/logged/active-trips")
+        except HTTPException:
+            raise e
+        for trip in (active_trips or {}).get("trips", []):
+            if trip.get("device", {}).get("code") == trips_data["deviceCode"]:
+                logger.warning("Ответ на начало поездки на самокате %s не получен (%s), но поездка %s активна",
+                               trips_data["deviceCode"], e.detail, trip.get("id"))
+                return {"trip": trip}
+        raise
+
+
+# Отправляет запрос на завершение поездки. Если ответ не получен (таймаут, 5xx), запрос не повторяется:
+# поездка, которая больше не активна, считается завершенным этим запросом
+async def send_trip_completion(trip_id: str, completion_data: Dict) -> Dict:
+    try:
+        return await make_request("post", f"{BASE_URL}/trips/{trip_id}/completion", json_data=completion_data)
+    except CircuitOpenError:
+        raise
+    except HTTPException as e:
+        if e.status_code < 500:
+            raise
+        # 404 от проверки пробрасывается дальше: end_trip считает такую поездку завершенной
+        trip_info = await fetch_current_state(f"{BASE_URL}/trips/active/{trip_id}")
+        trip = (trip_info or {}).get("trip")
+        if trip and trip.get("status") not in (None, "ACTIVE"):
+            logger.warning("Ответ на завершение поездки %s не получен (%s), но поездка уже в статусе %s",
+                           trip_id, e.detail, trip.get("status"))
+            return {"trip": trip}
+        raise
 
 
 # Эндпоинт для старта поездки
-@app.post("/api/start_trip", summary="Начать поездку на самокате")
+@app.post("/api/start_trip", summary="Начать поездку на самокате",
+          response_model=StartTripResponse, response_model_exclude_unset=True)
 async def start_trip(scooter: ScooterCode):
     """
     Начинает поездку на выбранном самокате по его коду.
-    Координаты пользователя уже предустановлены в системе.
+    Координаты пользователя берутся из position, заголовков X-Lat/X-Lng или значений по умолчанию.
     Автоматически использует пакет минут, если он есть.
     """
     try:
-        # Шаг 1: Получаем информацию о самокате по коду
-        device_state_url = f"{BASE_URL}/devices/state"
-        device_params = {
-            "code": scooter.code,
-            "lat": DEFAULT_LAT,
-            "lng": DEFAULT_LNG,
-            "scanType": "MANUAL"
-        }
-
-        device_info = await make_request("get", device_state_url, params=device_params)
+        position = get_rider_position(scooter.position)
 
-        device_id = device_info.get("device", {}).get("id")
-        if not device_id:
-            raise HTTPException(status_code=404, detail="Самокат не найден")
+        # Шаг 1: Получаем id самоката по коду (из кэша, если самокат недавно запрашивали)
+        device_id = await resolve_device_id(scooter.code, position)
 
-        # Шаг 2: Получаем тарифы для самоката
-        tariff_url = f"{BASE_URL}/tariffs/tariff/minute-pack"
-        tariff_params = {"device": device_id}
-
-        tariffs_info = await make_request("get", tariff_url, params=tariff_params)
+        # Шаг 2: Получаем тарифы для самоката (из кэша, пока действителен tariffsToken)
+        tariffs_key = get_tariffs_cache_key(device_id)
+        tariffs_cached = await device_cache.ttl_left(tariffs_key) > 0
+        tariffs_info = await get_device_tariffs(device_id)
 
         # Шаг 3: Формируем запрос на начало поездки
-        trips_url = f"{BASE_URL}/trips"
-
-        # Копируем тарифы из ответа
-        tariffs = tariffs_info.get("tariffs", [])
-
         trips_data = {
             "deviceCode": scooter.code,
             "startTripType": "MANUAL",
             "insuranceRequired": False,
-            "position": {
-                "lat": DEFAULT_LAT,
-                "lng": DEFAULT_LNG
-            },
-            "tariffs": tariffs,
+            "position": position.dict(),
+            # Копируем тарифы из ответа
+            "tariffs": tariffs_info.get("tariffs", []),
             "tariffsToken": tariffs_info.get("tariffsToken", ""),
             "debugData": {
                 "sourceType": "trip_device_bs_center_button",
@@ -290,7 +2697,23 @@ async def start_trip(scooter: ScooterCode):
         }
 
         # Шаг 4: Отправляем запрос на начало поездки
-        trip_response = await make_request("post", trips_url, json_data=trips_data)
+        try:
+            trip_response = await send_start_trip(trips_data)
+        except HTTPException as e:
+            if not tariffs_cached or not 400 <= e.status_code < 500 or e.status_code in (401, 404, 429):
+                raise
+            # Тарифы из кэша могли устареть раньше срока: запрашиваем свежие и повторяем один раз
+            logger.info("Тарифы из кэша для самоката %s отклонены, запрашиваем заново", scooter.code)
+            tariffs_info = await get_device_tariffs(device_id, refresh=True)
+            trips_data["tariffs"] = tariffs_info.get("tariffs", [])
+            trips_data["tariffsToken"] = tariffs_info.get("tariffsToken", "")
+            trips_data["debugData"]["uuid"] = str(uuid.uuid4())
+            trip_response = await send_start_trip(trips_data)
+        finally:
+            invalidate_account_cache()
+
+        # tariffsToken использован для начала поездки, повторно его не отдаем
+        await device_cache.discard(tariffs_key)
 
         if "trip" not in trip_response:
             raise HTTPException(status_code=500, detail="Не удалось начать поездку: " + str(trip_response))
@@ -300,6 +2723,9 @@ async def start_trip(scooter: ScooterCode):
 
         # Проверяем, использовался ли пакет минут
         has_minute_pack = "usersMinutePack" in tariffs_info
+        if has_minute_pack:
+            # Во время поездки пакет расходуется: следим за моментом, когда закончатся минуты
+            set_minute_pack_riding(True)
 
         return {
             "success": True,
@@ -319,14 +2745,19 @@ async def start_trip(scooter: ScooterCode):
 
 
 # Эндпоинт для получения информации о текущей поездке
-@app.get("/api/trip_info", summary="Получить информацию о текущей поездке")
-async def get_trip_info(trip_id: Optional[str] = Query(None, description="ID поездки (если известен)")):
+@app.get("/api/trip_info", summary="Получить информацию о текущей поездке",
+         response_model=TripInfoResponse, response_model_exclude_unset=True)
+async def get_trip_info(
+        trip_id: Optional[str] = Query(None, description="ID поездки (если известен)"),
+        include_route: bool = Query(False, description="Добавить в ответ маршрут поездки")
+):
     """
     Возвращает информацию о текущей поездке, включая:
     - Время поездки
     - Пройденное расстояние
     - Текущую стоимость
     - Информацию о самокате
+    - Маршрут поездки (только при include_route=true)
     """
     try:
         # Если ID поездки не указан, получаем активные поездки
@@ -341,18 +2772,29 @@ async def get_trip_info(trip_id: Optional[str] = Query(None, description="ID п
             # Берем первую активную поездку
             trip_id = trips[0].get("id")
 
-        # Получаем детальную информацию о поездке
+        # Получаем детальную информацию о поездке и, если нужно, маршрут - параллельно
         trip_url = f"{BASE_URL}/trips/active/{trip_id}"
-        trip_info = await make_request("get", trip_url)
-
-        # Получаем информацию о маршруте
-        route_url = f"{BASE_URL}/trips/{trip_id}/route"
-        route_info = await make_request("get", route_url)
+        route_info = None
+
+        if include_route:
+            route_url = f"{BASE_URL}/trips/{trip_id}/route"
+            trip_info, route_info = await gather_requests(
+                make_request("get", trip_url),
+                make_request("get", route_url)
+            )
+            if isinstance(trip_info, Exception):
+                raise trip_info
+            if isinstance(route_info, Exception):
+                # Маршрут не обязателен: отдаем информацию о поездке без него
+                logger.warning("Ошибка при получении маршрута поездки %s: %s", trip_id, route_info)
+                route_info = None
+        else:
+            trip_info = await make_request("get", trip_url)
 
         # Форматируем и возвращаем данные в удобном виде
         trip = trip_info.get("trip", {})
 
-        return {
+        result = {
             "active_trip": True,
             "trip_id": trip_id,
             "duration": trip.get("duration", {}).get("amount", 0),
@@ -364,6 +2806,10 @@ async def get_trip_info(trip_id: Optional[str] = Query(None, description="ID п
             "speed_mode": trip.get("device", {}).get("state", {}).get("speedMode", {}).get("current", "NORMAL"),
             "coordinates": trip.get("device", {}).get("state", {}).get("position", {}).get("point", {})
         }
+        if include_route:
+            result["route"] = route_info
+
+        return result
 
     except HTTPException as e:
         raise e
@@ -371,12 +2817,813 @@ async def get_trip_info(trip_id: Optional[str] = Query(None, description="ID п
         raise HTTPException(status_code=500, detail=f"Ошибка при получении информации о поездке: {str(e)}")
 
 
+# Формат маршрута в ответе Whoosh не документирован, поэтому ищем в нем список точек:
+# {"lat", "lng"}, {"latitude", "longitude"}, {"point": {...}} или GeoJSON-координаты [lng, lat]
+def extract_route_points(data: Any) -> np.ndarray:
+    if isinstance(data, dict):
+        for key in ("route", "points", "path", "track", "geometry", "coordinates"):
+            if key in data:
+                points = extract_route_points(data[key])
+                if len(points):
+                    return points
+        return np.empty((0, 2))
+
+    if isinstance(data, list) and data:
+        first = data[0]
+        if isinstance(first, dict):
+            points = []
+            for item in data:
+                point = item.get("point", item)
+                lat = point.get("lat", point.get("latitude"))
+                lng = point.get("lng", point.get("longitude"))
+                if lat is not None and lng is not None:
+                    points.append((lat, lng))
+            return np.array(points, dtype=float).reshape(-1, 2)
+        if isinstance(first, (list, tuple)) and len(first) >= 2:
+            coordinates = np.array([item[:2] for item in data], dtype=float)
+            return coordinates[:, ::-1]
+
+    return np.empty((0, 2))
+
+
+def simplify_route(points: np.ndarray, max_points: Optional[int] = None, tolerance: Optional[float] = None) -> np.ndarray:
+    """
+    Упрощение маршрута алгоритмом Дугласа-Пекера с очередью по приоритету.
+    Отрезки разбиваются в порядке убывания отклонения (в метрах) самой дальней от них точки,
+    пока не набрано max_points точек или пока отклонение не стало меньше tolerance.
+    Поэтому работа пропорциональна размеру результата, а не длине исходного маршрута.
+    Первая и последняя точки остаются всегда.
+    """
+    count = len(points)
+    if count <= 2 or (max_points is None and tolerance is None):
+        return points
+
+    # Локальная проекция в метры: для маршрута одной поездки искажения пренебрежимы
+    lat0 = math.radians(float(points[:, 0].mean()))
+    xy = np.radians(points[:, ::-1]) * (EARTH_RADIUS_KM * 1000)
+    xy[:, 0] *= math.cos(lat0)
+
+    def push(start: int, end: int, parent: float):
+        if end - start < 2:
+            return
+        inner = xy[start + 1:end]
+        a = xy[start]
+        ab = xy[end] - a
+        length2 = float(ab @ ab)
+        if length2 > 0:
+            t = np.clip((inner - a) @ ab / length2, 0.0, 1.0)
+            offsets = inner - (a + t[:, None] * ab)
+        else:
+            offsets = inner - a
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        farthest = int(distances.argmax())
+        # Отклонение не больше, чем у родительского отрезка, чтобы точки выбирались по убыванию
+        heapq.heappush(heap, (-min(float(distances[farthest]), parent), start, end, start + 1 + farthest))
+
+    heap = []
+    keep = [0, count - 1]
+    limit = max_points if max_points is not None else count
+    push(0, count - 1, math.inf)
+    while heap and len(keep) < limit:
+        deviation, start, end, index = heapq.heappop(heap)
+        if tolerance is not None and -deviation <= tolerance:
+            break
+        keep.append(index)
+        push(start, index, -deviation)
+        push(index, end, -deviation)
+
+    return points[np.sort(keep)]
+
+
+# Координаты в целых числах (градусы * 10^precision): первая точка абсолютная, остальные - разность с предыдущей
+def get_route_deltas(points: np.ndarray, precision: int) -> np.ndarray:
+    scaled = np.round(points * 10 ** precision).astype(np.int64)
+    return np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+
+# Google Encoded Polyline из разностей координат
+def encode_polyline(deltas: np.ndarray) -> str:
+    chars = []
+    for value in deltas.ravel().tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return "".join(chars)
+
+
+async def stream_route(header: Dict, deltas: np.ndarray, encoding: str):
+    # Тот же JSON, что и без потока, но поле с координатами выдается частями
+    yield orjson.dumps(header)[:-1]
+    chunks = range(0, len(deltas), ROUTE_STREAM_CHUNK)
+    if encoding == "polyline":
+        yield b',"polyline":"'
+        for start in chunks:
+            # В polyline встречается только один символ, который нужно экранировать в JSON, - обратная косая черта
+            yield encode_polyline(deltas[start:start + ROUTE_STREAM_CHUNK]).replace("\\", "\\\\").encode()
+            await asyncio.sleep(0)
+        yield b'"}'
+        return
+
+    for axis, name in enumerate(("lat", "lng")):
+        yield f',"{name}":['.encode()
+        for start in chunks:
+            values = deltas[start:start + ROUTE_STREAM_CHUNK, axis].tolist()
+            yield (b"," if start else b"") + ",".join(map(str, values)).encode()
+            await asyncio.sleep(0)
+        yield b"]"
+    yield b"}"
+
+
+# Эндпоинт для получения маршрута поездки в компактном виде
+@app.get("/api/trip_route/{trip_id}", summary="Маршрут поездки",
+         response_model=TripRouteResponse, response_model_exclude_unset=True)
+async def get_trip_route(
+        trip_id: str,
+        encoding: str = Query("polyline", pattern="^(polyline|delta)$", description="polyline или delta"),
+        precision: int = Query(5, ge=5, le=6, description="Знаков после запятой в координатах"),
+        max_points: Optional[int] = Query(None, ge=2, description="Упростить маршрут до указанного числа точек"),
+        tolerance: Optional[float] = Query(None, gt=0, description="Упростить маршрут с допуском в метрах")
+):
+    """
+    Возвращает маршрут поездки в компактном виде:
+    - polyline - строка в формате Google Encoded Polyline
+    - delta - массивы lat и lng из целых чисел (координата * 10^precision), каждое число кроме первого - разность с предыдущим
+    Маршрут можно упростить алгоритмом Дугласа-Пекера до max_points точек и/или с допуском tolerance метров.
+    Длинные маршруты отдаются потоком, ответы сжимаются gzip.
+    """
+    try:
+        route_data = await make_request("get", f"{BASE_URL}/trips/{trip_id}/route")
+        points = extract_route_points(route_data)
+        simplified = simplify_route(points, max_points, tolerance)
+        deltas = get_route_deltas(simplified, precision)
+
+        header = {
+            "trip_id": trip_id,
+            "encoding": encoding,
+            "precision": precision,
+            "points_count": len(simplified),
+            "original_points_count": len(points)
+        }
+        if len(simplified) > ROUTE_STREAM_THRESHOLD:
+            return StreamingResponse(stream_route(header, deltas, encoding), media_type="application/json")
+
+        if encoding == "polyline":
+            return {**header, "polyline": encode_polyline(deltas)}
+        return {**header, "lat": deltas[:, 0].tolist(), "lng": deltas[:, 1].tolist()}
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении маршрута поездки: {str(e)}")
+
+
+class TripPoller:
+    """
+    Один фоновый опрос API Whoosh на аккаунт, регион и поездку, общий для всех подписчиков.
+    Событие рассылается подписчикам только если данные изменились с прошлого опроса.
+    """
+
+    def __init__(self, account_id: str, region_id: str, trip_id: Optional[str]):
+        self.key = (account_id, region_id, trip_id)
+        self.account_id = account_id
+        self.region_id = region_id
+        self.trip_id = trip_id
+        self.subscribers = set()
+        self.last_payloads: Dict[str, str] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=TRIP_STREAM_QUEUE_SIZE)
+        # Новый подписчик сразу получает последнее известное состояние
+        for event, payload in self.last_payloads.items():
+            queue.put_nowait((event, payload))
+        self.subscribers.add(queue)
+
+        if self.task is None:
+            # Опрос не привязан к запросу первого подписчика: аккаунт и регион задаются в run
+            self.task = asyncio.create_task(self.run(), context=Context())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            trip_pollers.pop(self.key, None)
+            if self.task is not None:
+                self.task.cancel()
+
+    async def run(self):
+        current_account_id.set(self.account_id)
+        current_region_id.set(self.region_id)
+        next_minute_pack_poll = 0.0
+        while True:
+            await self.poll("trip", get_trip_info(trip_id=self.trip_id, include_route=False))
+
+            if time.monotonic() >= next_minute_pack_poll:
+                await self.poll("minute_pack", get_minute_pack())
+                next_minute_pack_poll = time.monotonic() + TRIP_STREAM_MINUTE_PACK_INTERVAL
+
+            await asyncio.sleep(TRIP_STREAM_INTERVAL)
+
+    async def poll(self, event: str, coro):
+        try:
+            data = await coro
+        except Exception as e:
+            # Как и клиент при опросе, при ошибке оставляем прежнее состояние
+            logger.warning("Ошибка при опросе %s для потока %s: %s", event, self.key, e)
+            return
+
+        payload = orjson.dumps(data).decode()
+        if payload == self.last_payloads.get(event):
+            return
+        self.last_payloads[event] = payload
+
+        for queue in self.subscribers:
+            # Медленный подписчик теряет самые старые события, а не тормозит остальных
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((event, payload))
+
+
+# Активные опросы: (аккаунт, регион, id поездки) -> TripPoller
+trip_pollers: Dict[tuple, TripPoller] = {}
+
+
+# Эндпоинт для получения обновлений поездки через Server-Sent Events
+@app.get("/api/trip_stream", summary="Поток обновлений поездки (SSE)")
+async def trip_stream(
+        request: Request,
+        trip_id: Optional[str] = Query(None, description="ID поездки (если не указан - текущая активная поездка)")
+):
+    """
+    Отправляет события в формате Server-Sent Events:
+    - trip - то же, что возвращает /api/trip_info
+    - minute_pack - то же, что возвращает /api/minute_pack
+
+    События приходят только при изменении данных. Все клиенты одного аккаунта и региона
+    используют один общий опрос API Whoosh, поэтому нагрузка на API зависит
+    от количества активных поездок, а не от количества открытых клиентов.
+    """
+    poller = TripPoller(get_request_account().id, get_request_region_id(), trip_id)
+    poller = trip_pollers.setdefault(poller.key, poller)
+    queue = poller.subscribe()
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event, payload = await asyncio.wait_for(queue.get(), TRIP_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE, чтобы прокси не закрывали простаивающее соединение
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {payload}\n\n"
+        finally:
+            poller.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+class ExpiryScheduler:
+    """
+    Таймеры на сроки бронирований и пакетов минут в одной куче (heapq): добавление
+    и срабатывание таймера стоят O(log n), отмена - O(1) (запись в куче просто
+    перестает совпадать с актуальным таймером и пропускается). Один фоновый цикл
+    спит до ближайшего срока, поэтому тысячи таймеров не требуют ни опроса API,
+    ни отдельной задачи на каждый таймер.
+    """
+
+    DONE_MAX_ENTRIES = 10000
+    # Сроки, вычисленные из secondsLeft, от опроса к опросу сдвигаются на секунду-другую:
+    # такие сдвиги не перезапускают таймер (и не дублируют уже отправленное предупреждение)
+    TOLERANCE = 5
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        # key -> (срок в секундах Unix, номер записи в куче, callback, контекст)
+        self._timers: Dict[tuple, tuple] = {}
+        # Уже сработавшие таймеры: повторный schedule с тем же сроком их не перезапускает
+        self._done: OrderedDict = OrderedDict()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._callbacks = set()
+
+    def schedule(self, key: tuple, when: float, callback):
+        """
+        Ставит (или переносит) таймер key на момент when (секунды Unix). callback - функция
+        без аргументов, возвращающая корутину; она выполняется с тем же аккаунтом
+        и регионом, что и вызов schedule.
+        """
+        current = self._timers.get(key)
+        done = self._done.get(key)
+        if current is not None and abs(current[0] - when) <= self.TOLERANCE:
+            return
+        if done is not None and abs(done - when) <= self.TOLERANCE:
+            return
+        self._done.pop(key, None)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(0.0, when - time.time())
+        seq = next(self._seq)
+        self._timers[key] = (when, seq, callback, copy_context())
+        heapq.heappush(self._heap, (deadline, seq, key))
+
+        # Отмененные записи остаются в куче до извлечения: не даем им накапливаться
+        if len(self._heap) > 2 * len(self._timers) + 64:
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        elif self._heap[0][1] == seq:
+            # Новый таймер раньше всех остальных - будим цикл, чтобы он пересчитал время сна
+            self._wakeup.set()
+
+    def cancel(self, key: tuple):
+        self._timers.pop(key, None)
+        self._done.pop(key, None)
+
+    def _is_current(self, entry: tuple) -> bool:
+        timer = self._timers.get(entry[2])
+        return timer is not None and timer[1] == entry[1]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            delay = None
+            while self._heap:
+                entry = self._heap[0]
+                if not self._is_current(entry):
+                    heapq.heappop(self._heap)
+                    continue
+                delay = entry[0] - loop.time()
+                if delay > 0:
+                    break
+                heapq.heappop(self._heap)
+                self._fire(entry[2])
+                delay = None
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, key: tuple):
+        when, _, callback, context = self._timers.pop(key)
+        self._done[key] = when
+        while len(self._done) > self.DONE_MAX_ENTRIES:
+            self._done.popitem(last=False)
+
+        task = asyncio.create_task(self._run_callback(key, callback), context=context)
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    @staticmethod
+    async def _run_callback(key: tuple, callback):
+        try:
+            await callback()
+        except Exception as e:
+            logger.error("Ошибка при обработке таймера %s: %s", key, e)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+expiry_scheduler = ExpiryScheduler()
+
+# Подписчики /api/events: аккаунт -> очереди событий
+event_subscribers: Dict[str, set] = {}
+
+
+# Рассылаем событие подписчикам аккаунта и, если задан WHOOSH_WEBHOOK_URL, на вебхук
+async def publish_event(event: str, data: Dict):
+    account_id = get_request_account().id
+    payload = orjson.dumps({
+        "event": event,
+        "account_id": account_id,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "data": data
+    }).decode()
+    SCHEDULED_EVENTS.labels(event).inc()
+
+    for queue in event_subscribers.get(account_id, ()):
+        # Медленный подписчик теряет самые старые события, а не тормозит остальных
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait((event, payload))
+
+    if WEBHOOK_URL and http_client is not None:
+        try:
+            response = await http_client.post(
+                WEBHOOK_URL, content=payload, headers={"Content-Type": "application/json"}, timeout=WEBHOOK_TIMEOUT
+            )
+            response.raise_for_status()
+            WEBHOOK_DELIVERIES.labels("success").inc()
+        except Exception as e:
+            WEBHOOK_DELIVERIES.labels("error").inc()
+            logger.warning("Ошибка при отправке события %s на вебхук: %s", event, e)
+
+
+# Ставим таймер предупреждения (за EXPIRY_WARNING_SECONDS до срока) и таймер самого срока
+def schedule_expiry(key: tuple, expires_at: float, on_warning, on_expired):
+    expiry_scheduler.schedule(key + ("warning",), expires_at - EXPIRY_WARNING_SECONDS, on_warning)
+    expiry_scheduler.schedule(key + ("expired",), expires_at, on_expired)
+
+
+def cancel_expiry(key: tuple):
+    expiry_scheduler.cancel(key + ("warning",))
+    expiry_scheduler.cancel(key + ("expired",))
+
+
+# Следим за сроком бронирования (expiresAt из ответа Whoosh)
+def track_reservation(reservation_id: Optional[str], expires_at: Optional[str], scooter_code: Optional[str] = None):
+    if not reservation_id or not expires_at:
+        return
+    try:
+        expires_ts = to_timestamp(datetime.fromisoformat(expires_at))
+    except (TypeError, ValueError):
+        logger.warning("Не удалось разобрать срок бронирования %s: %s", reservation_id, expires_at)
+        return
+
+    data = {"reservation_id": reservation_id, "scooter_code": scooter_code, "expires_at": expires_at}
+
+    async def on_warning():
+        await publish_event("reservation_expiring", {**data, "seconds_left": max(0, round(expires_ts - time.time()))})
+
+    async def on_expired():
+        # Бронирование сгорело - закэшированные данные аккаунта больше не актуальны
+        invalidate_account_cache()
+        await publish_event("reservation_expired", data)
+
+    schedule_expiry(("reservation", get_request_account().id, reservation_id), expires_ts, on_warning, on_expired)
+
+
+def untrack_reservation(reservation_id: Optional[str]):
+    if reservation_id:
+        cancel_expiry(("reservation", get_request_account().id, reservation_id))
+
+
+# Последнее известное состояние пакета минут: (аккаунт, регион) -> secondsLeft, когда получен, идет ли поездка
+minute_pack_watch: Dict[tuple, Dict[str, Any]] = {}
+
+
+# Следим за сроком действия пакета минут (validTo) и, пока идет поездка, за остатком минут (secondsLeft)
+# observed_at - когда пакет был получен от API Whoosh (для ответа из кэша - время исходного ответа)
+def track_minute_pack(minute_pack: Optional[Dict], observed_at: Optional[float] = None):
+    key = ("minute_pack", get_request_account().id, get_request_region_id())
+    if not minute_pack:
+        cancel_expiry(key + ("valid_to",))
+        cancel_expiry(key + ("seconds_left",))
+        minute_pack_watch.pop(key, None)
+        return
+
+    state = minute_pack_watch.setdefault(key, {"riding": False})
+    state["seconds_left"] = minute_pack.get("secondsLeft", 0)
+    state["observed_at"] = observed_at if observed_at is not None else time.time()
+
+    valid_to = minute_pack.get("validTo")
+    try:
+        valid_to_ts = to_timestamp(datetime.fromisoformat(valid_to)) if valid_to else None
+    except (TypeError, ValueError):
+        logger.warning("Не удалось разобрать срок действия пакета минут: %s", valid_to)
+        valid_to_ts = None
+    if valid_to_ts is not None:
+        schedule_expiry(
+            key + ("valid_to",), valid_to_ts,
+            lambda: publish_event("minute_pack_expiring", {
+                "valid_to": valid_to, "seconds_left": max(0, round(valid_to_ts - time.time()))
+            }),
+            lambda: refresh_minute_pack("minute_pack_expired")
+        )
+
+    schedule_minute_pack_depletion(key, state)
+
+
+def schedule_minute_pack_depletion(key: tuple, state: Dict[str, Any]):
+    # Вне поездки минуты не расходуются (а закончившимся пакетом они не расходуются вовсе),
+    # и таймер на их окончание не нужен
+    if not state.get("riding") or state.get("seconds_left", 0) <= 0:
+        cancel_expiry(key + ("seconds_left",))
+        return
+
+    depleted_at = state["observed_at"] + state["seconds_left"]
+    schedule_expiry(
+        key + ("seconds_left",), depleted_at,
+        lambda: publish_event("minute_pack_depleting", {"seconds_left": max(0, round(depleted_at - time.time()))}),
+        lambda: refresh_minute_pack("minute_pack_depleted")
+    )
+
+
+def set_minute_pack_riding(riding: bool):
+    key = ("minute_pack", get_request_account().id, get_request_region_id())
+    state = minute_pack_watch.setdefault(key, {"riding": False})
+    state["riding"] = riding
+    schedule_minute_pack_depletion(key, state)
+
+
+# Срок наступил: сбрасываем кэш, получаем актуальный пакет минут (он же перезапустит таймеры) и рассылаем событие
+async def refresh_minute_pack(event: str):
+    response_cache.invalidate(get_request_account().id, ["/user-minute-pack/info"])
+    await publish_event(event, await get_minute_pack())
+
+
+# Эндпоинт для получения событий о сроках бронирований и пакетов минут через Server-Sent Events
+@app.get("/api/events", summary="Поток событий о сроках бронирований и пакетов минут (SSE)")
+async def events_stream(request: Request):
+    """
+    Отправляет события в формате Server-Sent Events:
+    - reservation_expiring / reservation_expired - бронирование скоро истечет / истекло
+    - minute_pack_expiring / minute_pack_expired - срок действия пакета минут скоро закончится / закончился
+    - minute_pack_depleting / minute_pack_depleted - во время поездки скоро закончатся / закончились минуты пакета
+
+    Предупреждения приходят за WHOOSH_EXPIRY_WARNING_SECONDS секунд до срока. Сроки
+    отслеживаются для бронирований и пакетов минут, полученных через этот сервер.
+    """
+    account_id = get_request_account().id
+    queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    event_subscribers.setdefault(account_id, set()).add(queue)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event, payload = await asyncio.wait_for(queue.get(), TRIP_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {payload}\n\n"
+        finally:
+            subscribers = event_subscribers.get(account_id, set())
+            subscribers.discard(queue)
+            if not subscribers:
+                event_subscribers.pop(account_id, None)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+class TripHistoryStore:
+    """
+    История завершенных поездок в SQLite в режиме WAL (чтение не блокируется записью).
+    end_trip только кладет поездку в очередь, а пишет ее на диск отдельный поток пачками,
+    поэтому ответ клиенту не ждет диска. Чтение выполняется в пуле потоков asyncio,
+    у каждого потока свое соединение.
+    """
+
+    COLUMNS = (
+        "trip_id", "account_id", "device_code", "device_id", "region_id", "finished_at",
+        "duration", "distance", "final_cost", "end_lat", "end_lng", "parking_id"
+    )
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS trips (
+            trip_id TEXT PRIMARY KEY,
+            account_id TEXT NOT NULL,
+            device_code TEXT,
+            device_id TEXT,
+            region_id TEXT,
+            finished_at REAL NOT NULL,
+            duration REAL,
+            distance REAL,
+            final_cost REAL,
+            end_lat REAL,
+            end_lng REAL,
+            parking_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS trips_account_finished ON trips (account_id, finished_at, trip_id);
+        CREATE INDEX IF NOT EXISTS trips_account_device_finished ON trips (account_id, device_code, finished_at, trip_id);
+    """
+    # Группировка агрегатов по периодам (в UTC)
+    PERIOD_FORMATS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+    WRITE_BATCH_SIZE = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def start(self):
+        if self._writer is not None:
+            return
+        connection = self._connect()
+        connection.executescript(self.SCHEMA)
+        connection.close()
+        self._writer = threading.Thread(target=self._write_loop, name="trip-history-writer", daemon=True)
+        self._writer.start()
+
+    def stop(self, timeout: float = 5):
+        # Дописываем то, что уже в очереди, и останавливаем поток записи
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join(timeout)
+        self._writer = None
+
+    def record(self, trip: Dict):
+        self._queue.put_nowait(trip)
+
+    def _write_loop(self):
+        connection = self._connect()
+        insert = (
+            f"INSERT OR REPLACE INTO trips ({', '.join(self.COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in self.COLUMNS)})"
+        )
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = [tuple(trip.get(column) for column in self.COLUMNS) for trip in batch if trip is not None]
+            if rows:
+                try:
+                    with connection:
+                        connection.executemany(insert, rows)
+                except sqlite3.Error as e:
+                    logger.error("Ошибка при записи истории поездок: %s", e)
+
+            if None in batch:
+                connection.close()
+                return
+
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    @staticmethod
+    def _filters(account_id: str, date_from: Optional[float], date_to: Optional[float], device_code: Optional[str]) -> tuple:
+        where = ["account_id = ?"]
+        args: List[Any] = [account_id]
+        if device_code:
+            where.append("device_code = ?")
+            args.append(device_code)
+        if date_from is not None:
+            where.append("finished_at >= ?")
+            args.append(date_from)
+        if date_to is not None:
+            where.append("finished_at < ?")
+            args.append(date_to)
+        return where, args
+
+    # Страница поездок от новых к старым; cursor - (finished_at, trip_id) последней поездки предыдущей страницы
+    def query(
+            self,
+            account_id: str,
+            date_from: Optional[float] = None,
+            date_to: Optional[float] = None,
+            device_code: Optional[str] = None,
+            cursor: Optional[tuple] = None,
+            limit: int = TRIP_HISTORY_PAGE_SIZE
+    ) -> List[Dict]:
+        where, args = self._filters(account_id, date_from, date_to, device_code)
+        if cursor is not None:
+            where.append("(finished_at, trip_id) < (?, ?)")
+            args.extend(cursor)
+        rows = self._reader().execute(
+            f"SELECT * FROM trips WHERE {' AND '.join(where)} ORDER BY finished_at DESC, trip_id DESC LIMIT ?",
+            (*args, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def aggregate(
+            self,
+            account_id: str,
+            period: str,
+            date_from: Optional[float] = None,
+            date_to: Optional[float] = None,
+            device_code: Optional[str] = None
+    ) -> List[Dict]:
+        where, args = self._filters(account_id, date_from, date_to, device_code)
+        rows = self._reader().execute(
+            f"""
+            SELECT strftime(?, finished_at, 'unixepoch') AS period,
+                   COUNT(*) AS trips,
+                   COALESCE(SUM(final_cost), 0) AS total_cost,
+                   COALESCE(SUM(duration), 0) / 60.0 AS total_minutes,
+                   COALESCE(SUM(distance), 0) AS total_distance
+            FROM trips WHERE {' AND '.join(where)}
+            GROUP BY period ORDER BY period DESC
+            """,
+            (self.PERIOD_FORMATS[period], *args)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+trip_history = TripHistoryStore(TRIP_HISTORY_DB)
+
+
+def encode_history_cursor(trip: Dict) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps([trip["finished_at"], trip["trip_id"]])).decode()
+
+
+def decode_history_cursor(cursor: str) -> tuple:
+    try:
+        finished_at, trip_id = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(finished_at), str(trip_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+
+
+# Дата из запроса в секундах Unix; дата без часового пояса считается UTC
+def to_timestamp(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+# Эндпоинт истории поездок
+@app.get("/api/trips/history", summary="История завершенных поездок",
+         response_model=TripHistoryResponse, response_model_exclude_unset=True)
+async def get_trip_history(
+        date_from: Optional[datetime] = Query(None, description="Начало периода (включительно)"),
+        date_to: Optional[datetime] = Query(None, description="Конец периода (не включительно)"),
+        device_code: Optional[str] = Query(None, description="Код самоката"),
+        cursor: Optional[str] = Query(None, description="next_cursor из предыдущей страницы"),
+        limit: int = Query(TRIP_HISTORY_PAGE_SIZE, ge=1, le=TRIP_HISTORY_MAX_PAGE_SIZE),
+        period: str = Query("month", pattern="^(day|week|month)$", description="Период для агрегатов: day, week или month")
+):
+    """
+    Возвращает завершенные через этот сервер поездки текущего аккаунта, от новых к старым.
+    Постраничная выдача по курсору: следующая страница запрашивается с cursor=next_cursor.
+    На первой странице (без cursor) дополнительно возвращаются агрегаты по всему отобранному
+    периоду: число поездок, сумма, минуты и расстояние - всего и по дням, неделям или месяцам.
+    """
+    account_id = get_request_account().id
+    start = to_timestamp(date_from)
+    end = to_timestamp(date_to)
+    after = decode_history_cursor(cursor) if cursor else None
+
+    try:
+        trips = await asyncio.to_thread(trip_history.query, account_id, start, end, device_code, after, limit)
+        periods = None
+        if after is None:
+            periods = await asyncio.to_thread(trip_history.aggregate, account_id, period, start, end, device_code)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка при чтении истории поездок: {str(e)}")
+
+    result = {
+        "trips": [
+            {
+                "trip_id": trip["trip_id"],
+                "finished_at": datetime.fromtimestamp(trip["finished_at"], timezone.utc).isoformat(),
+                "device_code": trip["device_code"],
+                "device_id": trip["device_id"],
+                "region_id": trip["region_id"],
+                "duration": trip["duration"],
+                "distance": trip["distance"],
+                "final_cost": trip["final_cost"],
+                "end_coordinates": {"lat": trip["end_lat"], "lng": trip["end_lng"]} if trip["end_lat"] is not None else None,
+                "parking_id": trip["parking_id"]
+            }
+            for trip in trips
+        ],
+        "next_cursor": encode_history_cursor(trips[-1]) if len(trips) == limit else None
+    }
+    if periods is not None:
+        result["aggregates"] = {
+            "period": period,
+            "trips": sum(row["trips"] for row in periods),
+            "total_cost": sum(row["total_cost"] for row in periods),
+            "total_minutes": round(sum(row["total_minutes"] for row in periods), 2),
+            "total_distance": sum(row["total_distance"] for row in periods),
+            "periods": [{**row, "total_minutes": round(row["total_minutes"], 2)} for row in periods]
+        }
+    return result
+
+
 # Исправленный эндпоинт для завершения поездки
-@app.post("/api/end_trip", summary="Завершить поездку")
+@app.post("/api/end_trip", summary="Завершить поездку",
+          response_model=EndTripResponse, response_model_exclude_unset=True)
 async def end_trip(request: EndTripRequest):
     """
-    Завершает текущую поездку с фиксированными координатами
-    и возвращает итоговую информацию о поездке.
+    Завершает текущую поездку и возвращает итоговую информацию о поездке.
+    Координаты райдера (position или X-Lat/X-Lng) притягиваются к ближайшей известной парковке;
+    без координат используются фиксированные END_COORDINATES.
     """
     try:
         # Сначала проверяем, не завершена ли уже поездка
@@ -386,7 +3633,7 @@ async def end_trip(request: EndTripRequest):
 
             # Если поездка не активна или не найдена, значит она уже завершена
             if "error" in trip_info or trip_info.get("trip", {}).get("status") != "ACTIVE":
-                logger.info(f"Поездка {request.trip_id} уже не активна")
+                logger.info("Поездка %s уже не активна", request.trip_id)
 
                 # Возвращаем успешный результат, так как поездка уже завершена
                 return {
@@ -402,29 +3649,32 @@ async def end_trip(request: EndTripRequest):
                 }
         except Exception as check_error:
             # Если возникла ошибка при проверке, продолжаем с попыткой завершения
-            logger.warning(f"Ошибка при проверке статуса поездки: {str(check_error)}")
+            logger.warning("Ошибка при проверке статуса поездки: %s", check_error)
 
         # Данные для завершения поездки
+        end_position, parking = get_trip_end_position(request.position)
         completion_data = {
             "completeOutsideParking": False,
-            "coordinate": END_COORDINATES,
+            "coordinate": end_position.dict(),
             "payWithScore": False
         }
 
-        logger.info(f"Отправка запроса на завершение поездки {request.trip_id}")
+        logger.info("Отправка запроса на завершение поездки %s", request.trip_id)
 
-        # Запрос на завершение поездки
-        completion_url = f"{BASE_URL}/trips/{request.trip_id}/completion"
-        completion_response = await make_request("post", completion_url, json_data=completion_data)
+        # Завершение не отменяется по таймауту: отправленный запрос проверяется в send_trip_completion
+        try:
+            completion_response = await send_trip_completion(request.trip_id, completion_data)
+        finally:
+            invalidate_account_cache()
 
-        logger.info(f"Получен ответ от API Whoosh: {completion_response}")
+        log_payload("/api/end_trip", "Получен ответ от API Whoosh: %s", completion_response)
 
         trip = completion_response.get("trip", {})
 
         # Проверяем статус поездки в ответе
         trip_status = trip.get("status")
         if trip_status != "COMPLETED":
-            logger.error(f"Неожиданный статус поездки: {trip_status}")
+            logger.error("Неожиданный статус поездки: %s", trip_status)
             # Не выбрасываем исключение, а возвращаем статус с информацией об ошибке
             return {
                 "success": False,
@@ -433,23 +3683,40 @@ async def end_trip(request: EndTripRequest):
                 "status": trip_status
             }
 
-        # Получаем информацию о пакете минут после поездки
-        try:
-            minute_pack_url = f"{BASE_URL}/user-minute-pack/info"
-            minute_pack_params = {"regionId": REGION_ID}
+        # Информация о пакете минут после поездки
+        has_minute_pack = False
+        minutes_left = 0
 
+        # Поездка завершена - минуты пакета больше не расходуются
+        set_minute_pack_riding(False)
+        # Остаток пакета запрашиваем после завершения, чтобы в нем уже были списаны минуты поездки
+        minute_pack_url = f"{BASE_URL}/user-minute-pack/info"
+        minute_pack_params = {"regionId": get_request_region_id()}
+        try:
             minute_pack_info = await make_request("get", minute_pack_url, params=minute_pack_params)
-
-            has_minute_pack = "purchasedMinutePack" in minute_pack_info
-            minutes_left = 0
-
-            if has_minute_pack:
+        except Exception as e:
+            logger.error("Ошибка при получении информации о пакете минут: %s", e)
+        else:
+            track_minute_pack(minute_pack_info.get("purchasedMinutePack"), get_fetched_at(minute_pack_info))
+            if "purchasedMinutePack" in minute_pack_info:
+                has_minute_pack = True
                 seconds_left = minute_pack_info["purchasedMinutePack"].get("secondsLeft", 0)
                 minutes_left = seconds_left // 60
-        except Exception as minute_pack_error:
-            logger.error(f"Ошибка при получении информации о пакете минут: {str(minute_pack_error)}")
-            has_minute_pack = False
-            minutes_left = 0
+
+        trip_history.record({
+            "trip_id": request.trip_id,
+            "account_id": get_request_account().id,
+            "device_code": trip.get("device", {}).get("code"),
+            "device_id": trip.get("device", {}).get("id"),
+            "region_id": get_request_region_id(),
+            "finished_at": time.time(),
+            "duration": trip.get("duration", {}).get("amount", 0),
+            "distance": trip.get("distance", {}).get("amount", 0),
+            "final_cost": trip.get("accruedPricing", {}).get("price", {}).get("amount", 0),
+            "end_lat": end_position.lat,
+            "end_lng": end_position.lng,
+            "parking_id": parking.get("id") if parking else None
+        })
 
         # Успешный ответ
         return {
@@ -464,12 +3731,14 @@ async def end_trip(request: EndTripRequest):
                 "active": has_minute_pack,
                 "minutes_left": minutes_left
             },
+            "end_coordinates": end_position.dict(),
+            "parking": parking,
             "message": "Поездка успешно завершена"
         }
 
     except HTTPException as e:
         # Записываем конкретную ошибку в лог
-        logger.error(f"HTTP ошибка при завершении поездки {request.trip_id}: {str(e)}")
+        logger.error("HTTP ошибка при завершении поездки %s: %s", request.trip_id, e)
 
         # Проверяем, возможно поездка уже завершена
         if e.status_code == 404:
@@ -496,7 +3765,7 @@ async def end_trip(request: EndTripRequest):
         )
     except Exception as e:
         # Записываем общую ошибку в лог
-        logger.exception(f"Общая ошибка при завершении поездки {request.trip_id}: {str(e)}")
+        logger.exception("Общая ошибка при завершении поездки %s: %s", request.trip_id, e)
 
         # Возвращаем ошибку в удобном формате
         return JSONResponse(
@@ -509,8 +3778,151 @@ async def end_trip(request: EndTripRequest):
         )
 
 
+def get_batch_limits(items: List[str], concurrency: Optional[int], timeout: Optional[float]) -> tuple:
+    if not items:
+        raise HTTPException(status_code=400, detail="Список самокатов пуст")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Слишком много самокатов в одном запросе (максимум {BATCH_MAX_ITEMS})")
+    concurrency = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    timeout = timeout if timeout and timeout > 0 else BATCH_ITEM_TIMEOUT
+    return concurrency, min(timeout, BATCH_ITEM_TIMEOUT)
+
+
+def start_batch(items: List[str], handler, concurrency: int, timeout: float) -> List[asyncio.Task]:
+    """
+    Запускает handler для каждого элемента не более чем concurrency одновременно.
+    Каждая задача возвращает результат по своему элементу и никогда не падает,
+    так что ошибка одного самоката не мешает остальным.
+    Задачи создаются сразу, внутри запроса, поэтому видят аккаунт и регион клиента.
+    Элемент, для которого к таймауту запрос на изменение (начало или завершение поездки)
+    уже ушел в API Whoosh, не отменяется: он доводится до конца в фоне, а в ответе
+    получает статус "unknown".
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index: int, item: str) -> Dict:
+        async with semaphore:
+            started = time.perf_counter()
+            result = {"index": index, "item": item}
+            write_flags = {"sent": False}
+            current_write_flags.set(write_flags)
+            task = asyncio.create_task(handler(item))
+            try:
+                done, _ = await asyncio.wait({task}, timeout=timeout)
+                if not done:
+                    if not write_flags["sent"]:
+                        task.cancel()
+                        raise asyncio.TimeoutError
+                    # Отмена не отменит уже отправленный запрос, а только скроет его результат
+                    task.add_done_callback(lambda late: log_late_batch_result(item, late))
+                    result.update(
+                        success=False, status_code=504, status="unknown",
+                        detail="Превышено время ожидания ответа API Whoosh, результат неизвестен: проверьте активные поездки"
+                    )
+                    result["elapsed"] = round(time.perf_counter() - started, 3)
+                    return result
+                response = task.result()
+                if isinstance(response, Response):
+                    # end_trip возвращает ошибки в виде JSONResponse
+                    result["status_code"] = response.status_code
+                    response = orjson.loads(response.body)
+                result["success"] = bool(response.get("success", True))
+                result["result"] = response
+            except asyncio.TimeoutError:
+                result.update(success=False, status_code=504, detail="Превышено время ожидания обработки самоката")
+            except HTTPException as e:
+                result.update(success=False, status_code=e.status_code, detail=e.detail)
+            except Exception as e:
+                logger.exception("Ошибка при обработке %s в групповой операции: %s", item, e)
+                result.update(success=False, status_code=500, detail=str(e))
+            result["elapsed"] = round(time.perf_counter() - started, 3)
+            return result
+
+    return [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+
+
+# Результат элемента групповой операции, завершившегося после таймаута
+def log_late_batch_result(item: str, task: asyncio.Task):
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logger.warning("Операция над %s завершилась после таймаута с ошибкой: %s", item, task.exception())
+        return
+    response = task.result()
+    if isinstance(response, Response):
+        logger.warning("Операция над %s завершилась после таймаута с кодом %s", item, response.status_code)
+    else:
+        logger.warning("Операция над %s завершилась после таймаута: %s", item, response.get("message"))
+
+
+async def stream_batch(tasks: List[asyncio.Task]):
+    # NDJSON: по строке на каждый самокат в порядке завершения, в конце - итог.
+    # Если клиент отключится, уже запущенные операции все равно доведутся до конца.
+    succeeded = 0
+    for next_done in asyncio.as_completed(tasks):
+        result = await next_done
+        succeeded += result["success"]
+        yield orjson.dumps(result) + b"\n"
+    yield orjson.dumps({"done": True, "total": len(tasks), "succeeded": succeeded,
+                        "failed": len(tasks) - succeeded}) + b"\n"
+
+
+async def batch_response(tasks: List[asyncio.Task], stream: bool):
+    if stream:
+        return StreamingResponse(
+            stream_batch(tasks),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    results = await asyncio.gather(*tasks)
+    succeeded = sum(result["success"] for result in results)
+    return {
+        "success": succeeded == len(results),
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    }
+
+
+# Групповой старт поездок
+@app.post("/api/batch/start_trips", summary="Начать поездки на нескольких самокатах",
+          response_model=BatchResponse, response_model_exclude_unset=True)
+async def batch_start_trips(batch: BatchStartTripsRequest, stream: bool = Query(True, description="Отдавать результаты NDJSON по мере готовности")):
+    """
+    Запускает поездки сразу на нескольких самокатах (групповая поездка).
+    Каждый самокат проходит тот же путь, что и /api/start_trip, параллельно с остальными.
+    Ошибка одного самоката не отменяет остальные: результат возвращается по каждому коду.
+    """
+    concurrency, timeout = get_batch_limits(batch.codes, batch.concurrency, batch.timeout)
+
+    async def start_one(code: str):
+        return await start_trip(ScooterCode(code=code, position=batch.position))
+
+    tasks = start_batch(batch.codes, start_one, concurrency, timeout)
+    return await batch_response(tasks, stream)
+
+
+# Групповое завершение поездок
+@app.post("/api/batch/end_trips", summary="Завершить несколько поездок",
+          response_model=BatchResponse, response_model_exclude_unset=True)
+async def batch_end_trips(batch: BatchEndTripsRequest, stream: bool = Query(True, description="Отдавать результаты NDJSON по мере готовности")):
+    """
+    Завершает сразу несколько поездок, как /api/end_trip для каждой, параллельно.
+    """
+    concurrency, timeout = get_batch_limits(batch.trip_ids, batch.concurrency, batch.timeout)
+
+    async def end_one(trip_id: str):
+        return await end_trip(EndTripRequest(trip_id=trip_id, position=batch.position))
+
+    tasks = start_batch(batch.trip_ids, end_one, concurrency, timeout)
+    return await batch_response(tasks, stream)
+
+
 # Эндпоинт для обновления токенов вручную
-@app.post("/api/refresh_tokens", summary="Обновить токены авторизации вручную")
+@app.post("/api/refresh_tokens", summary="Обновить токены авторизации вручную",
+          response_model=RefreshTokensResponse, response_model_exclude_unset=True)
 async def manual_refresh_tokens():
     """
     Ручное обновление токенов авторизации.
@@ -523,14 +3935,458 @@ async def manual_refresh_tokens():
             "message": "Токены успешно обновлены",
             "expires_in": "1 час"
         }
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при обновлении токенов: {str(e)}")
 
 
+# Эндпоинт для просмотра загрузки пула соединений к API Whoosh
+@app.get("/api/pool_stats", summary="Статистика пула HTTP-соединений",
+         response_model=Dict[str, Any], response_model_exclude_unset=True)
+async def get_http_pool_stats():
+    """
+    Возвращает текущее состояние общего пула соединений к API Whoosh:
+    - Количество открытых, активных и простаивающих соединений
+    - Количество запросов, ожидающих свободного соединения
+    - Настроенные лимиты пула
+    - Текущий адаптивный лимит одновременных запросов и очередь к нему (limiter)
+    - Состояние размыкателей цепи по путям API Whoosh (breakers)
+    """
+    return {
+        **get_pool_stats(),
+        "limiter": upstream_limiter.stats(),
+        "breakers": {name: breaker.stats() for name, breaker in circuit_breakers.items()}
+    }
+
+
+# Эндпоинт для просмотра эффективности кэша ответов
+@app.get("/api/cache_stats", summary="Статистика кэша ответов API Whoosh",
+         response_model=Dict[str, Any], response_model_exclude_unset=True)
+async def get_cache_stats():
+    """
+    Возвращает количество записей и занятую память кэша,
+    а также число попаданий (в том числе устаревших) и промахов.
+    """
+    return {
+        **response_cache.stats(),
+        "coalesced_requests": coalesced_requests_total,
+        "fallback": fallback_cache.stats(),
+        "devices": {
+            region_id: {"count": len(snapshot.devices), "version": snapshot.version_token, "updated_at": snapshot.updated_at}
+            for region_id, snapshot in device_snapshots.items()
+        }
+    }
+
+
+# Эндпоинт с метриками в формате Prometheus
+@app.get("/metrics", summary="Метрики Prometheus", include_in_schema=False)
+async def metrics():
+    """
+    Количество запросов, ошибок и гистограммы времени ответа по маршрутам нашего API
+    и по путям API Whoosh, обновления токенов, эффективность кэшей и загрузка пула соединений.
+    """
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+# Эндпоинт для получения списка регионов
+@app.get("/api/regions", summary="Список регионов Whoosh",
+         response_model=RegionsResponse, response_model_exclude_unset=True)
+async def get_regions():
+    """
+    Возвращает все регионы из ids_regions.json:
+    - ID региона (используется в заголовке X-Region-Id)
+    - Название
+    - Координаты центра
+    """
+    return {
+        "regions": region_index.regions,
+        "count": len(region_index.regions)
+    }
+
+
+# Эндпоинт для поиска ближайшего региона
+@app.get("/api/regions/nearest", summary="Ближайший регион по координатам",
+         response_model=NearestRegionResponse, response_model_exclude_unset=True)
+async def get_nearest_region(
+        lat: float = Query(..., ge=-90, le=90, description="Широта"),
+        lng: float = Query(..., ge=-180, le=180, description="Долгота")
+):
+    """
+    Возвращает регион, центр которого ближе всего к указанной точке,
+    и расстояние до него в километрах.
+    """
+    nearest = region_index.nearest(lat, lng)
+    if nearest is None:
+        raise HTTPException(status_code=404, detail="Регионы не загружены")
+
+    region, distance_km = nearest
+    return {**region, "distance_km": round(distance_km, 3)}
+
+
+# Расстояния в метрах от точки до массива точек (формула гаверсинусов)
+def haversine_distances(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    lat_rad = math.radians(lat)
+    lats_rad = np.radians(lats)
+    a = (np.sin((lats_rad - lat_rad) / 2) ** 2
+         + math.cos(lat_rad) * np.cos(lats_rad) * np.sin((np.radians(lngs) - math.radians(lng)) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * 1000 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+
+# Формат массового ответа об устройствах не документирован: ищем список устройств
+# и берем у каждого код, id, заряд и координаты в тех же полях, что и у устройства в поездке
+def extract_devices(data: Any) -> List[Dict]:
+    if isinstance(data, dict):
+        for key in ("devices", "items", "vehicles", "scooters"):
+            if isinstance(data.get(key), list):
+                data = data[key]
+                break
+    if not isinstance(data, list):
+        return []
+
+    devices = []
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        device = item.get("device", item)
+        point = (device.get("state", {}).get("position", {}).get("point")
+                 or device.get("position") or device.get("coordinate") or device)
+        lat = point.get("lat", point.get("latitude"))
+        lng = point.get("lng", point.get("longitude"))
+        if not device.get("code") or lat is None or lng is None:
+            continue
+        battery = device.get("battery")
+        devices.append({
+            "code": device["code"],
+            "device_id": device.get("id"),
+            "lat": float(lat),
+            "lng": float(lng),
+            "battery_level": battery.get("power") if isinstance(battery, dict) else battery
+        })
+    return devices
+
+
+class DeviceGrid:
+    """
+    Равномерная сетка с ячейками около cell_size метров. Поиск обходит кольца ячеек вокруг
+    точки от ближних к дальним и останавливается, как только следующее кольцо целиком
+    дальше радиуса или дальше уже найденных limit самокатов. Поэтому запрос стоит
+    пропорционально числу самокатов рядом, а не во всем регионе.
+    """
+
+    def __init__(self, devices: List[Dict], cell_size: float = DEVICES_GRID_CELL_SIZE):
+        self.devices = devices
+        self.cell_size = cell_size
+        lat0 = math.radians(sum(device["lat"] for device in devices) / len(devices)) if devices else 0.0
+        self.cell_lat = math.degrees(cell_size / (EARTH_RADIUS_KM * 1000))
+        self.cell_lng = self.cell_lat / max(math.cos(lat0), 0.01)
+        self.lat = np.array([device["lat"] for device in devices], dtype=np.float64)
+        self.lng = np.array([device["lng"] for device in devices], dtype=np.float64)
+        self.cells: Dict[tuple, List[int]] = {}
+        for index, device in enumerate(devices):
+            self.cells.setdefault(self._cell(device["lat"], device["lng"]), []).append(index)
+
+    def _cell(self, lat: float, lng: float) -> tuple:
+        return math.floor(lat / self.cell_lat), math.floor(lng / self.cell_lng)
+
+    def _ring(self, row: int, column: int, ring: int) -> List[int]:
+        if ring == 0:
+            return self.cells.get((row, column), [])
+        indices = []
+        for offset in range(-ring, ring + 1):
+            indices += self.cells.get((row - ring, column + offset), [])
+            indices += self.cells.get((row + ring, column + offset), [])
+        for offset in range(-ring + 1, ring):
+            indices += self.cells.get((row + offset, column - ring), [])
+            indices += self.cells.get((row + offset, column + ring), [])
+        return indices
+
+    def search(self, lat: float, lng: float, radius: float, limit: int, min_battery: int = 0) -> List[tuple]:
+        """Самокаты в радиусе radius метров с зарядом не ниже min_battery: [(расстояние, устройство)] по возрастанию"""
+        if not self.devices:
+            return []
+        row, column = self._cell(lat, lng)
+        # Сторона ячейки в метрах на этой широте: точка может быть у края своей ячейки,
+        # поэтому самокаты кольца ring не ближе ring - 1 сторон
+        cell_side = min(self.cell_size, self.cell_size * math.cos(math.radians(lat)) * self.cell_lng / self.cell_lat)
+        max_ring = int(radius // cell_side) + 1
+
+        found = []
+        for ring in range(max_ring + 1):
+            if len(found) >= limit and found[limit - 1][0] <= (ring - 1) * cell_side:
+                break
+            indices = self._ring(row, column, ring)
+            if not indices:
+                continue
+            distances = haversine_distances(lat, lng, self.lat[indices], self.lng[indices])
+            for index, distance in zip(indices, distances.tolist()):
+                device = self.devices[index]
+                if distance <= radius and (device["battery_level"] or 0) >= min_battery:
+                    found.append((distance, device))
+            found.sort(key=lambda match: match[0])
+        return found[:limit]
+
+
+class DeviceSnapshot:
+    """
+    Снимок самокатов одного региона. Фоновая задача раз в DEVICES_SNAPSHOT_INTERVAL секунд
+    запрашивает все самокаты региона одним запросом и, если что-то изменилось, увеличивает
+    версию и запоминает, какие самокаты изменились. Клиент, передавший прежнюю версию,
+    получает только изменения с нее.
+
+    Версия для клиента - строка "<эпоха>.<номер>". Эпоха случайна для каждого снимка, поэтому
+    версия, выданная до перезапуска сервера или другим воркером, не совпадет ни с одной
+    из версий этого снимка, и клиент получит полный список.
+    """
+
+    def __init__(self, region_id: str):
+        self.region_id = region_id
+        self.devices: Dict[str, Dict] = {}
+        self.grid = DeviceGrid([])
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        # Изменения после версии history_start хранятся полностью: (версия, код самоката)
+        self.history_start = self.version
+        self.changes: deque = deque()
+        self.updated_at: Optional[str] = None
+        self.error: Optional[str] = None
+        self.last_used = time.monotonic()
+        self.ready = asyncio.Event()
+        # Обновление не привязано к запросу, который его запустил: запрос уходит с любого аккаунта пула
+        self.task = asyncio.create_task(self.run(), context=Context())
+
+    async def run(self):
+        try:
+            while time.monotonic() - self.last_used < DEVICES_SNAPSHOT_IDLE:
+                try:
+                    await self.refresh()
+                    self.error = None
+                except Exception as e:
+                    self.error = str(e)
+                    logger.warning("Ошибка при обновлении снимка самокатов региона %s: %s", self.region_id, e)
+                self.ready.set()
+                await asyncio.sleep(DEVICES_SNAPSHOT_INTERVAL)
+        finally:
+            device_snapshots.pop(self.region_id, None)
+
+    async def refresh(self):
+        url = f"{BASE_URL}{DEVICES_SNAPSHOT_PATH}"
+        # Регион снимка уходит и заголовком X-region-id, независимо от того, кто вызвал обновление
+        token = current_region_id.set(self.region_id)
+        try:
+            data = await make_request("get", url, params={"regionId": self.region_id}, shared=True)
+        finally:
+            current_region_id.reset(token)
+        self.apply({device["code"]: device for device in extract_devices(data)})
+
+    def apply(self, devices: Dict[str, Dict]):
+        changed = [code for code, device in devices.items() if self.devices.get(code) != device]
+        changed += [code for code in self.devices if code not in devices]
+        self.updated_at = datetime.now(timezone.utc).isoformat()
+        if not changed:
+            return
+
+        self.version += 1
+        self.changes.extend((self.version, code) for code in changed)
+        while len(self.changes) > DEVICES_CHANGES_MAX:
+            self.history_start = self.changes.popleft()[0]
+        self.devices = devices
+        self.grid = DeviceGrid(list(devices.values()))
+
+    @property
+    def version_token(self) -> str:
+        return f"{self.epoch}.{self.version}"
+
+    def changed_since(self, version_token: str) -> Optional[set]:
+        """Коды самокатов, изменившихся после version_token (None - изменения с этой версии не известны)"""
+        epoch, _, number = version_token.partition(".")
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        version = int(number)
+        if not self.history_start <= version <= self.version:
+            return None
+        codes = set()
+        for change_version, code in reversed(self.changes):
+            if change_version <= version:
+                break
+            codes.add(code)
+        return codes
+
+
+# Снимки самокатов по регионам
+device_snapshots: Dict[str, DeviceSnapshot] = {}
+
+
+async def get_device_snapshot(region_id: str) -> DeviceSnapshot:
+    snapshot = device_snapshots.get(region_id)
+    if snapshot is None:
+        snapshot = device_snapshots[region_id] = DeviceSnapshot(region_id)
+    snapshot.last_used = time.monotonic()
+
+    await snapshot.ready.wait()
+    if snapshot.updated_at is None:
+        raise HTTPException(status_code=503, detail=f"Снимок самокатов региона недоступен: {snapshot.error}")
+    return snapshot
+
+
+class NearbyScooter(BaseModel):
+    code: str
+    device_id: Any = None
+    lat: float
+    lng: float
+    battery_level: Any = None
+    distance_m: float
+
+
+class NearbyScootersResponse(BaseModel):
+    region_id: str
+    version: str
+    full: bool
+    updated_at: Optional[str] = None
+    scooters: List[NearbyScooter]
+    removed: Optional[List[str]] = None
+    count: int
+
+
+# Эндпоинт для поиска самокатов рядом
+@app.get("/api/scooters/nearby", summary="Самокаты рядом",
+         response_model=NearbyScootersResponse, response_model_exclude_unset=True)
+async def get_nearby_scooters(
+        lat: Optional[float] = Query(None, ge=-90, le=90, description="Широта (по умолчанию - из X-Lat)"),
+        lng: Optional[float] = Query(None, ge=-180, le=180, description="Долгота (по умолчанию - из X-Lng)"),
+        radius: float = Query(NEARBY_DEFAULT_RADIUS, gt=0, le=NEARBY_MAX_RADIUS, description="Радиус поиска в метрах"),
+        min_battery: int = Query(0, ge=0, le=100, description="Минимальный заряд, %"),
+        limit: int = Query(NEARBY_DEFAULT_LIMIT, ge=1, le=NEARBY_MAX_LIMIT, description="Максимум самокатов в ответе"),
+        since_version: Optional[str] = Query(None, description="version из предыдущего ответа - вернуть только изменения")
+):
+    """
+    Возвращает самокаты в радиусе от точки, ближайшие первыми, из снимка всех самокатов
+    региона (обновляется раз в WHOOSH_DEVICES_SNAPSHOT_INTERVAL секунд).
+
+    С since_version возвращаются только изменения с этой версии: scooters - самокаты,
+    которые изменились и подходят под условия поиска, removed - коды самокатов, которые
+    пропали, уехали из радиуса или разрядились ниже min_battery; scooters тоже ограничены
+    limit ближайшими. Если изменения
+    с этой версии уже не известны, возвращается полный список (full=true).
+    """
+    if (lat is None) != (lng is None):
+        raise HTTPException(status_code=400, detail="Координаты нужно указать вместе: lat и lng")
+
+    position = get_rider_position(Position(lat=lat, lng=lng) if lat is not None else None)
+    region_id = get_request_region_id()
+    snapshot = await get_device_snapshot(region_id)
+
+    result = {
+        "region_id": region_id,
+        "version": snapshot.version_token,
+        "updated_at": snapshot.updated_at
+    }
+    changed = snapshot.changed_since(since_version) if since_version is not None else None
+
+    if changed is None:
+        matches = snapshot.grid.search(position.lat, position.lng, radius, limit, min_battery)
+        result["full"] = True
+    else:
+        matches = []
+        removed = []
+        for code in sorted(changed):
+            device = snapshot.devices.get(code)
+            distance = None
+            if device is not None and (device["battery_level"] or 0) >= min_battery:
+                distance = float(haversine_distances(position.lat, position.lng, np.array([device["lat"]]), np.array([device["lng"]]))[0])
+            if distance is not None and distance <= radius:
+                matches.append((distance, device))
+            else:
+                removed.append(code)
+        matches.sort(key=lambda match: match[0])
+        matches = matches[:limit]
+        result["full"] = False
+        result["removed"] = removed
+
+    result["scooters"] = [{**device, "distance_m": round(distance, 1)} for distance, device in matches]
+    result["count"] = len(matches)
+    return result
+
+
 # Добавим эти эндпоинты в существующий код API
 
+# Модели ответов эндпоинтов аккаунта
+class AccountResponse(BaseModel):
+    id: Optional[str] = None
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    locale: Optional[str] = None
+    trips_count: Optional[int] = None
+    birthdate: Optional[str] = None
+    verified: bool
+    verified_birthdate: Optional[bool] = None
+    gender: Optional[str] = None
+    verified_gender: Optional[bool] = None
+    auth_types: Optional[List[str]] = None
+    debtor: Optional[bool] = None
+
+
+class PaymentMethod(BaseModel):
+    id: Optional[str] = None
+    type: Optional[str] = None
+    card_type: Optional[str] = None
+    number: Optional[str] = None
+    rbs_type: Optional[str] = None
+    status: Optional[str] = None
+    preferable: Optional[bool] = None
+    last_successful_charge: Optional[bool] = None
+    created_at: Optional[str] = None
+
+
+class PaymentMethodsResponse(BaseModel):
+    payment_methods: List[PaymentMethod]
+    count: int
+    has_preferred_method: bool
+
+
+class UserSubscription(BaseModel):
+    id: Optional[str] = None
+    title: Optional[str] = None
+    name: Optional[str] = None
+    status: Optional[str] = None
+    valid_from: Optional[str] = None
+    valid_to: Optional[str] = None
+    # Union, а не float: целая цена остается в ответе целым числом
+    price: Optional[Union[int, float]] = None
+    currency: Optional[str] = None
+    auto_prolongation: Optional[bool] = None
+    is_trial: Optional[bool] = None
+
+
+class SubscriptionsResponse(BaseModel):
+    active_subscriptions: List[UserSubscription]
+    expired_subscriptions: List[UserSubscription]
+    on_hold_subscriptions: List[UserSubscription]
+    has_active_subscription: bool
+    active_until: Optional[str] = None
+
+
+class SubscriptionOffer(BaseModel):
+    id: Optional[str] = None
+    title: Optional[str] = None
+    name: Optional[str] = None
+    is_trial: Optional[bool] = None
+    price: Optional[Union[int, float]] = None
+    currency: Optional[str] = None
+    version: Optional[int] = None
+    features: Optional[List[str]] = None
+    illustration_url: Optional[str] = None
+
+
+class SubscriptionOffersResponse(BaseModel):
+    subscription_offers: List[SubscriptionOffer]
+    count: int
+
+
 # Эндпоинт для получения данных аккаунта пользователя
-@app.get("/api/account", summary="Получение данных аккаунта пользователя")
+@app.get("/api/account", summary="Получение данных аккаунта пользователя",
+         response_model=AccountResponse, response_model_exclude_unset=True)
 async def get_account_info():
     """
     Возвращает информацию о текущем пользователе:
@@ -542,7 +4398,7 @@ async def get_account_info():
     url = f"{BASE_URL}/users/logged"
 
     try:
-        response = await make_request("get", url)
+        response = await cached_request(url)
         user_data = response.get("user", {})
 
         # Формируем более удобный и компактный ответ
@@ -561,12 +4417,15 @@ async def get_account_info():
             "auth_types": user_data.get("authTypes", []),
             "debtor": user_data.get("debtor", False)
         }
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при получении данных аккаунта: {str(e)}")
 
 
 # Эндпоинт для получения платежных методов
-@app.get("/api/payment_methods", summary="Получение платежных методов пользователя")
+@app.get("/api/payment_methods", summary="Получение платежных методов пользователя",
+         response_model=PaymentMethodsResponse, response_model_exclude_unset=True)
 async def get_payment_methods():
     """
     Возвращает список платежных методов пользователя:
@@ -577,10 +4436,10 @@ async def get_payment_methods():
     - Предпочтительный метод оплаты
     """
     url = f"{BASE_URL}/payment/payment-methods"
-    params = {"regionId": REGION_ID}
+    params = {"regionId": get_request_region_id()}
 
     try:
-        response = await make_request("get", url, params=params)
+        response = await cached_request(url, params=params)
         payment_methods = response.get("paymentMethods", [])
 
         result = []
@@ -605,12 +4464,15 @@ async def get_payment_methods():
             "count": len(result),
             "has_preferred_method": any(method["preferable"] for method in result)
         }
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при получении платежных методов: {str(e)}")
 
 
 # Эндпоинт для получения подписок пользователя
-@app.get("/api/subscriptions", summary="Получение подписок пользователя")
+@app.get("/api/subscriptions", summary="Получение подписок пользователя",
+         response_model=SubscriptionsResponse, response_model_exclude_unset=True)
 async def get_user_subscriptions():
     """
     Возвращает информацию о подписках пользователя:
@@ -622,7 +4484,7 @@ async def get_user_subscriptions():
     url = f"{BASE_URL}/subscriptions/user"
 
     try:
-        response = await make_request("get", url)
+        response = await cached_request(url)
         subscriptions = response.get("userSubscriptions", [])
 
         # Группируем подписки по статусу
@@ -660,12 +4522,15 @@ async def get_user_subscriptions():
             "has_active_subscription": len(active_subscriptions) > 0,
             "active_until": active_subscriptions[0].get("valid_to") if active_subscriptions else None
         }
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при получении подписок: {str(e)}")
 
 
 # Эндпоинт для получения доступных предложений подписок
-@app.get("/api/subscription_offers", summary="Получение доступных предложений подписок")
+@app.get("/api/subscription_offers", summary="Получение доступных предложений подписок",
+         response_model=SubscriptionOffersResponse, response_model_exclude_unset=True)
 async def get_subscription_offers():
     """
     Возвращает информацию о доступных подписках для покупки:
@@ -676,7 +4541,8 @@ async def get_subscription_offers():
     url = f"{BASE_URL}/offer/subscriptions"
 
     try:
-        response = await make_request("get", url)
+        # Предложения не зависят от пользователя, поэтому запрос может уйти с любого аккаунта
+        response = await cached_request(url, shared=True)
         offers = response.get("subscriptionOffers", [])
 
         result = []
@@ -699,6 +4565,8 @@ async def get_subscription_offers():
             "subscription_offers": result,
             "count": len(result)
         }
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при получении предложений подписок: {str(e)}")
 
@@ -708,11 +4576,6 @@ from typing import Optional, List
 
 
 # Модели данных для бронирования
-class Position(BaseModel):
-    lat: float
-    lng: float
-
-
 class Amount(BaseModel):
     amount: int
     currency: str = "RUB"
@@ -741,46 +4604,83 @@ class ReservationRequest(BaseModel):
 # Модель для отмены бронирования
 class CancelReservationResponse(BaseModel):
     reservation_id: str
+    success: bool = True
+    created_at: Any = None
+    started_at: Any = None
+    finished_at: Any = None
+    status: str = "CANCELLED"
+    message: Optional[str] = None
+
+
+class ReservationResponse(BaseModel):
+    success: bool
+    reservation_id: Any = None
+    scooter_code: str
+    device_id: Any = None
+    created_at: Any = None
+    expires_at: Any = None
+    battery_level: Any = None
+    scooter_model: Any = None
+    coordinates: Any = None
+    message: str
+
+
+class ReservationSummary(BaseModel):
+    id: Any = None
+    created_at: Any = None
+    status: Any = None
+
+
+class StartReservedTripResponse(BaseModel):
+    success: bool
+    trip_id: Any = None
+    scooter_code: Any = None
+    created_at: Any = None
+    status: Any = None
+    battery_level: Any = None
+    reservation: ReservationSummary
+    message: str
+
+
+class ActiveReservation(BaseModel):
+    reservation_id: Any = None
+    scooter_code: Any = None
+    created_at: Any = None
+    expires_at: Any = None
+    status: Any = None
+    device_id: Any = None
+    battery_level: Any = None
+
+
+class ActiveReservationsResponse(BaseModel):
+    active_reservations: List[ActiveReservation]
+    count: int
 
 
 # Модель для начала поездки по бронированию
 class StartReservedTripRequest(BaseModel):
     deviceCode: str
+    position: Optional[Position] = None
 
 
 # Эндпоинт для бронирования самоката
-@app.post("/api/reserve_scooter/{scooter_code}", summary="Бронирование самоката")
+@app.post("/api/reserve_scooter/{scooter_code}", summary="Бронирование самоката",
+          response_model=ReservationResponse, response_model_exclude_unset=True)
 async def reserve_scooter(scooter_code: str, request: Optional[ReservationRequest] = None):
     """
     Бронирует самокат на 20 минут.
     После бронирования вы можете начать поездку в течение этого времени.
     """
     try:
-        # Получаем информацию о самокате
-        device_state_url = f"{BASE_URL}/devices/state"
-        device_params = {
-            "code": scooter_code,
-            "lat": DEFAULT_LAT,
-            "lng": DEFAULT_LNG,
-            "scanType": "MANUAL"
-        }
-
-        device_info = await make_request("get", device_state_url, params=device_params)
-
-        if "device" not in device_info:
-            raise HTTPException(status_code=404, detail="Самокат не найден")
-
-        device_id = device_info.get("device", {}).get("id")
-
-        # Получаем тарифы для самоката
-        tariff_url = f"{BASE_URL}/tariffs/tariff/minute-pack"
-        tariff_params = {"device": device_id}
+        position = get_rider_position(request.position if request is not None else None)
 
-        tariffs_info = await make_request("get", tariff_url, params=tariff_params)
+        # Получаем id самоката (заодно проверяем, что самокат существует)
+        device_id = await resolve_device_id(scooter_code, position)
 
         # Если запрос не содержит данных о тарифах, используем полученные
         if request is None:
-            position = Position(lat=DEFAULT_LAT, lng=DEFAULT_LNG)
+            tariffs_info = await get_device_tariffs(device_id)
+
             tariffs = tariffs_info.get("tariffs", [])
             tariffs_token = tariffs_info.get("tariffsToken", "")
 
@@ -797,11 +4697,13 @@ async def reserve_scooter(scooter_code: str, request: Optional[ReservationReques
         # Выполняем запрос на бронирование
         reservation_url = f"{BASE_URL}/reservations/{scooter_code}"
         reservation_response = await make_request("post", reservation_url, json_data=json_data)
+        invalidate_account_cache()
 
         if "reservation" not in reservation_response:
             raise HTTPException(status_code=500, detail="Не удалось забронировать самокат")
 
         reservation = reservation_response.get("reservation", {})
+        track_reservation(reservation.get("id"), reservation.get("expiresAt"), scooter_code)
 
         # Форматируем ответ
         return {
@@ -824,7 +4726,8 @@ async def reserve_scooter(scooter_code: str, request: Optional[ReservationReques
 
 
 # Эндпоинт для отмены бронирования
-@app.delete("/api/cancel_reservation/{reservation_id}", summary="Отмена бронирования")
+@app.delete("/api/cancel_reservation/{reservation_id}", summary="Отмена бронирования",
+            response_model=CancelReservationResponse, response_model_exclude_unset=True)
 async def cancel_reservation(reservation_id: str):
     """
     Отменяет бронирование самоката.
@@ -833,9 +4736,11 @@ async def cancel_reservation(reservation_id: str):
         # Выполняем запрос на отмену бронирования
         cancel_url = f"{BASE_URL}/reservations/{reservation_id}"
         cancel_response = await make_request("delete", cancel_url)
+        invalidate_account_cache()
 
         if "reservation" not in cancel_response:
             raise HTTPException(status_code=500, detail="Не удалось отменить бронирование")
+        untrack_reservation(reservation_id)
 
         reservation = cancel_response.get("reservation", {})
 
@@ -862,15 +4767,15 @@ async def cancel_reservation(reservation_id: str):
 
 
 # Эндпоинт для начала поездки по бронированию
-@app.post("/api/start_reserved_trip", summary="Начало поездки по бронированию")
+@app.post("/api/start_reserved_trip", summary="Начало поездки по бронированию",
+          response_model=StartReservedTripResponse, response_model_exclude_unset=True)
 async def start_reserved_trip(request: StartReservedTripRequest):
     """
     Начинает поездку по ранее забронированному самокату.
     """
     try:
         # Формируем запрос на начало поездки по бронированию
-        trips_url = f"{BASE_URL}/trips"
-        position = Position(lat=DEFAULT_LAT, lng=DEFAULT_LNG)
+        position = get_rider_position(request.position)
 
         json_data = {
             "deviceCode": request.deviceCode,
@@ -886,13 +4791,15 @@ async def start_reserved_trip(request: StartReservedTripRequest):
         }
 
         # Выполняем запрос на начало поездки
-        trip_response = await make_request("post", trips_url, json_data=json_data)
+        trip_response = await send_start_trip(json_data)
+        invalidate_account_cache()
 
         if "trip" not in trip_response:
             raise HTTPException(status_code=500, detail="Не удалось начать поездку по бронированию")
 
         trip = trip_response.get("trip", {})
         reservation = trip.get("reservation", {})
+        untrack_reservation(reservation.get("id"))
 
         # Форматируем ответ
         return {
@@ -917,7 +4824,8 @@ async def start_reserved_trip(request: StartReservedTripRequest):
 
 
 # Эндпоинт для получения информации о текущем бронировании
-@app.get("/api/active_reservations", summary="Получение информации о текущих бронированиях")
+@app.get("/api/active_reservations", summary="Получение информации о текущих бронированиях",
+         response_model=ActiveReservationsResponse, response_model_exclude_unset=True)
 async def get_active_reservations():
     """
     Возвращает информацию о текущих бронированиях пользователя.
@@ -937,6 +4845,7 @@ async def get_active_reservations():
                 reservation = trip.get("reservation", {})
 
                 if reservation.get("status") != "CANCELLED" and reservation.get("status") != "COMPLETED":
+                    track_reservation(reservation.get("id"), reservation.get("expiresAt"), trip.get("device", {}).get("code"))
                     active_reservations.append({
                         "reservation_id": reservation.get("id"),
                         "scooter_code": trip.get("device", {}).get("code"),
@@ -952,9 +4861,39 @@ async def get_active_reservations():
             "count": len(active_reservations)
         }
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при получении активных бронирований: {str(e)}")
 
+# Проверка живости: процесс запущен и отвечает
+@app.get("/healthz", summary="Проверка живости сервера", include_in_schema=False)
+async def healthz():
+    return {"status": "ok", "uptime": round(time.time() - started_at, 1)}
+
+
+# Проверка готовности: прогрев завершен и у всех аккаунтов есть действующие токены
+@app.get("/readyz", summary="Проверка готовности сервера", include_in_schema=False)
+async def readyz():
+    now = time.time()
+    accounts = {}
+    for account in account_pool.accounts.values():
+        manager = account.token_manager
+        expires_at = manager.expires_at()
+        accounts[account.id] = {
+            "fresh": manager.is_fresh(),
+            "expires_in": round(expires_at - now) if expires_at is not None else None,
+            "refreshing": manager.is_refreshing()
+        }
+
+    warmed_up = warm_up_task is not None and warm_up_task.done()
+    ready = warmed_up and http_client is not None and all(state["fresh"] for state in accounts.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "warmed_up": warmed_up, "accounts": accounts}
+    )
+
+
 @app.get("/{full_path:path}")
 async def serve_react_app(full_path: str, request: Request):
     # Если запрос начинается с /api/, возвращаем 404, так как это API маршрут, который не был найден
@@ -968,19 +4907,76 @@ async def serve_react_app(full_path: str, request: Request):
     else:
         raise HTTPException(status_code=404, detail="React build not found")
 
-# Проверяем при запуске, есть ли токены, и если нет - создаем файл
+# Фоновый прогрев токенов, запущенный при старте (None - еще не запускался)
+warm_up_task: Optional[asyncio.Task] = None
+started_at = time.time()
+
+
+# Сервер начинает принимать запросы сразу, а токены загружаются и обновляются в фоне.
+# Запрос, пришедший до окончания прогрева, сам дождется токенов своего аккаунта
 @app.on_event("startup")
 async def startup_event():
-    tokens = load_tokens()
-    if not tokens.get("access_token") or not tokens.get("id_token"):
-        logger.info("Токены отсутствуют, попытка получить новые...")
+    global http_client, warm_up_task, parkings_refresh_task
+    http_client = create_http_client()
+    trip_history.start()
+
+    warm_up_task = asyncio.create_task(warm_up_accounts())
+
+    if PARKINGS_SOURCE_PATH:
+        parkings_refresh_task = asyncio.create_task(refresh_parkings_periodically())
+    elif not parking_indexes:
+        logger.warning(
+            "Файл парковок %s не найден или пуст: точка завершения поездки не притягивается к парковкам "
+            "(создайте файл по описанию в DocsAPI.md или задайте WHOOSH_PARKINGS_SOURCE_PATH)", PARKINGS_FILE
+        )
+
+
+async def warm_up_accounts():
+    await asyncio.gather(*(warm_up_account(account) for account in account_pool.accounts.values()))
+
+
+# Загружаем токены аккаунта и обновляем их, если они отсутствуют или истекли
+async def warm_up_account(account: Account):
+    manager = account.token_manager
+    await manager.load()
+    if not manager.is_fresh():
+        logger.info("Токены аккаунта %s отсутствуют или истекли, попытка получить новые...", account.id)
         try:
-            await refresh_tokens()
-            logger.info("Токены успешно обновлены")
+            await manager.refresh(stale_access_token=manager.tokens.get("access_token"))
+            logger.info("Токены аккаунта %s успешно обновлены", account.id)
         except Exception as e:
-            logger.error(f"Ошибка при обновлении токенов при запуске: {str(e)}")
+            logger.error("Ошибка при обновлении токенов аккаунта %s при запуске: %s", account.id, e)
             # Не прерываем запуск, сервер все равно должен запуститься
 
 
+# Закрываем общий HTTP-клиент при остановке сервера
+@app.on_event("shutdown")
+async def shutdown_event():
+    global http_client
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    if parkings_refresh_task is not None:
+        parkings_refresh_task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    expiry_scheduler.stop()
+    await asyncio.to_thread(trip_history.stop)
+    await shared_store.close()
+
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8031, reload=True)
\ No newline at end of file
+    # Запускаем uvicorn как отдельную программу: процессы воркеров и перезагрузчика импортируют
+    # main:app сами, а не выполняют этот файл повторно как __main__ (метрики регистрировались бы дважды).
+    # Автоперезагрузка при изменении кода - только для разработки (WHOOSH_RELOAD=1, один воркер).
+    # WHOOSH_WORKERS > 1 запускает несколько процессов с общим хранилищем токенов и кэша
+    args = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", os.getenv("WHOOSH_HOST", "0.0.0.0"),
+        "--port", os.getenv("WHOOSH_PORT", "8031")
+    ]
+    if os.getenv("WHOOSH_RELOAD", "0") == "1":
+        args.append("--reload")
+    elif WORKERS > 1:
+        args += ["--workers", str(WORKERS)]
+    os.execv(sys.executable, args)
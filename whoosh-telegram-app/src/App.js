@@ -13,6 +13,9 @@ const TelegramApp = () => {
   // Базовый URL API - используем относительные пути
   const API_BASE_URL = '';
 
+  // Минимальная длина кода самоката, с которой его имеет смысл готовить к поездке (например KE446A)
+  const MIN_SCOOTER_CODE_LENGTH = 6;
+
   // Определяем функцию endTrip с помощью useCallback, чтобы её можно было использовать в эффектах
   const endTrip = useCallback(async (tripId) => {
     if (!tripId) return;
@@ -185,29 +188,51 @@ const TelegramApp = () => {
     }
   }, [loading]);
 
-  // ВАЖНО: Проверка статуса поездки каждую секунду
+  // Подписка на поток обновлений поездки и пакета минут (Server-Sent Events).
+  // Сервер сам опрашивает API Whoosh и присылает данные только при изменениях.
   useEffect(() => {
-    // Каждую секунду проверяем статус поездки
-    const tripInfoInterval = setInterval(() => {
-      fetchTripInfo();
-    }, 1000);
+    const tripStream = new EventSource(`${API_BASE_URL}/api/trip_stream`);
+
+    tripStream.addEventListener('trip', (event) => {
+      applyTripInfo(JSON.parse(event.data));
+    });
+
+    tripStream.addEventListener('minute_pack', (event) => {
+      setMinutePack(JSON.parse(event.data));
+    });
 
-    // Очистка при размонтировании
+    tripStream.onerror = () => {
+      // EventSource переподключается сам, просто фиксируем проблему
+      console.warn('Поток обновлений поездки прерван, переподключение...');
+    };
+
+    // Закрываем поток при размонтировании
     return () => {
-      clearInterval(tripInfoInterval);
+      tripStream.close();
     };
   }, []);
 
-  // Получение информации о пакете минут каждые 5 секунд
+  // Заранее готовим самокат к поездке, пока пользователь не нажал "Поехали!"
   useEffect(() => {
-    const minutePackInterval = setInterval(() => {
-      fetchMinutePack();
-    }, 5000);
+    const code = scooterCode.trim();
+    if (code.length < MIN_SCOOTER_CODE_LENGTH) return;
+
+    const prepareTimeout = setTimeout(() => {
+      fetch(`${API_BASE_URL}/api/prepare_trip/${encodeURIComponent(code)}`, {
+        method: 'POST',
+        headers: {
+          'Accept': 'application/json'
+        }
+      }).catch((err) => {
+        // Не критично: start_trip сам выполнит все запросы
+        console.warn('Не удалось заранее подготовить самокат:', err);
+      });
+    }, 500);
 
     return () => {
-      clearInterval(minutePackInterval);
+      clearTimeout(prepareTimeout);
     };
-  }, []);
+  }, [scooterCode]);
 
   // Функция обновления темы
   const updateTheme = () => {
@@ -243,29 +268,34 @@ const TelegramApp = () => {
       const data = await response.json();
       console.log('Получен статус поездки:', data);
 
-      // Проверяем результат и обновляем состояние активной поездки
-      if (data.active_trip) {
-        setActiveTrip(data);
-      } else {
-        // Если активной поездки нет, но сообщение "Нет активных поездок",
-        // то это нормальная ситуация, не ошибка
-        if (data.message === "Нет активных поездок") {
-          // Молча обновляем состояние
-          setActiveTrip(null);
-          setError(null); // Очищаем ошибку, если она была
-        } else if (data.status === "None") {
-          // Обрабатываем специфический случай со статусом None
-          console.log('Получен статус None, это нормально после завершения поездки');
-          setActiveTrip(null);
-          setError(null); // Очищаем ошибку, чтобы не показывать "неожиданный статус None"
-        }
-      }
+      applyTripInfo(data);
     } catch (err) {
       console.error('Ошибка при получении информации о поездке:', err);
       // Не сбрасываем активную поездку при ошибке соединения
     }
   };
 
+  // Обновление состояния по информации о поездке (из /api/trip_info или из потока)
+  const applyTripInfo = (data) => {
+    // Проверяем результат и обновляем состояние активной поездки
+    if (data.active_trip) {
+      setActiveTrip(data);
+    } else {
+      // Если активной поездки нет, но сообщение "Нет активных поездок",
+      // то это нормальная ситуация, не ошибка
+      if (data.message === "Нет активных поездок") {
+        // Молча обновляем состояние
+        setActiveTrip(null);
+        setError(null); // Очищаем ошибку, если она была
+      } else if (data.status === "None") {
+        // Обрабатываем специфический случай со статусом None
+        console.log('Получен статус None, это нормально после завершения поездки');
+        setActiveTrip(null);
+        setError(null); // Очищаем ошибку, чтобы не показывать "неожиданный статус None"
+      }
+    }
+  };
+
   // Получение информации о пакете минут
   const fetchMinutePack = async () => {
     try {